@@ -16,7 +16,7 @@ import obsplus
 from obsplus.constants import CPU_COUNT, bank_subpaths_type
 from obsplus.exceptions import BankDoesNotExistError
 from obsplus.interfaces import ProgressBar
-from obsplus.utils.bank import _IndexCache
+from obsplus.utils.bank import _IndexCache, _PrunedFileIterator, DIRECTORY_COLUMNS
 from obsplus.utils.misc import get_progressbar, iter_files, iterate
 from obsplus.utils.time import to_datetime64
 
@@ -39,12 +39,17 @@ class _Bank(ABC):
     namespace = ""
     index_name = ".index.h5"  # name of index file
     executor = None  # an executor for using parallelism
+    # if True only list directories whose mtime changed since the last update
+    prune_directories = False
     # optional str defining the directory structure and file name schemes
     path_structure = None
     name_structure = None
     # the minimum obsplus version. If not met delete index and re-index
     # bump when database schema change.
     _min_version = "0.0.3"
+    # the version of the index layout used by the bank, indices created with
+    # an older layout are deleted and re-indexed. Bump when the layout changes.
+    _schema_version = 0
     # status bar attributes
     _bar_update_interval = 50  # number of files before updating bar
     _min_files_for_bar = 100  # min number of files before using bar enabled
@@ -83,6 +88,14 @@ class _Bank(ABC):
     def _read_metadata(self) -> pd.DataFrame:
         """Return a dictionary of metadata."""
 
+    @abstractmethod
+    def _read_directory_manifest(self) -> Optional[pd.DataFrame]:
+        """Return the directory manifest of the last update, else None."""
+
+    @abstractmethod
+    def _write_directory_manifest(self, manifest: pd.DataFrame):
+        """Replace the stored directory manifest."""
+
     # --- path/node related objects
 
     @property
@@ -110,16 +123,23 @@ class _Bank(ABC):
         """The node/table where the update metadata is stored."""
         return "/".join([self.namespace, "metadata"])
 
+    @property
+    def _directory_node(self):
+        """The node/table where the directory manifest is stored."""
+        return "/".join([self.namespace, "directories"])
+
     def _enforce_min_version(self):
         """Check version of obsplus used to create index and delete index if the
         minimum version requirement is not met.
         """
         try:
-            version = self._index_version
+            meta = self._read_metadata()
         except (FileNotFoundError, DatabaseError):
             return
         else:
-            if self._min_version > version:
+            version = meta["obsplus_version"].iloc[0]
+            schema = meta.get("schema_version", pd.Series([0])).iloc[0]
+            if self._min_version > version or self._schema_version > int(schema):
                 msg = (
                     f"the indexing schema has changed since {self._min_version} "
                     f"the index will be recreated"
@@ -127,8 +147,16 @@ class _Bank(ABC):
                 warnings.warn(msg)
                 os.remove(self.index_path)
 
-    def _unindexed_iterator(self, paths: Optional[bank_subpaths_type] = None):
-        """Return an iterator of potential unindexed files."""
+    def _unindexed_iterator(
+        self, paths: Optional[bank_subpaths_type] = None, track_files: bool = False
+    ):
+        """
+        Return an iterator of potential unindexed files.
+
+        If paths is None a _PrunedFileIterator is returned which, if
+        prune_directories is True, skips directories unchanged since the last
+        update. If track_files is True it also records the files it finds.
+        """
         # get mtime, subtract a bit to avoid odd bugs
         mtime = None
         last_updated = self.last_updated_timestamp  # this needs db so only call once
@@ -137,7 +165,10 @@ class _Bank(ABC):
         # get paths to iterate
         bank_path = self.bank_path
         if paths is None:
-            paths = self.bank_path
+            prune = self.prune_directories
+            manifest = self._read_directory_manifest() if prune else None
+            kwargs = dict(ext=self.ext, mtime=mtime, track_files=track_files)
+            return _PrunedFileIterator(bank_path, manifest, **kwargs)
         else:
             paths = [
                 f"{self.bank_path}/{x}" if str(bank_path) not in str(x) else str(x)
@@ -146,6 +177,14 @@ class _Bank(ABC):
         # return file iterator
         return iter_files(paths, ext=self.ext, mtime=mtime)
 
+    def _update_directory_manifest(self, file_iterator: Iterable):
+        """Write the directories found by a pruned walk if they changed."""
+        if not self.prune_directories or not getattr(file_iterator, "changed", 0):
+            return
+        rows = list(file_iterator.directories.values())
+        df = pd.DataFrame(rows, columns=list(DIRECTORY_COLUMNS))
+        self._write_directory_manifest(df)
+
     def _measure_iterator(self, iterable: Iterable, bar: Optional[ProgressBar] = None):
         """A generator to yield un-indexed files and update progress bar."""
         # get progress bar
@@ -165,6 +204,7 @@ class _Bank(ABC):
             path_structure=self.path_structure,
             name_structure=self.name_structure,
             obsplus_version=obsplus.__version__,
+            schema_version=self._schema_version,
         )
         return pd.DataFrame(meta, index=[0])
 
@@ -109,6 +109,11 @@ class EventBank(_Bank):
         An executor with the same interface as
         :py:class:`concurrent.futures.Executor, the map method of the executor
         will be used for reading files and updating indices.
+    prune_directories
+        If True, update_index only lists directories whose modification time
+        has changed since the last update, which greatly speeds up updating
+        large archives. Files modified in place (rather than created or
+        replaced) in unchanged directories are then not re-indexed.
 
     Attributes
     ----------
@@ -158,6 +163,7 @@ class EventBank(_Bank):
         format="quakeml",
         ext=".xml",
         executor: Optional[Executor] = None,
+        prune_directories: bool = False,
     ):
         """ Initialize an instance. """
         if isinstance(base_path, EventBank):
@@ -173,6 +179,7 @@ class EventBank(_Bank):
         ns = name_structure or self._name_structure or EVENT_NAME_STRUCTURE
         self.name_structure = ns
         self.executor = executor
+        self.prune_directories = prune_directories
         # initialize cache
         self._index_cache = _IndexCache(self, cache_size=cache_size)
         # enforce min version upon init
@@ -279,6 +286,7 @@ class EventBank(_Bank):
         events_remain = True
         while events_remain:
             events_remain = self._index_from_iterable(iterator, update_time)
+        self._update_directory_manifest(file_yielder)
         return self
 
     def _index_from_iterable(self, iterable, update_time):
@@ -398,6 +406,24 @@ class EventBank(_Bank):
             out = pd.read_sql(sql, con)
         return out
 
+    # --- directory manifest
+
+    def _read_directory_manifest(self) -> Optional[pd.DataFrame]:
+        """ Return the directory manifest of the last update, else None. """
+        if not self.index_path.exists():  # connecting would create the file
+            return None
+        with sql_connection(self.index_path) as con:
+            try:
+                return _read_table(self._directory_node, con)
+            except pd.io.sql.DatabaseError:
+                return None
+
+    def _write_directory_manifest(self, manifest: pd.DataFrame):
+        """ Replace the directory manifest. """
+        with sql_connection(self.index_path) as con:
+            node = self._directory_node
+            manifest.to_sql(node, con, if_exists="replace", index=False)
+
     # --- read events stuff
 
     @compose_docstring(get_events_params=get_events_parameters)
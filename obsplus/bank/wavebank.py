@@ -1,15 +1,20 @@
 """
 A local database for waveform formats.
 """
+import glob
+import os
+import shutil
+import threading
 import time
-from collections import defaultdict
-from contextlib import suppress
-from concurrent.futures import Executor
-from functools import partial, reduce
-from itertools import chain
-from operator import add
+import warnings
+from collections import defaultdict, deque
+from contextlib import contextmanager, suppress
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
 from pathlib import Path
-from typing import Optional, Union
+from types import MappingProxyType as MapProxy
+from typing import List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import obspy
@@ -38,10 +43,28 @@ from obsplus.constants import (
 from obsplus.utils.bank import (
     _summarize_trace,
     _IndexCache,
+    _FileLock,
+    _IndexSnapshot,
+    _SharedIndex,
+    _IntervalIndex,
     _summarize_wave_file,
+    _summarize_mseed_traces,
+    _merge_stream,
     _try_read_stream,
+    _try_read_byte_ranges,
+    _try_read_stream_times,
+    _interval_join,
+    _coalesce_intervals,
+    _find_gaps,
+    _plan_index_query,
+    _merge_coverage,
+    _binned_coverage,
+    _TraceCache,
+    _summarize_record_blocks,
     summarizing_functions,
     _remove_base_path,
+    _stat_file,
+    _stat_key,
 )
 from obsplus.utils.docs import compose_docstring
 from obsplus.utils.misc import replace_null_nlsc_codes
@@ -102,6 +125,56 @@ class WaveBank(_Bank):
         An executor with the same interface as concurrent.futures.Executor,
         the map method of the executor will be used for reading files and
         updating indices.
+    prune_directories
+        If True, update_index only lists directories whose modification time
+        has changed since the last update, which greatly speeds up updating
+        large archives. Files modified in place (rather than created or
+        replaced) in unchanged directories are then not re-indexed.
+    records_per_block
+        If an int, update_index also stores the byte offsets of blocks of
+        this many records in each (fixed record length) miniSEED file, and
+        waveform requests with start and end times only read and decode the
+        blocks which overlap the requested times.
+    trace_cache_bytes
+        The number of bytes of decoded traces to keep in memory so repeated
+        requests for data from the same files need not read them again. The
+        least recently used traces are evicted first and traces of files
+        changed on disk are never used. When the cache is used files are read
+        whole. The default of 0 disables the cache; see trace_cache_info.
+    index_partition
+        If "year" or "month", the rows of the index are stored in one table
+        for each year or month, chosen by the starttime of each file, and a
+        small manifest of the time span of each table is kept. Queries then
+        only read the tables which overlap the requested times and updates
+        only write to the tables of the files they change. If None, the
+        layout of an existing index is used, new indexes have a single
+        table. An index with a different layout is rebuilt by update_index.
+    snapshot
+        If True, the index file is loaded into memory once and kept open for
+        the life of the bank, rather than opened for every query. It is only
+        loaded again when the update time stored in the index changes, so
+        queries see the index as of the last completed update_index (by any
+        process). Useful for serving many small requests.
+    shared_index
+        If True, index queries are served from a copy of the index columns
+        in memory-mapped files next to the index, which all processes using
+        the bank share rather than each keeping its own copy in memory. The
+        copy is written by the first update_index of such a bank, then the
+        changes of each update (of any bank) are added to it, each time with
+        a new generation number which readers switch to on their next query.
+        Until there is a copy, queries read the index file. Only the
+        selected rows are decoded, and the paths of the returned index are
+        categoricals of only those paths.
+
+    Notes
+    -----
+    Readers and writers of the index coordinate with file locks, so any use
+    of a bank, even read only, creates the files .index.h5.lock and
+    .index.h5.write.lock next to the index. If they can't be created (eg the
+    bank is read only) reads still work, but are only coordinated with
+    other threads of the same process. update_index writes to a copy of the
+    index (.index.h5.<key>.update) which then replaces the index, so an
+    interrupted update leaves the copy behind for the next to continue.
 
     Examples
     --------
@@ -157,12 +230,69 @@ class WaveBank(_Bank):
     _gap_columns = tuple(list(columns_no_path) + ["gap_duration"])
     namespace = "/waveforms"
     buffer = np.timedelta64(1_000_000_000, "ns")
-    # dict defining lengths of str columns (after seed spec)
+    # columns stored as integer codes which refer to lookup tables
+    _categorical_columns = tuple(list(index_str) + ["path"])
+    # dict defining lengths of str columns (after seed spec) in lookup tables
     # Note: Empty strings get their dtypes caste as S8, which means 8 is the min
     min_itemsize = {"path": 79, "station": 8, "network": 8, "location": 8, "channel": 8}
     _min_files_for_bar = 5000  # number of files before progress bar kicks in
     _dtypes_input = WAVEFORM_DTYPES_INPUT
-    _dtypes_output = WAVEFORM_DTYPES
+    _dtypes_output = MapProxy({**WAVEFORM_DTYPES, **dict.fromkeys(NSLC, "category")})
+    _schema_version = 6
+    _max_files_in_memory = 10_000  # max files to summarize before flushing
+    # columns of the file manifest; start and stop are the range of row labels
+    # and shard is the partition key of the table holding the rows
+    _file_columns = MapProxy(
+        dict(
+            path="int32",
+            size="int64",
+            mtime="float64",
+            start="int64",
+            stop="int64",
+            shard="int64",
+        )
+    )
+    # datetime64 units of the supported index partitions
+    _partition_units = MapProxy(dict(year="Y", month="M"))
+    # columns of the shard manifest; the time span of each partition table
+    # and the label after its last row
+    _shard_columns = MapProxy(
+        dict(key="int64", starttime="int64", endtime="int64", stop="int64")
+    )
+    # columns of the record blocks used for partial reads
+    _record_columns = MapProxy(
+        dict(
+            path="int32",
+            offset="int64",
+            nbytes="int64",
+            starttime="int64",
+            endtime="int64",
+        )
+    )
+    # columns of the per channel coverage table, codes and int64 ns
+    _coverage_key = tuple(list(NSLC) + ["sampling_period"])
+    _coverage_columns = MapProxy(
+        {
+            **dict.fromkeys(NSLC, "int32"),
+            "sampling_period": "int64",
+            "starttime": "int64",
+            "endtime": "int64",
+        }
+    )
+    _coverage_periods = 1.5  # sampling periods between merged intervals
+    # columns of the index tables with completely sorted (CSI) indexes
+    _csi_columns = tuple(list(NSLC) + ["starttime", "endtime"])
+    # columns of the stats returned by get_waveforms_array
+    _array_stats_dtypes = MapProxy(
+        {
+            "request": "int64",
+            "channel_index": "int64",
+            **dict.fromkeys(NSLC, str),
+            "starttime": "datetime64[ns]",
+            "sampling_rate": "float64",
+            "npts": "int64",
+        }
+    )
 
     # ----------------------------- setup stuff
 
@@ -175,6 +305,12 @@ class WaveBank(_Bank):
         format="mseed",
         ext=None,
         executor: Optional[Executor] = None,
+        prune_directories: bool = False,
+        records_per_block: Optional[int] = None,
+        trace_cache_bytes: int = 0,
+        index_partition: Optional[str] = None,
+        snapshot: bool = False,
+        shared_index: bool = False,
     ):
         if isinstance(base_path, WaveBank):
             self.__dict__.update(base_path.__dict__)
@@ -186,13 +322,59 @@ class WaveBank(_Bank):
         self.path_structure = path_structure or WAVEFORM_STRUCTURE
         self.name_structure = name_structure or WAVEFORM_NAME_STRUCTURE
         self.executor = executor
+        self.prune_directories = prune_directories
+        self.records_per_block = records_per_block
+        if index_partition is not None and index_partition not in self._partition_units:
+            msg = f"index_partition must be one of {list(self._partition_units)}"
+            raise ValueError(msg)
+        self.index_partition = index_partition
         # initialize cache
         self._index_cache = _IndexCache(self, cache_size=cache_size)
+        self._trace_cache = _TraceCache(max_bytes=trace_cache_bytes)
+        self._snapshot = _IndexSnapshot(self) if snapshot else None
+        self._shared_index = _SharedIndex(self) if shared_index else None
+        # readers share the index lock, writes to the index take it alone;
+        # the write lock is held by the one process updating the index. The
+        # lock files are made on first use, reads work without them.
+        self._index_lock = _FileLock(f"{self.index_path}.lock")
+        self._write_lock = _FileLock(f"{self.index_path}.write.lock")
+        self._staged = None  # (thread id, path) of an update, see _staged_index
         # enforce min version upon init
         self._enforce_min_version()
 
     # ----------------------- index related stuff
 
+    @property
+    def _file_node(self):
+        """ The node where the file manifest is stored. """
+        return "/".join([self.namespace, "files"])
+
+    @property
+    def _record_node(self):
+        """ The node where the byte ranges of record blocks are stored. """
+        return "/".join([self.namespace, "records"])
+
+    @property
+    def _coverage_node(self):
+        """ The node where the merged time coverage of each channel is stored. """
+        return "/".join([self.namespace, "coverage"])
+
+    @property
+    def _partition_node(self):
+        """ The node where the partition unit of the index is stored. """
+        return "/".join([self.namespace, "partition"])
+
+    @property
+    def _shard_manifest_node(self):
+        """ The node where the time span of each partition table is stored. """
+        return "/".join([self.namespace, "shard_manifest"])
+
+    def _shard_node(self, partition: str, key: int) -> str:
+        """ Return the node of the partition table with the given key. """
+        unit = self._partition_units[partition]
+        name = np.datetime_as_string(np.datetime64(int(key), unit)).replace("-", "_")
+        return "/".join([self.namespace, "shards", partition[0] + name])
+
     @property
     def last_updated_timestamp(self) -> Optional[float]:
         """
@@ -201,7 +383,8 @@ class WaveBank(_Bank):
         self.ensure_bank_path_exists()
         node = self._time_node
         try:
-            out = pd.read_hdf(self.index_path, node)[0]
+            with self._open_index() as store:
+                out = store.get(node)[0]
         except (IOError, IndexError, ValueError, KeyError, AttributeError):
             out = None
         return out
@@ -213,7 +396,8 @@ class WaveBank(_Bank):
             complib=self._complib,
             complevel=self._complevel,
             format="table",
-            data_columns=list(self.index_ints),
+            data_columns=list(self.index_str) + list(self.index_ints),
+            index=False,  # see _create_csi_indexes
         )
 
     @compose_docstring(
@@ -230,50 +414,923 @@ class WaveBank(_Bank):
         {bar_description}
         {paths_description}
         """
+        with self._write_lock(exclusive=True):  # one writer at a time
+            self._update_index(bar, paths)
+        return self
+
+    def _update_index(self, bar, paths):
+        """ Update the index, the write lock must be held. """
         self._enforce_min_version()  # delete index if schema has changed
+        self._enforce_partition()  # or if it is partitioned differently
         update_time = time.time()
+        with self._staged_index():
+            updated, known = self._index_bank_files(bar, paths, update_time)
+        if updated:
+            self._finish_update(known)
+        else:  # publish a shared index which is new or out of date
+            self._publish_shared_index()
+
+    def _index_bank_files(self, bar, paths, update_time) -> tuple:
+        """
+        Index the files of the bank which are new or changed and drop the
+        rows of removed files, return True if the index was updated and the
+        lookup tables used (see _encode_categories).
+        """
         # create a function for the mapping and apply
         func = partial(
             _summarize_wave_file,
             format=self.format,
             summarizer=summarizing_functions.get(self.format, None),
         )
-        file_yielder = self._unindexed_iterator(paths=paths)
+        # files already in the index, including those written by an update
+        # which was interrupted before it finished.
+        indexed, known = self._read_indexed_files()
+        track_files = not indexed.empty  # needed only to find removed files
+        file_yielder = self._unindexed_iterator(paths=paths, track_files=track_files)
         iterable = self._measure_iterator(file_yielder, bar)
-        updates = list(self._map(func, iterable))
-        update_list = list(chain.from_iterable(updates))
-        df = pd.DataFrame.from_dict(update_list)
-        # push updates to index if any were found
-        if not df.empty:
-            self._write_update(df, update_time)
-            # clear cache out when new traces are added
-            self.clear_cache()
-        return self
+        # index files in chunks to limit memory usage; each is flushed to disk
+        updated, chunk_size = False, self._max_files_in_memory
+        for files in iter(lambda: list(islice(iterable, chunk_size)), []):
+            updated |= self._index_files(files, func, indexed, known)
+        # drop rows of indexed files which no longer exist
+        if track_files and hasattr(file_yielder, "missing"):
+            missing = indexed["path"][file_yielder.missing(indexed.index)]
+            if len(missing):
+                self._trace_cache.invalidate(missing.index)
+                self._write_update(pd.DataFrame(), stale=missing.values, known=known)
+                updated = True
+        # only now update the timestamp so an interrupted update can resume
+        if updated:
+            self._write_update_time(update_time)
+        self._update_directory_manifest(file_yielder)
+        return updated, known
+
+    def _finish_update(self, known=None):
+        """
+        Drop what was cached of the old index and publish the changes of
+        the update to the shared index, once the index has been replaced.
+        """
+        self.clear_cache()
+        self._publish_shared_index((known or {}).get("changes"))
 
-    def _write_update(self, update_df, update_time):
-        """ convert updates to dataframe, then append to index table """
-        # read in dataframe and prepare for input into hdf5 index
-        df = self._prep_write_df(update_df)
-        with pd.HDFStore(self.index_path) as store:
-            node = self._index_node
-            try:
-                nrows = store.get_storer(node).nrows
-            except (AttributeError, KeyError):
-                store.append(
-                    node, df, min_itemsize=self.min_itemsize, **self.hdf_kwargs
-                )
-            else:
-                df.index += nrows
-                store.append(node, df, append=True, **self.hdf_kwargs)
-            # update timestamp
+    @contextmanager
+    def _open_index(self, mode: str = "r", snapshot: bool = True):
+        """
+        Open the index holding the index lock, shared for reading and
+        exclusive for writing. Reads use the snapshot if the bank has one,
+        unless snapshot is False. A thread staging an update opens its copy
+        of the index instead, see _staged_index.
+        """
+        staged = self._staged_file()
+        if staged is not None:  # the calling thread is updating the index
+            if mode != "r" and not staged.exists() and self.index_path.exists():
+                with self._index_lock():
+                    shutil.copyfile(self.index_path, staged)
+            if mode != "r" or staged.exists():
+                with pd.HDFStore(staged, mode) as store:
+                    yield store
+                return
+        if mode == "r" and snapshot and self._snapshot is not None:
+            with self._snapshot.open() as store:
+                yield store
+            return
+        with self._index_lock(exclusive=mode != "r"):
+            with pd.HDFStore(self.index_path, mode) as store:
+                yield store
+
+    @contextmanager
+    def _staged_index(self):
+        """
+        Stage the writes of an update in a copy of the index which then
+        replaces the index in one step, so readers see all of an update or
+        none of it and only wait while the copy is moved. The write lock must
+        be held.
+
+        The calling thread reads and writes the copy (see _open_index), which
+        is made on its first write. The copy is named after the index it was
+        made from, so one left by an interrupted update is continued by the
+        next, unless the index has been replaced or removed since.
+        """
+        staged = self._staged_path()
+        for path in glob.glob(f"{glob.escape(str(self.index_path))}.*.update"):
+            if path != str(staged):  # made from an index which was replaced
+                os.remove(path)
+        self._staged = (threading.get_ident(), staged)
+        try:
+            yield
+        finally:
+            self._staged = None
+        if staged.exists():
+            with self._index_lock(exclusive=True):
+                os.replace(staged, self.index_path)
+
+    def _staged_path(self) -> Path:
+        """ Return the path of a staged copy of the index as it is now. """
+        try:
+            key = "_".join(str(x) for x in _stat_key(self.index_path))
+        except FileNotFoundError:
+            key = "new"
+        return self.index_path.with_name(f"{self.index_path.name}.{key}.update")
+
+    def _staged_file(self) -> Optional[Path]:
+        """ Return the staged copy of the index if the calling thread stages one. """
+        if self._staged is not None and self._staged[0] == threading.get_ident():
+            return self._staged[1]
+        return None
+
+    def _index_exists(self) -> bool:
+        """ Return True if the index, or the staged copy being written, exists. """
+        staged = self._staged_file()
+        return self.index_path.exists() or (staged is not None and staged.exists())
+
+    def _get_shared_index(self) -> Optional[_SharedIndex]:
+        """ Return the shared index if this bank, or another, uses it. """
+        shared = self._shared_index or _SharedIndex(self)
+        if self._shared_index is not None or shared.path.exists():
+            return shared
+        return None
+
+    def _publish_shared_index(self, changes=None, full=False):
+        """
+        Publish the changes of an update (see _write_update) to the shared
+        index if it is used, see _SharedIndex.publish.
+        """
+        shared = self._get_shared_index()
+        if shared is not None:
+            shared.publish(changes, full=full)
+
+    def _enforce_partition(self):
+        """ Delete the index if it is not partitioned by index_partition. """
+        if self.index_partition is None or not self.index_path.exists():
+            return
+        with self._open_index(snapshot=False) as store:
+            if self._file_node not in store:
+                return
+            partition = self._read_partition(store)
+        if partition != self.index_partition:
+            msg = (
+                f"the index is not partitioned by {self.index_partition}, "
+                f"the index will be recreated"
+            )
+            warnings.warn(msg)
+            with self._index_lock(exclusive=True):
+                os.remove(self.index_path)
+
+    def _read_partition(self, store: pd.HDFStore) -> Optional[str]:
+        """ Return the partition of the index in store, None if it has one table. """
+        if self._partition_node not in store:
+            return None
+        return store.get(self._partition_node).iloc[0]
+
+    def _read_shard_manifest(self, store: pd.HDFStore) -> pd.DataFrame:
+        """ Read the shard manifest, empty if the index is not partitioned. """
+        if self._shard_manifest_node not in store:
+            df = pd.DataFrame(columns=list(self._shard_columns))
+            return df.astype(dict(self._shard_columns))
+        return store.select(self._shard_manifest_node)
+
+    def _index_nodes(self, store: pd.HDFStore, starttime=None, endtime=None):
+        """
+        Return the index tables in store which may have rows between
+        starttime and endtime (int64 ns); all tables if they are None.
+        """
+        partition = self._read_partition(store)
+        if partition is None:
+            return [self._index_node] if self._index_node in store else []
+        shards = self._read_shard_manifest(store)
+        if starttime is not None:
+            shards = shards[shards["endtime"] >= starttime]
+        if endtime is not None:
+            shards = shards[shards["starttime"] <= endtime]
+        return [self._shard_node(partition, x) for x in shards["key"]]
+
+    def _select_index(
+        self, store: pd.HDFStore, where=None, starttime=None, endtime=None, **kwargs
+    ) -> pd.DataFrame:
+        """
+        Select (encoded) rows from the index tables which may have rows
+        between starttime and endtime (int64 ns), see _index_nodes.
+
+        Rows are returned in the order they were added to the index.
+        """
+        nodes = self._index_nodes(store, starttime, endtime)
+        if not nodes:  # an empty selection still has the columns and dtypes
+            nodes = self._index_nodes(store)[:1] or [self._index_node]
+            kwargs["stop"] = 0
+        dfs = [store.select(x, where=where, **kwargs) for x in nodes]
+        if len(dfs) == 1:
+            return dfs[0]
+        return pd.concat(dfs).sort_index()
+
+    def _read_indexed_files(self):
+        """
+        Read the file manifest indexed by path, and the path lookup table.
+
+        The lookup table is returned in a dict used by _encode_categories so
+        it need not be read again for each chunk of updates.
+        """
+        if not self._index_exists():
+            return self._empty_file_manifest(), {}
+        with self._open_index(snapshot=False) as store:
+            manifest = self._read_file_manifest(store)
+            categories = self._read_categories(store, "path")
+        manifest.index = categories[manifest["path"].values]
+        # files appended to have an entry for each append, the last is current
+        manifest = manifest[~manifest.index.duplicated(keep="last")]
+        return manifest, {"path": categories}
+
+    def _index_files(self, files, func, indexed, known, summaries=None) -> bool:
+        """
+        Summarize files and write them to the index, return True if updated.
+
+        Files with the same size and mtime as when they were indexed are
+        skipped; the old rows of other previously indexed files are removed.
+        If summaries (a dict of the rows of each file) is given the files
+        are not read.
+        """
+        stats = pd.DataFrame(
+            [_stat_file(x) for x in files],
+            columns=["size", "mtime"],
+            index=_remove_base_path(pd.Series(files, dtype=object), self.bank_path),
+        )
+        old = indexed.reindex(stats.index)
+        unchanged = (old["size"] == stats["size"]) & (old["mtime"] == stats["mtime"])
+        stale = old.loc[~unchanged & old["path"].notnull(), "path"]
+        self._trace_cache.invalidate(stale.index)
+        to_index = np.array(files, dtype=object)[~unchanged.values]
+        if summaries is None:
+            rows = self._map(func, to_index)
+        else:
+            rows = [summaries[x] for x in to_index]
+        df = pd.DataFrame.from_dict(list(chain.from_iterable(rows)))
+        if df.empty and stale.empty:
+            return False
+        blocks = None
+        if self.records_per_block and self.format == "mseed" and len(to_index):
+            func = partial(
+                _summarize_record_blocks, records_per_block=self.records_per_block
+            )
+            block_dfs = [x for x in self._map(func, to_index) if x is not None]
+            blocks = pd.concat(block_dfs, ignore_index=True) if block_dfs else None
+        self._write_update(
+            df, stale=stale.values, stats=stats, known=known, blocks=blocks
+        )
+        return True
+
+    def _write_update(self, update_df, stale=(), stats=None, known=None, blocks=None):
+        """
+        Remove rows of stale files (by path code), then append updates.
+
+        Parameters
+        ----------
+        update_df
+            The summaries of the traces to add to the index.
+        stale
+            The path codes of files whose rows should be removed.
+        stats
+            A dataframe of size and mtime indexed by (relative) file path.
+        known
+            A dict of lookup tables passed to _encode_categories.
+        blocks
+            A dataframe of record blocks of the updated files, see
+            obsplus.utils.mseed.summarize_mseed_blocks.
+        """
+        known = {} if known is None else known
+        with self._open_index("a") as store:
+            if self.index_partition and self._file_node not in store:
+                store.put(self._partition_node, pd.Series([self.index_partition]))
+            if "changes" not in known:  # kept to publish to the shared index
+                shared = self._get_shared_index()
+                base = None if shared is None else shared._read_update_time(store)
+                known["changes"] = None if shared is None else shared.track(base)
+            changes = known["changes"]
+            added = removed = None
+            if len(stale):
+                removed = self._remove_files(store, np.asarray(stale), known)
+                if changes is not None:
+                    changes.remove(stale, len(removed))
+            if not update_df.empty:
+                # prepare dataframe for input into hdf5 index and append it
+                df = self._prep_write_df(update_df)
+                # group the rows of each file together
+                df = df.iloc[np.argsort(df["path"].values, kind="mergesort")]
+                paths = df["path"].values
+                added = self._encode_categories(store, df, known=known)
+                self._append_files(store, added, paths, stats, known)
+                if changes is not None:
+                    columns = self._categorical_columns
+                    categories = {x: known[x] for x in columns}
+                    changes.add(added[list(self.index_columns)], categories)
+            if blocks is not None and not update_df.empty:
+                self._append_record_blocks(store, blocks, known["path"])
+            self._update_coverage(store, added, removed)
+
+    def _write_update_time(self, update_time=None):
+        """ Write the update timestamp and make sure the meta table exists. """
+        with self._open_index("a") as store:
             update_time = time.time() if update_time is None else update_time
             store.put(self._time_node, pd.Series(update_time))
-            # make sure meta table also exists.
-            # Note this is hear to avoid opening the store again.
             if self._meta_node not in store:
                 meta = self._make_meta_table()
                 store.put(self._meta_node, meta, format="table")
 
+    def compact_index(self) -> dict:
+        """
+        Rewrite the index to remove fragmentation from many small updates.
+
+        The rows of each index table are sorted by (network, station,
+        location, channel, starttime), keeping the rows of each file
+        together, and written in one append sized to the number of rows.
+        Indexes of the columns are rebuilt and the other tables are copied.
+        The index is written to a new file which then replaces the old one,
+        so readers never see a partial index. It should not be run while the
+        index is being updated.
+
+        Returns a dict of the size of the index file (bytes) and the mean
+        time of a few queries of the index (seconds), before and after.
+        """
+        self.ensure_bank_path_exists()
+        if not self.index_path.exists():
+            return {}
+        out = dict(size_before=self.index_path.stat().st_size)
+        out["latency_before"] = self._time_index_queries()
+        temp_path = self.index_path.with_name(self.index_path.name + ".compact")
+        try:
+            with self._write_lock(exclusive=True):
+                with self._open_index(snapshot=False) as old:
+                    with pd.HDFStore(temp_path, "w") as new:
+                        self._write_compact_index(old, new)
+                with self._index_lock(exclusive=True):
+                    os.replace(temp_path, self.index_path)
+                # the rows were relabeled
+                self._publish_shared_index(full=True)
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(temp_path)
+        self.clear_cache()
+        out["size_after"] = self.index_path.stat().st_size
+        out["latency_after"] = self._time_index_queries()
+        return out
+
+    def _write_compact_index(self, old: pd.HDFStore, new: pd.HDFStore):
+        """
+        Write the sorted index tables and a relabeled file manifest of old
+        to new, then copy the other nodes.
+        """
+        partition = self._read_partition(old)
+        files = self._read_file_manifest(old)
+        shards = self._read_shard_manifest(old)
+        written = {self._file_node, self._shard_manifest_node}
+        file_parts, label = [], 0
+        nodes = self._index_nodes(old)
+        keys = [0] * len(nodes) if partition is None else list(shards["key"])
+        for key, node in zip(keys, nodes):
+            df = old.select(node)
+            sub = files[files["shard"] == key]
+            df, sub = self._sort_index_table(df, sub, label)
+            if len(df):
+                kwargs = dict(self.hdf_kwargs, expectedrows=len(df))
+                new.append(node, df, **kwargs)
+                self._create_csi_indexes(new, node)
+            label += len(df)
+            shards.loc[shards["key"] == key, "stop"] = label
+            file_parts.append(sub)
+            written.add(node)
+        files = pd.concat(file_parts, ignore_index=True) if file_parts else files
+        if len(files):
+            new.append(
+                self._file_node,
+                files.astype(dict(self._file_columns)),
+                complib=self._complib,
+                complevel=self._complevel,
+                format="table",
+                data_columns=["path"],
+                expectedrows=len(files),
+                index=False,  # it is read whole or by coordinates
+            )
+        if partition is not None:
+            new.append(
+                self._shard_manifest_node,
+                shards.astype(dict(self._shard_columns)),
+                complib=self._complib,
+                complevel=self._complevel,
+                format="table",
+            )
+        for node in set(old.keys()) - written:
+            self._copy_node(old, new, node)
+
+    def _sort_index_table(self, df: pd.DataFrame, files: pd.DataFrame, label: int):
+        """
+        Sort the (encoded) rows of an index table and relabel them from label.
+
+        Rows are sorted by NSLC codes and starttime, except that the rows of
+        each file stay adjacent, and files are ordered by their first row.
+        Returns the rows and the files with their new label ranges.
+        """
+        order = np.argsort(files["start"].values, kind="mergesort")
+        files = files.iloc[order].reset_index(drop=True)
+        labels = df.index.values
+        # find the file of each row from the label ranges of the files
+        pos = np.searchsorted(files["start"].values, labels, side="right") - 1
+        valid = pos >= 0
+        valid[valid] = labels[valid] < files["stop"].values[pos[valid]]
+        # rows without a file are kept, each as if it were its own file
+        groups = np.where(valid, pos, len(files) + np.arange(len(df)))
+        keys = [df[x].values for x in ["starttime"] + list(NSLC)[::-1]]
+        ranks = np.empty(len(df), dtype=np.int64)
+        ranks[np.lexsort(keys)] = np.arange(len(df))
+        first_ranks = pd.Series(ranks).groupby(groups).transform("min").values
+        order = np.lexsort((ranks, first_ranks))
+        df = df.iloc[order]
+        df.index = pd.RangeIndex(label, label + len(df))
+        # the new label range of each file
+        new_groups = groups[order]
+        firsts = np.flatnonzero(np.r_[True, new_groups[1:] != new_groups[:-1]])
+        stops = np.r_[firsts[1:], len(df)] + label
+        file_groups = new_groups[firsts]
+        has_file = file_groups < len(files)
+        files = files.iloc[file_groups[has_file]].reset_index(drop=True)
+        files["start"] = firsts[has_file] + label
+        files["stop"] = stops[has_file]
+        return df, files
+
+    def _copy_node(self, old: pd.HDFStore, new: pd.HDFStore, node: str):
+        """ Copy a node of the index, keeping the format and string sizes. """
+        storer = old.get_storer(node)
+        if not storer.is_table:
+            new.put(node, old.get(node))
+            return
+        df = old.select(node)
+        sizes = [
+            x.itemsize for x in storer.table.coldescrs.values() if x.kind == "string"
+        ]
+        new.append(
+            node,
+            df,
+            complib=self._complib,
+            complevel=self._complevel,
+            format="table",
+            data_columns=storer.data_columns or None,
+            min_itemsize={"values": max(sizes)} if sizes else None,
+            expectedrows=max(len(df), 1),
+            index=False,
+        )
+
+    def _time_index_queries(self, repeat: int = 3) -> float:
+        """
+        Return the mean time to read the whole index and the rows of a short
+        time window in the middle of the index.
+        """
+        with self._open_index(snapshot=False) as store:
+            if not self._index_nodes(store):
+                return np.nan
+            coverage = self._read_coverage_table(store)
+            start = (coverage["starttime"].min() + coverage["endtime"].max()) // 2
+            start = int(start) if len(coverage) else 0
+            end = start + 60 * 1_000_000_000
+            where = _plan_index_query(start, end)
+            t1 = time.perf_counter()
+            for _ in range(repeat):
+                self._select_index(store)
+                self._select_index(store, where, start, end)
+            return (time.perf_counter() - t1) / (2 * repeat)
+
+    def _read_file_manifest(self, store: pd.HDFStore) -> pd.DataFrame:
+        """
+        Read the file manifest, the index is the row number of each file.
+        """
+        if self._file_node not in store:
+            return self._empty_file_manifest()
+        return store.select(self._file_node).reset_index(drop=True)
+
+    def _empty_file_manifest(self) -> pd.DataFrame:
+        """ Return an empty file manifest with the expected dtypes. """
+        df = pd.DataFrame(columns=list(self._file_columns))
+        return df.astype(dict(self._file_columns))
+
+    def _append_files(
+        self, store: pd.HDFStore, df: pd.DataFrame, paths, stats, known=None
+    ):
+        """
+        Append the (encoded) rows of new files to the index and file manifest.
+
+        The rows of each file must be adjacent; they are given consecutive
+        labels so they can be removed as a range later. Labels are not
+        re-numbered when rows are removed so the ranges stay valid. If the
+        index is partitioned, the rows of each file are appended to the
+        table of the partition of its earliest starttime. The labels of the
+        tables in known (see _read_labels) are extended.
+        """
+        labels = {} if known is None else known.get("labels", {})
+        partition = self._read_partition(store)
+        firsts = np.flatnonzero(np.r_[True, paths[1:] != paths[:-1]])
+        start, file_keys = self._next_label(store, partition), np.zeros(len(firsts))
+        df.index = pd.RangeIndex(start, start + len(df))
+        if partition is None:
+            store.append(self._index_node, df, **self.hdf_kwargs)
+            self._create_csi_indexes(store, self._index_node)
+            if self._index_node in labels:
+                labels[self._index_node] = np.r_[labels[self._index_node], df.index]
+        else:
+            file_starts = np.minimum.reduceat(df["starttime"].values, firsts)
+            unit = self._partition_units[partition]
+            file_keys = file_starts.astype("datetime64[ns]")
+            file_keys = file_keys.astype(f"datetime64[{unit}]").astype(np.int64)
+            row_keys = np.repeat(file_keys, np.diff(np.r_[firsts, len(df)]))
+            for key in np.unique(row_keys):
+                node = self._shard_node(partition, key)
+                store.append(node, df[row_keys == key], **self.hdf_kwargs)
+                self._create_csi_indexes(store, node)
+                if node in labels:
+                    labels[node] = np.r_[labels[node], df.index[row_keys == key]]
+            self._update_shard_manifest(store, df, row_keys)
+        # create the file manifest rows with the label range of each file
+        if stats is None or not set(paths[firsts]).issubset(stats.index):
+            new_paths = paths[firsts]
+            new_stats = [_stat_file(str(self.bank_path) + x) for x in new_paths]
+            stats = pd.DataFrame(new_stats, columns=["size", "mtime"], index=new_paths)
+        files = stats.loc[paths[firsts]].reset_index(drop=True)
+        files.insert(0, "path", df["path"].values[firsts])
+        files["start"] = df.index.values[firsts]
+        files["stop"] = np.r_[df.index.values[firsts[1:]], df.index[-1] + 1]
+        files["shard"] = file_keys
+        store.append(
+            self._file_node,
+            files.astype(dict(self._file_columns)),
+            complib=self._complib,
+            complevel=self._complevel,
+            format="table",
+            data_columns=["path"],
+            index=False,  # it is read whole or by coordinates
+        )
+
+    def _create_csi_indexes(self, store: pd.HDFStore, node: str):
+        """
+        Create completely sorted indexes on the time and NSLC columns of an
+        index table if it doesn't have them.
+
+        PyTables keeps the indexes sorted as rows are appended or removed, so
+        they are only created once for each table.
+        """
+        table = store.get_storer(node).table
+        columns = [x for x in self._csi_columns if x in table.colinstances]
+        cols = [table.colinstances[x] for x in columns]
+        if all(x.is_indexed and x.index.is_csi for x in cols):
+            return
+        store.create_table_index(node, columns=columns, optlevel=9, kind="full")
+
+    def _next_label(self, store: pd.HDFStore, partition: Optional[str]) -> int:
+        """ Return the label of the next row appended to the index. """
+        if partition is not None:
+            stops = self._read_shard_manifest(store)["stop"]
+            return int(stops.max()) if len(stops) else 0
+        try:
+            nrows = store.get_storer(self._index_node).nrows
+        except (AttributeError, KeyError):
+            nrows = 0
+        if not nrows:
+            return 0
+        last = store.select_column(self._index_node, "index", start=nrows - 1)
+        return int(last.iloc[0]) + 1
+
+    def _update_shard_manifest(self, store: pd.HDFStore, df: pd.DataFrame, keys):
+        """ Extend the time spans and stops of shards with appended rows. """
+        new = pd.DataFrame(
+            dict(
+                key=keys,
+                starttime=df["starttime"].values,
+                endtime=df["endtime"].values,
+                stop=df.index.values + 1,
+            )
+        )
+        shards = pd.concat([self._read_shard_manifest(store), new])
+        agg = dict(starttime="min", endtime="max", stop="max")
+        shards = shards.groupby("key", sort=True).agg(agg).reset_index()
+        store.put(
+            self._shard_manifest_node,
+            shards.astype(dict(self._shard_columns)),
+            complib=self._complib,
+            complevel=self._complevel,
+            format="table",
+        )
+
+    def _read_labels(self, store: pd.HDFStore, node: str, known=None) -> np.ndarray:
+        """
+        Return the (sorted) row labels of an index table.
+
+        The labels are kept in known, if given, so an update reads those of
+        each table once rather than for each chunk of files it removes.
+        """
+        labels = {} if known is None else known.setdefault("labels", {})
+        if node not in labels:
+            labels[node] = store.select_column(node, "index").values
+        return labels[node]
+
+    def _remove_files(self, store: pd.HDFStore, codes: np.ndarray, known=None):
+        """
+        Remove the index rows and manifest entries of files by path code.
+
+        Returns the coverage columns of the removed (encoded) index rows.
+        known is an optional dict used to keep the labels of the tables.
+        """
+        removed = pd.DataFrame(columns=list(self._coverage_columns))
+        if self._file_node not in store:
+            return removed
+        file_codes = store.select_column(self._file_node, "path").values
+        file_coords = np.flatnonzero(np.isin(file_codes, codes))
+        if not len(file_coords):
+            return removed
+        stale = store.select(self._file_node, where=file_coords)
+        partition = self._read_partition(store)
+        parts = []
+        for key, files in stale.groupby("shard"):
+            node = self._index_node
+            if partition is not None:
+                node = self._shard_node(partition, key)
+            labels = self._read_labels(store, node, known)
+            starts = np.searchsorted(labels, files["start"].values.astype(np.int64))
+            stops = np.searchsorted(labels, files["stop"].values.astype(np.int64))
+            ranges = [np.arange(x1, x2) for x1, x2 in zip(starts, stops)]
+            coords = np.concatenate(ranges)
+            if len(coords):
+                columns = list(self._coverage_columns)
+                parts.append(store.select(node, where=coords, columns=columns))
+                store.remove(node, where=coords)
+                if known is not None:
+                    known["labels"][node] = np.delete(labels, coords)
+        if parts:
+            removed = pd.concat(parts, ignore_index=True)
+        store.remove(self._file_node, where=file_coords)
+        self._remove_record_blocks(store, codes)
+        return removed
+
+    def _remove_record_blocks(self, store: pd.HDFStore, codes: np.ndarray):
+        """ Remove the record blocks of files by path code. """
+        if self._record_node in store:
+            block_codes = store.select_column(self._record_node, "path").values
+            block_coords = np.flatnonzero(np.isin(block_codes, codes))
+            if len(block_coords):
+                store.remove(self._record_node, where=block_coords)
+
+    def _read_coverage_table(self, store: pd.HDFStore) -> pd.DataFrame:
+        """
+        Read the (encoded) coverage table sorted by channel and starttime,
+        empty if it doesn't exist. Updates append rows, so it isn't stored
+        sorted.
+        """
+        if self._coverage_node not in store:
+            df = pd.DataFrame(columns=list(self._coverage_columns))
+            return df.astype(dict(self._coverage_columns))
+        df = store.select(self._coverage_node)
+        order = list(self._coverage_key) + ["starttime"]
+        return df.sort_values(order, kind="mergesort").reset_index(drop=True)
+
+    def _update_coverage(self, store: pd.HDFStore, added=None, removed=None):
+        """
+        Update the coverage table with added and removed (encoded) index rows.
+
+        Only the coverage rows of the changed channels which are within the
+        merge tolerance of the changed times are read (see _select_coverage);
+        they are merged with the added rows and replaced. Coverage can't be
+        subtracted from, so the intervals which contained removed rows are
+        rebuilt from the remaining index rows of their channels.
+        """
+        key, columns = list(self._coverage_key), list(self._coverage_columns)
+        dtypes = dict(self._coverage_columns)
+        changed = [x[columns] for x in [added, removed] if x is not None]
+        changed = [x for x in changed if not x.empty]
+        if not changed:
+            return
+        changed = pd.concat(changed, ignore_index=True).astype(dtypes)
+        coords, coverage = self._select_coverage(store, changed)
+        parts = [coverage]
+        if removed is not None and not removed.empty:
+            removed = removed.astype(dtypes)
+            cov_intervals, removed_intervals = self._coverage_intervals(
+                coverage, removed
+            )
+            _, dirty = _interval_join(*removed_intervals, *cov_intervals)
+            is_dirty = np.isin(np.arange(len(coverage)), dirty)
+            parts[0], dirty_df = coverage[~is_dirty], coverage[is_dirty]
+            if not dirty_df.empty and self._index_nodes(store):
+                t1, t2 = dirty_df["starttime"].min(), dirty_df["endtime"].max()
+                codes = {x: np.unique(dirty_df[x]) for x in NSLC}
+                max_codes = self._index_cache._max_query_codes
+                codes = {i: v for i, v in codes.items() if len(v) <= max_codes}
+                where = _plan_index_query(t1, t2, codes)
+                rows = self._select_index(store, where, t1, t2, columns=columns)
+                rows = rows.astype(dtypes)
+                rows = rows[self._same_channels(rows, dirty_df)]
+                # keep the remaining rows of the rebuilt intervals
+                intervals = self._coverage_intervals(dirty_df, rows)
+                keep, _ = _interval_join(*intervals[1], *intervals[0])
+                parts.append(rows.iloc[np.unique(keep)])
+        if added is not None:
+            parts.append(added[columns])
+        df = pd.concat(parts, ignore_index=True).astype(dtypes)
+        tolerance = df["sampling_period"].values * self._coverage_periods
+        df = _merge_coverage(df, key, tolerance.astype(np.int64))
+        if len(coords):
+            store.remove(self._coverage_node, where=coords)
+        if len(df):
+            store.append(
+                self._coverage_node,
+                df.astype(dtypes),
+                complib=self._complib,
+                complevel=self._complevel,
+                format="table",
+                data_columns=True,
+                index=False,  # it is small, indexes only slow removing rows
+            )
+
+    def _select_coverage(self, store: pd.HDFStore, changed: pd.DataFrame):
+        """
+        Return the coordinates and rows of the coverage table of the channels
+        of changed (coverage rows) which overlap, or are within the merge
+        tolerance of, its times.
+        """
+        columns = list(self._coverage_columns)
+        node, dtypes = self._coverage_node, dict(self._coverage_columns)
+        empty = pd.DataFrame(columns=columns).astype(dtypes)
+        if node not in store:
+            return np.array([], dtype=np.int64), empty
+        if not store.get_storer(node).data_columns:
+            # tables written before coverage was queried can't be selected from
+            coverage = store.select(node)
+            store.remove(node)
+            return np.array([], dtype=np.int64), coverage
+        tolerance = int((changed["sampling_period"] * self._coverage_periods).max())
+        t1 = int(changed["starttime"].min()) - tolerance
+        t2 = int(changed["endtime"].max()) + tolerance
+        codes = {x: np.unique(changed[x]) for x in NSLC}
+        max_codes = self._index_cache._max_query_codes
+        codes = {i: v for i, v in codes.items() if len(v) <= max_codes}
+        coords = store.select_as_coordinates(node, _plan_index_query(t1, t2, codes))
+        coords = np.asarray(coords, dtype=np.int64)
+        if not len(coords):
+            return coords, empty
+        coverage = store.select(node, where=coords).astype(dtypes)
+        is_changed = self._same_channels(coverage, changed)
+        return coords[is_changed], coverage[is_changed].reset_index(drop=True)
+
+    def _same_channels(self, df: pd.DataFrame, other: pd.DataFrame) -> np.ndarray:
+        """ Return True for rows of df with the coverage key of a row of other. """
+        key = list(self._coverage_key)
+        keys = pd.MultiIndex.from_frame(other[key])
+        return pd.MultiIndex.from_frame(df[key]).isin(keys)
+
+    def _coverage_intervals(self, *dfs):
+        """
+        Return (codes, starttime, endtime) for each dataframe of coverage
+        columns, the same codes are given to rows with the same channel.
+        """
+        key = list(self._coverage_key)
+        df = pd.concat([x[key] for x in dfs], ignore_index=True)
+        splits = np.cumsum([len(x) for x in dfs])[:-1]
+        codes = np.split(df.groupby(key).ngroup().values, splits)
+        return [(x, y["starttime"], y["endtime"]) for x, y in zip(codes, dfs)]
+
+    def _read_coverage(
+        self,
+        network: Optional[str] = None,
+        station: Optional[str] = None,
+        location: Optional[str] = None,
+        channel: Optional[str] = None,
+        starttime: Optional[utc_time_type] = None,
+        endtime: Optional[utc_time_type] = None,
+        min_gap: Optional[np.timedelta64] = None,
+    ) -> pd.DataFrame:
+        """
+        Read the coverage of the selected channels, clipped to the given times.
+
+        Coverage intervals closer than min_gap are merged, min_gap must not
+        be less than the tolerance of the coverage table. The output has the
+        columns and dtypes of the index, without path, sorted by NSLC and
+        starttime.
+        """
+        self.ensure_bank_path_exists()
+        if not self.index_path.exists():
+            self.update_index()
+        if not self.index_path.exists():
+            df = pd.DataFrame(columns=list(self.columns_no_path))
+            return df.astype(dict(self._dtypes_output))
+        with self._open_index() as store:
+            df = self._read_coverage_table(store)
+            if min_gap is not None:
+                tolerance = int(to_timedelta64(min_gap).astype("timedelta64[ns]"))
+                df = _merge_coverage(df, self._coverage_key, tolerance)
+            df = self._index_cache._decode_categories(store, df)
+        # sort by the sorted categories, not codes which follow indexing order
+        df = df.sort_values(list(NSLC) + ["starttime"], kind="mergesort")
+        filt = filter_index(
+            df, network=network, station=station, location=location, channel=channel
+        )
+        df = df[filt]
+        if starttime is not None:
+            t1 = to_datetime64(starttime).astype(np.int64)
+            df = df[df["endtime"] >= t1].assign(starttime=df["starttime"].clip(t1))
+        if endtime is not None:
+            t2 = to_datetime64(endtime).astype(np.int64)
+            df = df[df["starttime"] <= t2].assign(endtime=df["endtime"].clip(None, t2))
+        columns = list(self.columns_no_path)
+        return df[columns].astype(dict(self._dtypes_output)).reset_index(drop=True)
+
+    def _append_record_blocks(self, store, blocks: pd.DataFrame, categories):
+        """ Append record blocks to the store, encoding paths with categories. """
+        paths = _remove_base_path(blocks["path"], self.bank_path)
+        blocks = blocks.assign(path=categories.get_indexer(paths.values))
+        blocks = blocks[blocks["path"] >= 0]  # files without indexed traces
+        store.append(
+            self._record_node,
+            blocks[list(self._record_columns)].astype(dict(self._record_columns)),
+            complib=self._complib,
+            complevel=self._complevel,
+            format="table",
+            data_columns=["path", "starttime", "endtime"],
+            index=False,  # the table is always scanned, indexing only slows reads
+        )
+
+    def _read_record_blocks(self, paths, starttime, endtime) -> dict:
+        """
+        Return the byte ranges to read from paths for the given times.
+
+        A dict of {path: array of (offset, nbytes) rows} is returned, adjacent
+        blocks are merged. Paths which have no record blocks are not included.
+        The blocks of each path are cached with the index, so the index is
+        only read for paths which are not cached.
+        """
+        t1, t2 = to_datetime64([starttime, endtime]).astype(np.int64)
+        cache, cached = self._index_cache, {}
+        for path in np.asarray(paths, dtype=object):
+            with suppress(KeyError):
+                cached[path] = cache.get_record_blocks(path)
+        missing = [x for x in np.asarray(paths, dtype=object) if x not in cached]
+        if missing:
+            for path, blocks in self._select_record_blocks(missing).items():
+                cache.set_record_blocks(path, blocks)
+                cached[path] = blocks
+        out = {}
+        for path, blocks in cached.items():
+            if blocks is None:
+                continue
+            blocks = blocks[(blocks[:, 2] <= t2) & (blocks[:, 3] >= t1)]
+            offset, nbytes = blocks[:, 0], blocks[:, 1]
+            # merge blocks which are adjacent in the file into one read
+            firsts = np.r_[True, offset[1:] != offset[:-1] + nbytes[:-1]]
+            groups = np.cumsum(firsts) - 1
+            ranges = np.stack([offset[firsts], np.bincount(groups, nbytes)], axis=1)
+            out[path] = ranges.astype(np.int64).reshape(-1, 2)
+        return out
+
+    def _select_record_blocks(self, missing) -> dict:
+        """
+        Read the (offset, nbytes, starttime, endtime) rows of the record
+        blocks of the missing paths, sorted by offset, None for paths
+        without blocks.
+        """
+        out = dict.fromkeys(missing)
+        with self._open_index() as store:
+            if self._record_node not in store:
+                return out
+            # codes are positions in the lookup table, re-read it if paths
+            # were added since it was cached
+            categories = self._index_cache.lookup(store, "path")[0]
+            codes = categories.get_indexer(missing)
+            if (codes < 0).any():
+                size = len(categories) + 1
+                categories = self._index_cache.lookup(store, "path", size)[0]
+                codes = categories.get_indexer(missing)
+            codes = [int(x) for x in codes[codes >= 0]]
+            if not codes:
+                return out
+            blocks = store.select(self._record_node, where="path=codes")
+        columns = ["offset", "nbytes", "starttime", "endtime"]
+        blocks = blocks.sort_values(["path", "offset"], kind="mergesort")
+        for code, df in blocks.groupby("path", sort=False):
+            out[categories[code]] = df[columns].values.astype(np.int64)
+        return out
+
+    def _read_directory_manifest(self) -> Optional[pd.DataFrame]:
+        """ Return the directory manifest of the last update, else None. """
+        try:
+            with self._open_index(snapshot=False) as store:
+                return store.get(self._directory_node)
+        except (IOError, ValueError, KeyError, AttributeError):
+            return None
+
+    def _write_directory_manifest(self, manifest: pd.DataFrame):
+        """ Replace the directory manifest, only if the index exists. """
+        if not self._index_exists():
+            return
+        with self._open_index("a") as store:
+            store.put(
+                self._directory_node,
+                manifest,
+                complib=self._complib,
+                complevel=self._complevel,
+                format="table",
+            )
+
     def _prep_write_df(self, df):
         """ Prepare the dataframe to put it into the HDF5 store. """
         # ensure the bank path is not in the path column
@@ -289,13 +1346,63 @@ class WaveBank(_Bank):
         assert not df.isnull().any().any(), "null values found in index"
         return df
 
+    def _category_node(self, column):
+        """ Return the node where the lookup table of a column is stored. """
+        return "/".join([self.namespace, "categories", column])
+
+    def _read_categories(self, store: pd.HDFStore, column: str) -> pd.Index:
+        """ Read the lookup table of a categorical column, codes are positions. """
+        node = self._category_node(column)
+        if node not in store:
+            return pd.Index([], dtype=object)
+        return pd.Index(store.select(node).values, dtype=object)
+
+    def _encode_categories(
+        self, store: pd.HDFStore, df: pd.DataFrame, known: Optional[dict] = None
+    ):
+        """
+        Replace str columns with integer codes, extending lookup tables as needed.
+
+        Codes are never re-assigned so existing rows remain valid. Null values
+        (including "None" strings) are stored with a code of -1. known is an
+        optional dict of lookup tables which is used (and kept up to date)
+        instead of reading the tables from the store.
+        """
+        known = {} if known is None else known
+        for col in self._categorical_columns:
+            if col in known:
+                categories = known[col]
+            else:
+                categories = self._read_categories(store, col)
+            values = df[col]
+            is_null = values.isnull() | (values == "None")
+            new = pd.Index(values[~is_null].unique()).difference(categories)
+            if len(new):
+                start = len(categories)
+                ser = pd.Series(new.values, index=range(start, start + len(new)))
+                min_itemsize = {"values": self.min_itemsize[col]}
+                store.append(
+                    self._category_node(col),
+                    ser,
+                    min_itemsize=min_itemsize,
+                    complib=self._complib,
+                    complevel=self._complevel,
+                    format="table",
+                    index=False,  # it is only ever read whole
+                )
+                categories = categories.append(new)
+            known[col] = categories
+            codes = categories.get_indexer(values.where(~is_null))
+            df[col] = codes.astype(np.int32)
+        return df
+
     def _ensure_meta_table_exists(self):
         """
         If the bank path exists ensure it has a meta table, if not create it.
         """
         if not Path(self.index_path).exists():
             return
-        with pd.HDFStore(self.index_path) as store:
+        with self._open_index("a") as store:
             # add metadata if not in store
             if self._meta_node not in store:
                 meta = self._make_meta_table()
@@ -331,8 +1438,17 @@ class WaveBank(_Bank):
         # if no file was created (dealing with empty bank) return empty index
         if not self.index_path.exists():
             return pd.DataFrame(columns=self.index_columns)
-        # grab index from cache
-        index = self._index_cache(starttime, endtime, buffer=self.buffer, **kwargs)
+        if self._snapshot is not None:  # clears the cache if the index changed
+            self._snapshot.refresh()
+        if self._shared_index is not None:  # or if there is a new generation
+            self._shared_index.refresh()
+        # grab index from cache, str codes are also used to select rows
+        query = dict(network=network, station=station, location=location)
+        query["channel"] = channel
+        filters = {i: v for i, v in query.items() if isinstance(v, str)}
+        index = self._index_cache(
+            starttime, endtime, buffer=self.buffer, filters=filters, **kwargs
+        )
         # filter and return
         filt = filter_index(
             index, network=network, station=station, location=location, channel=channel
@@ -344,15 +1460,12 @@ class WaveBank(_Bank):
         Read the metadata table.
         """
         try:
-            with pd.HDFStore(self.index_path, "r") as store:
-                out = store.get(self._meta_node)
-            store.close()
-            return out
+            with self._open_index() as store:
+                return store.get(self._meta_node)
         except (FileNotFoundError, ValueError, KeyError, OSError):
-            with suppress(UnboundLocalError):
-                store.close()
             self._ensure_meta_table_exists()
-            return pd.read_hdf(self.index_path, self._meta_node)
+            with self._open_index(snapshot=False) as store:
+                return store.get(self._meta_node)
 
     # ------------------------ availability stuff
 
@@ -361,14 +1474,16 @@ class WaveBank(_Bank):
         """
         Return a dataframe specifying the availability of the archive.
 
+        Only the coverage table is read, if starttime or endtime are given
+        availability is clipped to them.
+
         Parameters
         ----------
         {get_waveform_params}
 
         """
-        # no need to read in path, just read needed columns
-        ind = self.read_index(*args, columns=self.columns_no_path, **kwargs)
-        gro = ind.groupby(list(NSLC))
+        coverage = self._read_coverage(*args, **kwargs)
+        gro = coverage.groupby(list(NSLC), observed=True)
         min_start = gro.starttime.min().reset_index()
         max_end = gro.endtime.max().reset_index()
         return pd.merge(min_start, max_end)
@@ -410,6 +1525,10 @@ class WaveBank(_Bank):
         """
         Return a dataframe containing an entry for every gap in the archive.
 
+        Gaps are found from the coverage table, which is merged across gaps of
+        up to 1.5 sampling periods. Smaller values of min_gap need the full
+        index.
+
         Parameters
         ----------
         {get_waveforms_params}
@@ -418,38 +1537,27 @@ class WaveBank(_Bank):
              If None, use 1.5 x sampling rate for
             each channel.
         """
-
-        def _get_gap_dfs(df, min_gap):
-            """ function to apply to each group of seed_id dataframes """
-            # get the min gap
-            if min_gap is None:
-                min_gap = 1.5 * df["sampling_period"].iloc[0]
-            else:
-                min_gap = to_timedelta64(min_gap)
-            # get df for determining gaps
-            dd = (
-                df.drop_duplicates()
-                .sort_values(["starttime", "endtime"])
-                .reset_index(drop=True)
-            )
-            shifted_starttimes = dd.starttime.shift(-1)
-            cum_max = np.maximum.accumulate(dd["endtime"] + min_gap)
-            gap_index = cum_max < shifted_starttimes
-            # create a dataframe of gaps
-            df = dd[gap_index]
-            df["starttime"] = dd.endtime[gap_index]
-            df["endtime"] = shifted_starttimes[gap_index]
-            df["gap_duration"] = df["endtime"] - df["starttime"]
-            return df
-
-        # get index and group by NSLC and sampling_period
+        if min_gap is not None:
+            min_gap = to_timedelta64(min_gap)
+            coverage = self._read_coverage(*args, **kwargs)
+            periods = coverage["sampling_period"] * self._coverage_periods
+            if (min_gap < periods).any():
+                return self._get_gaps_from_index(*args, min_gap=min_gap, **kwargs)
+        coverage = self._read_coverage(*args, min_gap=min_gap, **kwargs)
+        # the coverage is merged, so every space between intervals is a gap
+        gaps = _find_gaps(coverage, self._coverage_key, 0)
+        return gaps[list(self._gap_columns)]
+
+    def _get_gaps_from_index(self, *args, min_gap=None, **kwargs) -> pd.DataFrame:
+        """ Find gaps from the index rows, see get_gaps_df. """
         index = self.read_index(*args, **kwargs)
-        group_names = list(NSLC) + ["sampling_period"]  # include period
-        group = index.groupby(group_names, as_index=False)
-        out = group.apply(_get_gap_dfs, min_gap=min_gap)
-        if out.empty:  # if not gaps return empty dataframe with needed cols
-            return pd.DataFrame(columns=self._gap_columns)
-        return out.reset_index(drop=True)
+        if min_gap is None:
+            periods = index["sampling_period"].values.astype(np.int64)
+            tolerance = (periods * self._coverage_periods).astype(np.int64)
+        else:
+            tolerance = int(to_timedelta64(min_gap).astype("timedelta64[ns]"))
+        gaps = _find_gaps(index, self._coverage_key, tolerance)
+        return gaps[list(self._gap_columns)]
 
     @compose_docstring(get_waveforms_params=get_waveforms_parameters)
     def get_uptime_df(self, *args, **kwargs) -> pd.DataFrame:
@@ -470,7 +1578,7 @@ class WaveBank(_Bank):
             gap_total_df = pd.DataFrame(avail[list(NSLC)])
             gap_total_df["gap_duration"] = EMPTYTD64
         else:
-            gap_totals = gaps_df.groupby(list(NSLC)).gap_duration.sum()
+            gap_totals = gaps_df.groupby(list(NSLC), observed=True).gap_duration.sum()
             gap_total_df = pd.DataFrame(gap_totals).reset_index()
         # merge gap dataframe with availability dataframe, add uptime and %
         df = pd.merge(avail, gap_total_df, how="outer")
@@ -480,12 +1588,68 @@ class WaveBank(_Bank):
         df["availability"] = df["uptime"] / df["duration"]
         return df
 
+    @compose_docstring(get_waveforms_params=get_waveforms_parameters)
+    def get_coverage(
+        self,
+        network: Optional[str] = None,
+        station: Optional[str] = None,
+        location: Optional[str] = None,
+        channel: Optional[str] = None,
+        starttime: Optional[utc_time_type] = None,
+        endtime: Optional[utc_time_type] = None,
+        bin_size: Union[float, np.timedelta64] = 3600.0,
+    ) -> pd.DataFrame:
+        """
+        Return the fraction of each time bin covered by data for each channel.
+
+        Only the coverage table is read. Each sample covers one sampling
+        period.
+
+        Parameters
+        ----------
+        {get_waveforms_params}
+        bin_size
+            The duration of each bin in seconds or as a timedelta64. If
+            starttime is None, bins start at the multiple of bin_size
+            before the earliest data.
+
+        Returns
+        -------
+        A dataframe indexed by the starttime of each bin with a column of
+        fractions for each seed id.
+        """
+        coverage = self._read_coverage(network, station, location, channel)
+        if coverage.empty:
+            return pd.DataFrame(index=pd.DatetimeIndex([], name="starttime"))
+        codes, seed_ids = pd.factorize(get_seed_id_series(coverage), sort=True)
+        starts = coverage["starttime"].values.astype(np.int64)
+        periods = coverage["sampling_period"].values.astype(np.int64)
+        ends = coverage["endtime"].values.astype(np.int64) + periods
+        # merge coverage of the same channel with different sampling rates
+        groups = _coalesce_intervals(codes, starts, ends)
+        df = pd.DataFrame(dict(code=codes, starttime=starts, endtime=ends))
+        df = df.groupby(groups).agg(dict(code="first", starttime="min", endtime="max"))
+        bin_ns = int(to_timedelta64(bin_size).astype("timedelta64[ns]"))
+        if starttime is None:
+            t1 = (df["starttime"].min() // bin_ns) * bin_ns
+        else:
+            t1 = int(to_datetime64(starttime).astype(np.int64))
+        if endtime is None:
+            t2 = df["endtime"].max()
+        else:
+            t2 = int(to_datetime64(endtime).astype(np.int64))
+        edges = np.append(np.arange(t1, t2, bin_ns), t2)
+        fractions = _binned_coverage(df["code"], df["starttime"], df["endtime"], edges)
+        index = pd.DatetimeIndex(edges[:-1].astype("datetime64[ns]"), name="starttime")
+        return pd.DataFrame(fractions.T, index=index, columns=seed_ids)
+
     # ------------------------ get waveform related methods
 
     def get_waveforms_bulk(
         self,
         bulk: bulk_waveform_arg_type,
         index: Optional[pd.DataFrame] = None,
+        gap_tolerance: float = 0.0,
         **kwargs,
     ) -> Stream:
         """
@@ -499,42 +1663,224 @@ class WaveBank(_Bank):
         index
             A dataframe returned by read_index. Enables calling code to only
             read the index from disk once for repetitive calls.
+        gap_tolerance
+            Requests which use the same file and overlap, or are separated
+            by no more than gap_tolerance seconds, are read from the file
+            together. The default of 0 only coalesces overlapping requests,
+            larger values make fewer reads but also read the data between
+            requests.
+        """
+        out = []
+        for _, st in self._yield_bulk_windows(bulk, index, gap_tolerance):
+            out.extend(st)
+        return obspy.Stream(traces=out)
+
+    def get_waveforms_bulk_split(
+        self,
+        bulk: bulk_waveform_arg_type,
+        index: Optional[pd.DataFrame] = None,
+        gap_tolerance: float = 0.0,
+    ) -> List[Stream]:
+        """
+        Get a stream for each request of a bulk request.
+
+        Overlapping and nearby requests are read together, as in
+        get_waveforms_bulk, then split into one stream per request.
+
+        Parameters
+        ----------
+        bulk
+            A list of any number of lists containing the following:
+            (network, station, location, channel, starttime, endtime).
+        index
+            A dataframe returned by read_index. Enables calling code to only
+            read the index from disk once for repetitive calls.
+        gap_tolerance
+            Requests which use the same file and overlap, or are separated
+            by no more than gap_tolerance seconds, are read from the file
+            together. The default of 0 only coalesces overlapping requests,
+            larger values make fewer reads but also read the data between
+            requests.
+
+        Returns
+        -------
+        A list of streams, in the order of bulk.
+        """
+        out = [obspy.Stream() for _ in bulk or []]
+        for rows, st in self._yield_bulk_windows(bulk, index, gap_tolerance):
+            used = set()
+            for row, ids in rows.items():
+                traces = [tr for tr in st if tr.id in ids]
+                # requests for the same data get their own copies
+                out[row] = obspy.Stream(
+                    traces=[tr.copy() if id(tr) in used else tr for tr in traces]
+                )
+                used.update(id(tr) for tr in traces)
+        return out
+
+    def get_waveforms_array(
+        self,
+        bulk: bulk_waveform_arg_type,
+        index: Optional[pd.DataFrame] = None,
+        sampling_rate: Optional[float] = None,
+        dtype=np.float64,
+        gap_tolerance: float = 0.0,
+    ) -> Tuple[np.ndarray, np.ndarray, pd.DataFrame]:
+        """
+        Get the samples of a bulk request as arrays.
+
+        Files are read into traces once per span of requests, as in
+        get_waveforms_bulk, then the samples each request needs are copied
+        from the traces' data into one array, without merging or trimming
+        the traces or building a stream for each request.
+
+        Parameters
+        ----------
+        bulk
+            A list of any number of lists containing the following:
+            (network, station, location, channel, starttime, endtime).
+        index
+            A dataframe returned by read_index. Enables calling code to only
+            read the index from disk once for repetitive calls.
+        sampling_rate
+            The sampling rate of the output. Channels with other sampling
+            rates are not filled. If None, all the channels requested must
+            have the same, non-zero, sampling rate.
+        dtype
+            The float dtype of the output data.
+        gap_tolerance
+            Requests which use the same file and overlap, or are separated
+            by no more than gap_tolerance seconds, are read from the file
+            together. The default of 0 only coalesces overlapping requests,
+            larger values make fewer reads but also read the data between
+            requests.
+
+        Returns
+        -------
+        data
+            An array of shape (n_requests, n_channels, n_samples). The
+            channels of each request are sorted by seed id. The first sample
+            is the one nearest the request's starttime, and each request has
+            the samples up to its endtime. Samples without data are NaN.
+        mask
+            A boolean array, the same shape as data, which is True where
+            samples were filled.
+        stats
+            A dataframe with a row for each channel of each request and the
+            columns request, channel_index, network, station, location,
+            channel, starttime (of the first sample), sampling_rate and npts
+            (the number of filled samples).
+        """
+        read = self._read_bulk(bulk, index, gap_tolerance)
+        num_requests = len(bulk) if bulk else 0
+        if read is None:
+            shape = (num_requests, 0, 0)
+            stats = pd.DataFrame(columns=list(self._array_stats_dtypes))
+            stats = stats.astype(dict(self._array_stats_dtypes))
+            return np.empty(shape, dtype), np.zeros(shape, bool), stats
+        df, _, pairs, span_traces = read
+        if sampling_rate is None:
+            periods = pairs["sampling_period"].unique().astype(np.int64)
+            if (periods <= 0).any():
+                msg = "requested channels have a sampling rate of 0"
+                raise ValueError(msg + ", pass sampling_rate")
+            rates = 1 / (periods / 1e9)
+            if len(rates) > 1:
+                msg = f"requested channels have sampling rates {rates}"
+                raise ValueError(msg + ", pass sampling_rate")
+            sampling_rate = rates[0]
+        # each channel of each request gets an index, in order of seed id
+        slots = pairs[["row", "seed_id"]].drop_duplicates()
+        slots = slots.sort_values(["row", "seed_id"]).reset_index(drop=True)
+        slots["channel_index"] = slots.groupby("row").cumcount()
+        slots["slot"] = np.arange(len(slots))
+        t1s = df["t1"].values.astype(np.int64)
+        durations = df["t2"].values.astype(np.int64) - t1s
+        lengths = np.floor(durations * sampling_rate / 1e9).astype(np.int64) + 1
+        shape = (num_requests, slots["channel_index"].max() + 1, lengths.max())
+        data = np.full(shape, np.nan, dtype=dtype)
+        mask = np.zeros(shape, dtype=bool)
+        # the traces of each channel of each span
+        traces = defaultdict(list)
+        for span, trs in span_traces.items():
+            for tr in trs:
+                if np.isclose(tr.stats.sampling_rate, sampling_rate):
+                    traces[(span, tr.id)].append(tr)
+        # copy the samples of each trace into the rows which need them
+        reads = pairs[["row", "seed_id", "span"]].drop_duplicates()
+        reads = reads.merge(slots, on=["row", "seed_id"])
+        starts = t1s[slots["row"].values]
+        found = np.zeros(len(slots), dtype=bool)
+        columns = ["row", "seed_id", "span", "channel_index", "slot"]
+        for row, seed_id, span, chan, slot in reads[columns].values:
+            t1, length = t1s[row], lengths[row]
+            for tr in traces.get((span, seed_id), []):
+                tr_start = tr.stats.starttime.ns
+                # position of the first sample, ties go to the later sample
+                offset = int(np.ceil((tr_start - t1) * sampling_rate / 1e9 - 0.5))
+                first, start = max(-offset, 0), max(offset, 0)
+                count = min(len(tr.data) - first, length - start)
+                if count <= 0:
+                    continue
+                data[row, chan, start : start + count] = tr.data[first:][:count]
+                mask[row, chan, start : start + count] = True
+                # the time of the first sample on the trace's sample grid
+                if not found[slot]:
+                    starts[slot] = tr_start - int(offset * 1e9 / sampling_rate)
+                    found[slot] = True
+        stats = slots[["row", "channel_index"]].rename(columns={"row": "request"})
+        nslc = slots["seed_id"].str.split(".", expand=True)
+        for num, name in enumerate(NSLC):
+            stats[name] = nslc[num]
+        stats["starttime"] = starts.astype("datetime64[ns]")
+        stats["sampling_rate"] = float(sampling_rate)
+        stats["npts"] = mask.sum(axis=2)[slots["row"], slots["channel_index"]]
+        return data, mask, stats.astype(dict(self._array_stats_dtypes))
+
+    def _yield_bulk_windows(self, bulk, index, gap_tolerance):
+        """
+        Yield the requests and stream of each unique time window of bulk.
+
+        The requests are a dict of {{bulk row: seed ids}}, the streams are
+        yielded in order of (starttime, endtime).
+        """
+        read = self._read_bulk(bulk, index, gap_tolerance)
+        if read is None:
+            return
+        _, windows, pairs, file_traces = read
+        pairs = pairs.sort_values("window", kind="mergesort")
+        # slice the traces of each window out of the traces of its spans
+        bounds = np.flatnonzero(np.diff(pairs["window"].values)) + 1
+        firsts = pairs["window"].values[np.r_[0, bounds]]
+        columns = ["row", "span", "seed_id"]
+        for window, rows in zip(firsts, np.split(pairs[columns].values, bounds)):
+            requests = defaultdict(set)
+            for row, seed_id in rows[:, [0, 2]]:
+                requests[row].add(seed_id)
+            ids = set(rows[:, 2])
+            traces = [
+                tr
+                for span in pd.unique(rows[:, 1])
+                for tr in file_traces.get(span, [])
+                if tr.id in ids
+            ]
+            t1, t2 = [to_utc(x) for x in windows[window].astype("datetime64[ns]")]
+            st = self._copy_slices(traces, t1, t2)
+            yield requests, self._prep_output_stream(st, t1, t2)
+
+    def _read_bulk(self, bulk, index, gap_tolerance):
+        """
+        Read the data needed for a bulk request.
+
+        Returns None if no data match the request, else the dataframe of
+        bulk requests, an array of their unique time windows (in ns), a
+        dataframe of the matching (request, index row) pairs and a dict of
+        {{span: traces}} (see _read_bulk_spans).
         """
         if not bulk:  # return emtpy waveforms if empty list or None
-            return obspy.Stream()
-
-        def _func(time, ind, df):
-            """ return waveforms from df of bulk parameters """
-            match_chars = {"*", "?", "[", "]"}
-            t1, t2 = time[0], time[1]
-            # filter index based on start/end times
-            in_time = ~((ind["starttime"] > t2) | (ind["endtime"] < t1))
-            ind = ind[in_time]
-            # create indices used to load data
-            ar = np.ones(len(ind))  # indices of ind to use to load data
-            df = df[(df.t1 == time[0]) & (df.t2 == time[1])]
-            # determine which columns use any matching or other select features
-            uses_matches = [_column_contains(df[x], match_chars) for x in NSLC]
-            match_ar = np.array(uses_matches).any(axis=0)
-            df_match = df[match_ar]
-            df_no_match = df[~match_ar]
-            # handle columns that need matches (more expensive)
-            if not df_match.empty:
-                match_bulk = df_match.to_records(index=False)
-                mar = np.array([filter_index(ind, *tuple(b)[:4]) for b in match_bulk])
-                ar = np.logical_and(ar, mar.any(axis=0))
-            # handle columns that do not need matches
-            if not df_no_match.empty:
-                nslc1 = set(get_seed_id_series(df_no_match))
-                nslc2 = get_seed_id_series(ind)
-                ar = np.logical_and(ar, nslc2.isin(nslc1))
-            return self._index2stream(ind[ar], t1, t2)
-
-        # get a dataframe of the bulk arguments, convert time to float
+            return None
+        # get a dataframe of the bulk arguments, convert time to datetime64
         df = pd.DataFrame(bulk, columns=list(NSLC) + ["utc1", "utc2"])
-        # df["t1"] = df["utc1"].apply(to_datetime64).astype("datetime64[ns]")
-        # df["t2"] = df["utc2"].apply(to_datetime64).astype("datetime64[ns]")
-
         df["t1"] = df["utc1"].apply(to_datetime64).astype("datetime64[ns]")
         df["t2"] = df["utc2"].apply(to_datetime64).astype("datetime64[ns]")
         # read index that contains any times that might be used, or filter
@@ -544,10 +1890,103 @@ class WaveBank(_Bank):
             ind = index[~((index.starttime > t2) | (index.endtime < t1))]
         else:
             ind = self.read_index(starttime=t1, endtime=t2)
-        # groupby.apply calls two times for each time set, avoid this.
-        unique_times = np.unique(df[["t1", "t2"]].values, axis=0)
-        streams = [_func(t, df=df, ind=ind) for t in unique_times]
-        return reduce(add, streams)
+        seed_ids = get_seed_id_series(ind).values
+        bulk_pos, index_pos = self._join_bulk(df, ind, seed_ids)
+        times = df[["t1", "t2"]].values.astype(np.int64)
+        windows, window_codes = np.unique(times, axis=0, return_inverse=True)
+        pairs = pd.DataFrame(
+            {
+                "window": window_codes.ravel()[bulk_pos],
+                "row": bulk_pos,
+                "path": np.asarray(ind["path"], dtype=object)[index_pos],
+                "seed_id": seed_ids[index_pos],
+                "sampling_period": ind["sampling_period"].values[index_pos],
+            }
+        )
+        if pairs.empty:
+            return None
+        tolerance = int(to_timedelta64(gap_tolerance).astype("timedelta64[ns]"))
+        pairs["span"], span_traces = self._read_bulk_spans(pairs, windows, tolerance)
+        return df, windows, pairs, span_traces
+
+    def _join_bulk(self, df, index, seed_ids):
+        """
+        Return the positions of the matching (bulk row, index row) pairs.
+
+        Bulk rows without wildcards are matched on seed id. Rows with wildcards
+        are expanded into one row per matching channel of the index, then all
+        rows are joined to the index on channel and time overlap at once.
+        """
+        match_chars = {"*", "?", "[", "]"}
+        codes, channels = pd.factorize(seed_ids)
+        uses_matches = [_column_contains(df[x], match_chars) for x in NSLC]
+        match_ar = np.array(uses_matches).any(axis=0)
+        exact = np.flatnonzero(~match_ar)
+        exact_ids = get_seed_id_series(df.iloc[exact]).values
+        bulk_rows, bulk_codes = [exact], [pd.Index(channels).get_indexer(exact_ids)]
+        if match_ar.any():
+            # the codes of the index's channels are the positions of firsts
+            firsts = np.unique(codes, return_index=True)[1]
+            channel_df = index.iloc[firsts][list(NSLC)]
+            wild = df.iloc[np.flatnonzero(match_ar)][list(NSLC)]
+            # group on codes, null codes are -1 so rows with nulls are kept
+            keys = pd.DataFrame({x: pd.factorize(wild[x])[0] for x in NSLC})
+            groups = keys.groupby(list(NSLC), sort=False).indices
+            for rows in groups.values():
+                pattern = wild.iloc[rows[0]].values
+                matched = np.flatnonzero(filter_index(channel_df, *pattern))
+                bulk_rows.append(np.repeat(wild.index.values[rows], len(matched)))
+                bulk_codes.append(np.tile(matched, len(rows)))
+        bulk_rows = np.concatenate(bulk_rows)
+        bulk_codes = np.concatenate(bulk_codes)
+        bulk_pos, index_pos = _interval_join(
+            bulk_codes,
+            df["t1"].values[bulk_rows],
+            df["t2"].values[bulk_rows],
+            codes,
+            index["starttime"].values,
+            index["endtime"].values,
+        )
+        return bulk_rows[bulk_pos], index_pos
+
+    def _read_bulk_spans(self, pairs, windows, tolerance):
+        """
+        Read the files needed by the bulk pairs.
+
+        The windows of each file are coalesced into spans of overlapping
+        windows, or windows separated by no more than tolerance (in ns), and
+        each span is read once. Returns the span of each pair and a dict of
+        {{span: traces}}.
+        """
+        reads = pairs[["path", "window"]].drop_duplicates()
+        path_codes = pd.factorize(reads["path"])[0]
+        if self._trace_cache.max_bytes:
+            # files are read (or taken from the cache) whole
+            reads["span"] = path_codes
+            file_ids = pairs.groupby("path")["seed_id"].agg(set).to_dict()
+            file_traces = self._read_cached_files(file_ids)
+            paths = reads.drop_duplicates("span").set_index("span")["path"]
+            span_traces = {x: file_traces.get(y, []) for x, y in paths.items()}
+        else:
+            t1s, t2s = windows[reads["window"].values].T
+            reads["span"] = _coalesce_intervals(path_codes, t1s, t2s, tolerance)
+            reads["t1"], reads["t2"] = t1s, t2s
+            agg = dict(path=("path", "first"), t1=("t1", "min"), t2=("t2", "max"))
+            spans = reads.groupby("span").agg(**agg)
+            args = zip(
+                str(self.bank_path) + spans["path"],
+                spans["t1"].values.astype("datetime64[ns]"),
+                spans["t2"].values.astype("datetime64[ns]"),
+            )
+            func = partial(_try_read_stream_times, format=self.format)
+            streams = self._map(func, args, chunksize=len(spans) / self._max_workers)
+            span_traces = {
+                span: replace_null_nlsc_codes(st).traces
+                for span, st in zip(spans.index, streams)
+                if st is not None
+            }
+        span = pairs.merge(reads, on=["path", "window"], how="left")["span"]
+        return span.values, span_traces
 
     @compose_docstring(get_waveforms_params=get_waveforms_parameters)
     def get_waveforms(
@@ -593,6 +2032,9 @@ class WaveBank(_Bank):
         endtime: Optional[utc_able_type] = None,
         duration: float = 3600.0,
         overlap: Optional[float] = None,
+        prefetch: int = 0,
+        wait_times: Optional[list] = None,
+        read_once: bool = False,
     ) -> Stream:
         """
         Yield time-series segments.
@@ -606,12 +2048,28 @@ class WaveBank(_Bank):
         overlap : float
             If duration is used, the amount of overlap in yielded streams,
             added to the end of the waveforms.
+        prefetch : int
+            The number of streams to read ahead in a background thread while
+            the caller works on the current one. At most prefetch streams
+            are held in memory besides the one yielded. The default, 0, only
+            reads a stream when it is requested.
+        wait_times : list
+            If a list is provided the time (in seconds) the caller waited for
+            each stream to be read is appended to it.
+        read_once : bool
+            If True, each file is read and decoded only once; its traces are
+            kept in memory while any remaining stream needs them and the
+            streams are sliced out of them. This is much faster when files
+            are longer than the streams (or streams overlap) but all files
+            which overlap a stream are held in memory at once.
 
         Notes
         -----
         All string parameters can use posix style matching with * and ? chars.
 
         Total duration of yielded streams = duration + overlap.
+
+        While prefetching, the bank should not be used from other threads.
         """
         # get times in float format
         starttime = to_datetime64(starttime, 0.0)
@@ -628,21 +2086,97 @@ class WaveBank(_Bank):
         # adjust start/end times
         starttime = max(starttime, index.starttime.min())
         endtime = min(endtime, index.endtime.max())
+        intervals = _IntervalIndex(index["starttime"], index["endtime"])
         # chunk time and iterate over chunks
         time_chunks = make_time_chunks(starttime, endtime, duration, overlap)
-        for t1, t2 in time_chunks:
-            t1, t2 = to_datetime64(t1), to_datetime64(t2)
-            con1 = (index.starttime - self.buffer) > t2
-            con2 = (index.endtime + self.buffer) < t1
-            ind = index[~(con1 | con2)]
-            if not len(ind):
-                continue
-            yield self._index2stream(ind, t1, t2)
+
+        def _chunk_args():
+            """ Yield the index and times of each chunk with data. """
+            for t1, t2 in time_chunks:
+                t1, t2 = to_datetime64(t1), to_datetime64(t2)
+                t1_buff, t2_buff = t1 - self.buffer, t2 + self.buffer
+                ind = index.iloc[intervals.query(t1_buff, t2_buff, closed=True)]
+                if len(ind):
+                    yield ind, t1, t2
+
+        if read_once:
+            streams = self._read_once_streams(_chunk_args(), index)
+        else:
+            streams = (self._index2stream(*x) for x in _chunk_args())
+        if prefetch:
+            streams = self._prefetch(streams, prefetch)
+        while True:
+            wait_start = time.perf_counter()
+            st = next(streams, None)
+            if st is None:
+                return
+            if wait_times is not None:
+                wait_times.append(time.perf_counter() - wait_start)
+            yield st
+
+    @staticmethod
+    def _prefetch(streams, prefetch: int):
+        """
+        Yield from the iterator streams, getting up to prefetch streams ahead
+        on a background thread.
+
+        Streams are read one at a time, in order; the bank's executor is still
+        used to read the files of each stream.
+        """
+        futures = deque()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                for _ in range(prefetch):
+                    futures.append(executor.submit(next, streams, None))
+                while True:
+                    st = futures.popleft().result()
+                    if st is None:
+                        return
+                    futures.append(executor.submit(next, streams, None))
+                    yield st
+            finally:  # dont finish reads nobody will use if the caller stops
+                for future in futures:
+                    future.cancel()
+
+    def _read_once_streams(self, chunk_args, index):
+        """
+        Yield the stream of each (index, starttime, endtime) in chunk_args
+        from a sliding buffer of decoded files.
+
+        Each file is read whole when a chunk first needs it and is dropped
+        once the chunks have passed its last endtime.
+        """
+        paths = np.asarray(index["path"], dtype=object)
+        ends = pd.Series(index["endtime"].values, index=paths)
+        file_ends = ends.groupby(level=0).max()
+        buffered = {}  # path: list of decoded traces
+        func = partial(_try_read_stream, format=self.format)
+        for ind, t1, t2 in chunk_args:
+            t1_buff = t1 - self.buffer
+            for path in [x for x in buffered if file_ends[x] < t1_buff]:
+                buffered.pop(path)
+            chunk_paths = pd.unique(np.asarray(ind["path"], dtype=object))
+            new = [x for x in chunk_paths if x not in buffered]
+            files = [str(self.bank_path) + x for x in new]
+            chunksize = len(files) / self._max_workers
+            for path, st in zip(new, self._map(func, files, chunksize=chunksize)):
+                st = obspy.Stream() if st is None else st
+                buffered[path] = replace_null_nlsc_codes(st).traces
+            traces = chain.from_iterable(buffered[x] for x in chunk_paths)
+            starttime, endtime = to_utc(t1), to_utc(t2)
+            stt = self._copy_slices(traces, starttime, endtime)
+            nslc = set(get_seed_id_series(ind))
+            stt.traces = [x for x in stt if x.id in nslc]
+            yield self._prep_output_stream(stt, starttime, endtime)
 
     # ----------------------- deposit waveforms methods
 
     def put_waveforms(
-        self, stream: Union[obspy.Stream, obspy.Trace], name=None, update_index=True
+        self,
+        stream: Union[obspy.Stream, obspy.Trace],
+        name=None,
+        update_index=True,
+        append=False,
     ):
         """
         Add the waveforms in a waveforms to the bank.
@@ -656,13 +2190,18 @@ class WaveBank(_Bank):
         update_index
             Flag to indicate whether or not to update the waveform index
             after writing the new events. Default is True.
+        append
+            If True, traces put into an existing file are written as new
+            records at the end of it, rather than merged with the traces of
+            the file and the whole file rewritten, and only their rows are
+            added to the index. Use consolidate to merge them later.
         """
         self.ensure_bank_path_exists(create=True)
+        update_time = time.time()
         st_dic = defaultdict(lambda: [])
         # make sure we have a trace iterable
         stream = [stream] if isinstance(stream, obspy.Trace) else stream
         # iter the waveforms and group by common paths
-        paths = []
         for tr in stream:
             summary = _summarize_trace(
                 tr,
@@ -672,50 +2211,273 @@ class WaveBank(_Bank):
             )
             path = self.bank_path / summary["path"]
             st_dic[path].append(tr)
-        # iter all the unique paths and save
+        if not st_dic:
+            return
+        if not update_index:
+            self._write_streams(st_dic, append)
+            return
+        with self._write_lock(exclusive=True):
+            # only append to files whose rows are all in the index
+            indexed, _ = self._read_indexed_files() if append else (None, None)
+            summaries, appended = self._write_streams(st_dic, append, indexed)
+            # index the written traces rather than reading the files back
+            self._index_summaries(summaries, update_time, appended)
+
+    def _write_streams(self, st_dic, append=False, indexed=None):
+        """
+        Write the traces of each path, return their summaries and the files
+        appended to.
+
+        If indexed (the file manifest) is given, only files indexed as they
+        are on disk are appended to.
+        """
+        summaries, appended = {}, []
         for path, tr_list in st_dic.items():
             # make the parent directories if they dont exist
             path.parent.mkdir(exist_ok=True, parents=True)
             stream = obspy.Stream(traces=tr_list)
-            # load the waveforms if the file already exists
-            if path.exists():
-                st_existing = obspy.read(str(path))
-                stream += st_existing
-            # polish streams and write
-            stream.merge(method=1)
-            stream.write(str(path), format="mseed")
-            paths.append(path)
-        # update the index as the contents have changed
-        if st_dic and update_index:
-            self.update_index(paths=paths)
+            if append and path.exists() and self._is_indexed(path, indexed):
+                stream = _merge_stream(stream)
+                with path.open("ab") as fi:
+                    stream.write(fi, format="mseed")
+                appended.append(str(path))
+            else:
+                # load the waveforms if the file already exists
+                if path.exists():
+                    st_existing = obspy.read(str(path))
+                    stream += st_existing
+                # polish streams and write
+                stream = _merge_stream(stream)
+                stream.write(str(path), format="mseed")
+            summaries[str(path)] = _summarize_mseed_traces(stream, str(path))
+        return summaries, appended
+
+    def _is_indexed(self, path, indexed=None) -> bool:
+        """ Return True if the manifest has the size and mtime of a file. """
+        if indexed is None:
+            return True
+        rel_path = _remove_base_path(pd.Series([str(path)]), self.bank_path)[0]
+        if rel_path not in indexed.index:
+            return False
+        size, mtime = _stat_file(path)
+        old = indexed.loc[rel_path]
+        return old["size"] == size and old["mtime"] == mtime
+
+    def _index_summaries(self, summaries, update_time, appended=()):
+        """
+        Write the rows of files summarized in memory to the index, the write
+        lock must be held.
+
+        The rows of appended files are added to those already indexed,
+        the rows of the other files replace them.
+        """
+        self._enforce_min_version()
+        self._enforce_partition()
+        with self._staged_index():
+            indexed, known = self._read_indexed_files()
+            files = [x for x in summaries if x not in set(appended)]
+            kwargs = dict(summaries=summaries)
+            updated = self._index_files(files, None, indexed, known, **kwargs)
+            if appended:
+                self._index_appended(appended, summaries, known)
+            if updated or appended:
+                self._write_update_time(update_time)
+        if updated or appended:
+            self._finish_update(known)
+
+    def _index_appended(self, files, summaries, known):
+        """
+        Add the rows of records appended to files to the index.
+
+        The files get another entry in the file manifest, for the new rows
+        and with their new size and mtime. The record blocks of the files
+        are summarized again as the last block may have grown.
+        """
+        rel_paths = _remove_base_path(pd.Series(files, dtype=object), self.bank_path)
+        stats = pd.DataFrame(
+            [_stat_file(x) for x in files], columns=["size", "mtime"], index=rel_paths
+        )
+        self._trace_cache.invalidate(stats.index)
+        codes = known.get("path", pd.Index([])).get_indexer(rel_paths)
+        if (codes >= 0).any():
+            with self._open_index("a") as store:
+                self._remove_record_blocks(store, codes[codes >= 0])
+        blocks = None
+        if self.records_per_block and self.format == "mseed":
+            func = partial(
+                _summarize_record_blocks, records_per_block=self.records_per_block
+            )
+            block_dfs = [x for x in self._map(func, files) if x is not None]
+            blocks = pd.concat(block_dfs, ignore_index=True) if block_dfs else None
+        df = pd.DataFrame.from_dict(
+            list(chain.from_iterable(summaries[x] for x in files))
+        )
+        self._write_update(df, stats=stats, known=known, blocks=blocks)
+
+    def consolidate(self, paths: Optional[Sequence[str]] = None) -> "WaveBank":
+        """
+        Merge the traces of files which records were appended to.
+
+        Each file is read, its traces merged, then it is rewritten and its
+        rows in the index replaced, as if all of its traces were put at once.
+        Files which can't be consolidated are skipped with a warning.
+
+        Parameters
+        ----------
+        paths
+            The files to consolidate, absolute or relative to the bank path.
+            If None, all files appended to since they were last written
+            whole are consolidated.
+        """
+        self.ensure_bank_path_exists()
+        with self._write_lock(exclusive=True):
+            update_time = time.time()
+            if paths is None:
+                files = self._appended_files()
+            else:
+                files = [self._absolute_path(x) for x in paths]
+            summaries = {}
+            for path in files:
+                try:
+                    stream = _merge_stream(obspy.read(path))
+                    stream.write(path, format="mseed")
+                except Exception as e:
+                    msg = f"failed to consolidate {path}: {e!r}"
+                    warnings.warn(msg, UserWarning)
+                    continue
+                summaries[path] = _summarize_mseed_traces(stream, path)
+            if summaries:
+                self._index_summaries(summaries, update_time)
+        return self
+
+    def _absolute_path(self, path) -> str:
+        """ Return the absolute path of a file in the bank. """
+        path = str(path)
+        if path.startswith(str(self.bank_path)):
+            return path
+        return str(self.bank_path / path.lstrip("/"))
+
+    def _appended_files(self) -> List[str]:
+        """ Return the files with more than one entry in the file manifest. """
+        if not self.index_path.exists():
+            return []
+        with self._open_index(snapshot=False) as store:
+            codes = self._read_file_manifest(store)["path"]
+            categories = self._read_categories(store, "path")
+        codes = codes[codes.duplicated()].unique()
+        return [str(self.bank_path) + x for x in categories[codes]]
 
     # ------------------------ misc methods
 
     def _index2stream(self, index, starttime=None, endtime=None) -> Stream:
         """ return the waveforms in the index """
         # get abs path to each datafame
-        files: pd.Series = (str(self.bank_path) + index.path).unique()
+        unique_paths = index["path"].unique()
+        paths = pd.Series(np.asarray(unique_paths, dtype=object))
+        files: np.ndarray = (str(self.bank_path) + paths).values
         # make sure start and endtimes are in UTCDateTime
         starttime = to_utc(starttime) if starttime else None
         endtime = to_utc(endtime) if endtime else None
-        # iterate the files to read and try to load into waveforms
-        kwargs = dict(format=self.format, starttime=starttime, endtime=endtime)
-        func = partial(_try_read_stream, **kwargs)
         stt = obspy.Stream()
-        chunksize = len(files) / self._max_workers
-        for st in self._map(func, files, chunksize=chunksize):
-            if st is not None:
-                stt += st
+        seed_ids = get_seed_id_series(index)
+        if self._trace_cache.max_bytes:
+            # files are read whole to cache their traces, blocks are not used
+            stt = self._read_cached_traces(index, seed_ids, starttime, endtime)
+        else:
+            # iterate the files to read and try to load into waveforms
+            kwargs = dict(format=self.format, starttime=starttime, endtime=endtime)
+            func = partial(_try_read_stream, **kwargs)
+            has_times = starttime is not None and endtime is not None
+            if self.records_per_block and has_times:
+                # only read the blocks of records which overlap the times
+                blocks = self._read_record_blocks(unique_paths, starttime, endtime)
+                files = [(x, blocks.get(y)) for x, y in zip(files, paths.values)]
+                func = partial(_try_read_byte_ranges, **kwargs)
+            chunksize = len(files) / self._max_workers
+            for st in self._map(func, files, chunksize=chunksize):
+                if st is not None:
+                    stt += st
         # sort out nullish nslc codes
         stt = replace_null_nlsc_codes(stt)
         # filter out any traces not in index (this can happen when files hold
         # multiple traces).
-        nslc = set(get_seed_id_series(index))
+        nslc = set(seed_ids)
         stt.traces = [x for x in stt if x.id in nslc]
         # trim, merge, attach response
         stt = self._prep_output_stream(stt, starttime, endtime)
         return stt
 
+    def _read_cached_traces(
+        self, index, seed_ids, starttime=None, endtime=None
+    ) -> Stream:
+        """
+        Return the traces of the files in the index using the trace cache.
+
+        Files with any traces which are not cached are read whole and all of
+        their traces are cached. Copies of the data between starttime and
+        endtime are returned so cached traces are never modified.
+        """
+        file_ids = defaultdict(set)
+        for path, seed_id in zip(np.asarray(index["path"], dtype=object), seed_ids):
+            file_ids[path].add(seed_id)
+        traces = chain.from_iterable(self._read_cached_files(file_ids).values())
+        return self._copy_slices(traces, starttime, endtime)
+
+    def _read_cached_files(self, file_ids: dict) -> dict:
+        """
+        Return {{path: traces}} for a dict of {{path: seed ids}} using the
+        trace cache.
+
+        Files with any seed ids which are not cached are read whole and all
+        of their traces are cached.
+        """
+        cache = self._trace_cache
+        out, to_read = {}, {}
+        for path, ids in file_ids.items():
+            mtime = _stat_file(str(self.bank_path) + path)[1]
+            cached = [cache.get((path, mtime, x)) for x in ids]
+            if any(x is None for x in cached):
+                to_read[path] = mtime
+            else:
+                out[path] = list(chain.from_iterable(cached))
+        files = [str(self.bank_path) + x for x in to_read]
+        func = partial(_try_read_stream, format=self.format)
+        chunksize = len(files) / self._max_workers
+        streams = self._map(func, files, chunksize=chunksize)
+        for (path, mtime), st in zip(to_read.items(), streams):
+            if st is None:
+                continue
+            file_traces = defaultdict(list)
+            for tr in replace_null_nlsc_codes(st):
+                file_traces[tr.id].append(tr)
+            for seed_id, trs in file_traces.items():
+                cache.put((path, mtime, seed_id), trs)
+            out[path] = st.traces
+        return out
+
+    @staticmethod
+    def _copy_slices(traces, starttime=None, endtime=None) -> Stream:
+        """
+        Return a stream of copies of the data of traces between the times.
+
+        Copies are made so the traces (which may be kept in memory) are never
+        modified by changes to the output.
+        """
+        out = []
+        for tr in traces:
+            sliced = tr.slice(starttime, endtime)
+            sliced.data = sliced.data.copy()
+            # only the trim in _prep_output_stream is recorded, as when reading
+            sliced.stats.processing = list(tr.stats.get("processing", []))
+            out.append(sliced)
+        return obspy.Stream(traces=out)
+
+    def trace_cache_info(self) -> dict:
+        """
+        Return the hits, misses, entries and size (in bytes) of the trace cache.
+        """
+        return self._trace_cache.info()
+
     def _prep_output_stream(self, st, starttime=None, endtime=None) -> obspy.Stream:
         """
         Prepare waveforms object for output by trimming to desired times,
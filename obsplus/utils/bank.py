@@ -2,18 +2,30 @@
 Utils for banks
 """
 import contextlib
+import io
 import itertools
+import json
 import os
 import re
+import shutil
 import sqlite3
+import threading
 import time
 import warnings
-from typing import Optional, Sequence, List
+import weakref
+from collections import defaultdict, OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence, List, Dict
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
 
 import obspy
 import pandas as pd
 import numpy as np
-from tables.exceptions import ClosedNodeError
+from tables.exceptions import HDF5ExtError
 
 from obsplus.constants import (
     NSLC,
@@ -23,11 +35,12 @@ from obsplus.constants import (
     LARGEDT64,
 )
 from obsplus.utils.misc import READ_DICT, _get_path
-from obsplus.utils.mseed import summarize_mseed
-from obsplus.utils.time import to_datetime64, _dict_times_to_ns
+from obsplus.utils.pd import get_regex
+from obsplus.utils.mseed import summarize_mseed_auto, summarize_mseed_blocks
+from obsplus.utils.time import to_datetime64, to_utc, _dict_times_to_ns
 
 # functions for summarizing the various formats
-summarizing_functions = dict(mseed=summarize_mseed)
+summarizing_functions = dict(mseed=summarize_mseed_auto)
 
 # extensions
 WAVEFORM_EXT = ".mseed"
@@ -78,6 +91,41 @@ def summarize_generic_stream(path, format=None) -> List[dict]:
     return out
 
 
+def _summarize_mseed_traces(traces, path) -> List[dict]:
+    """
+    Return summary information for traces as they are written to path.
+
+    Times are rounded to the microseconds stored in miniSEED and the
+    sampling period truncated to microseconds, as summarize_mseed does, so
+    the rows match those of reading the file back (endtimes, which it sums
+    from the record starttimes, to within a microsecond).
+    """
+    out = []
+    for tr in traces:
+        starttime = (tr.stats.starttime._ns + 500) // 1_000 * 1_000
+        endtime = (tr.stats.endtime._ns + 500) // 1_000 * 1_000
+        # a rate of 0 has a period of 0, as in libmseed
+        rate = tr.stats.sampling_rate
+        summary = {
+            "starttime": starttime,
+            "endtime": endtime,
+            "sampling_period": int(1_000_000 / rate) * 1_000 if rate else 0,
+            "path": path,
+        }
+        summary.update(dict((x, c) for x, c in zip(NSLC, tr.id.split("."))))
+        out.append(summary)
+    return out
+
+
+def _merge_stream(stream: obspy.Stream) -> obspy.Stream:
+    """
+    Merge the overlapping and adjacent traces of a stream, keeping those
+    separated by gaps apart (merging fills gaps with masked arrays, which
+    can't be written to miniSEED).
+    """
+    return stream.merge(method=1).split()
+
+
 def _summarize_wave_file(path, format, summarizer=None):
     """
     Summarize waveform files for indexing.
@@ -93,6 +141,20 @@ def _summarize_wave_file(path, format, summarizer=None):
     return summarize_generic_stream(path, format)
 
 
+def _summarize_record_blocks(path, records_per_block: int) -> Optional[pd.DataFrame]:
+    """
+    Return the byte and time ranges of blocks of records in an mseed file.
+
+    None is returned for files which cannot be scanned or fit in one block;
+    these are always read whole.
+    """
+    try:
+        df = summarize_mseed_blocks(path, records_per_block)
+    except (ValueError, IndexError, OSError):
+        return None
+    return df.assign(path=path) if len(df) > 1 else None
+
+
 def _summarize_trace(
     trace: obspy.Trace,
     path: Optional[str] = None,
@@ -141,6 +203,21 @@ def _remove_base_path(series: pd.Series, base="") -> pd.Series:
     return unix_paths.str.replace(unix_base_path, "")
 
 
+def _stat_file(path) -> tuple:
+    """ Return the size and mtime of a file, or (-1, nan) if it doesnt exist. """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return -1, np.nan
+    return stat.st_size, stat.st_mtime
+
+
+def _stat_key(path) -> tuple:
+    """ Return the inode, size and mtime (ns) of a file, which change on writes. """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
 def _natify_paths(series: pd.Series) -> pd.Series:
     """
     Natify paths in a series. IE, on windows replace / with \
@@ -150,56 +227,476 @@ def _natify_paths(series: pd.Series) -> pd.Series:
     return series.str.replace("/", os.sep)
 
 
+# columns of the directory manifest used to prune update walks
+DIRECTORY_COLUMNS = ("path", "mtime", "file_count", "listed")
+
+
+class _PrunedFileIterator:
+    """
+    Iterate files under base_path skipping listings of unchanged directories.
+
+    A directory is only listed if its mtime differs from the one stored in
+    the manifest, otherwise only its known sub-directories are visited.
+    Files created, renamed or deleted change the mtime of their parent
+    directory, files modified in place do not (so they are not found).
+
+    Parameters
+    ----------
+    base_path
+        The directory to traverse.
+    manifest
+        A dataframe with the columns in DIRECTORY_COLUMNS from a previous
+        walk. Directory paths are relative to base_path ("." is the root).
+    ext
+        If not None, only yield files ending with ext.
+    mtime
+        If not None, only yield files modified at or after mtime.
+    skip_hidden
+        If True skip files or folders beginning with a '.'.
+    track_files
+        If True, keep the paths of all files (with ext) in listed directories
+        so files which no longer exist can be found with `missing`.
+
+    Attributes
+    ----------
+    directories
+        A dict of manifest rows (tuples) for each directory found, keyed by
+        relative path. Populated during iteration.
+    changed
+        True if directories differs from the input manifest.
+    listed
+        The relative paths of directories which were listed.
+    files
+        The paths (relative to base_path, starting with "/") of files found
+        in listed directories, only populated if track_files is True.
+    """
+
+    def __init__(
+        self,
+        base_path,
+        manifest: Optional[pd.DataFrame] = None,
+        ext: Optional[str] = None,
+        mtime: Optional[float] = None,
+        skip_hidden: bool = True,
+        track_files: bool = False,
+    ):
+        self.base_path = str(base_path)
+        self.ext, self.mtime, self.skip_hidden = ext, mtime, skip_hidden
+        self.track_files = track_files
+        self._old, self._children = {}, defaultdict(list)
+        if manifest is not None and not manifest.empty:
+            for row in manifest[list(DIRECTORY_COLUMNS)].itertuples(index=False):
+                self._old[row[0]] = tuple(row)
+                if row[0] != ".":
+                    self._children[os.path.dirname(row[0]) or "."].append(row[0])
+        self.directories: Dict[str, tuple] = {}
+        self.changed = False
+        self.listed, self.files = set(), set()
+
+    def __iter__(self):
+        self.directories, self.changed = {}, False
+        self.listed, self.files = set(), set()
+        stack = ["."]
+        while stack:
+            rel = stack.pop()
+            yield from self._visit(rel, stack)
+        self.changed |= set(self.directories) != set(self._old)
+
+    def _visit(self, rel, stack):
+        """ List a directory (if needed) yielding files and queuing sub-dirs. """
+        path = self.base_path if rel == "." else os.path.join(self.base_path, rel)
+        listed = time.time()
+        try:
+            dir_mtime = os.stat(path).st_mtime
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        record = self._old.get(rel)
+        # the listing is unchanged; require the mtime to be well before the
+        # previous listing so coarse mtime resolution cant hide changes.
+        if record and record[1] == dir_mtime and dir_mtime < record[3] - 1:
+            self.directories[rel] = record
+            stack.extend(self._children[rel])
+            return
+        file_count = 0
+        ext, mtime = self.ext, self.mtime
+        prefix = "/" if rel == "." else f"/{rel}/"
+        self.listed.add(rel)
+        for entry in os.scandir(path):
+            if self.skip_hidden and entry.name[0] == ".":
+                continue
+            if entry.is_dir():
+                stack.append(entry.name if rel == "." else f"{rel}/{entry.name}")
+            elif entry.is_file():
+                file_count += 1
+                if ext is not None and not entry.name.endswith(ext):
+                    continue
+                if self.track_files:
+                    self.files.add(prefix + entry.name)
+                if mtime is None or entry.stat().st_mtime >= mtime:
+                    yield entry.path
+        new = (rel, dir_mtime, file_count, listed)
+        # keep the old record if listing again didnt change (or settle) it
+        if record and record[1:3] == new[1:3] and not dir_mtime < listed - 1:
+            new = record
+        self.changed |= new is not record
+        self.directories[rel] = new
+
+    def missing(self, paths) -> np.ndarray:
+        """
+        Return a boolean mask of relative file paths which no longer exist.
+
+        Only files in directories which were listed (or have been removed)
+        during the last iteration can be detected.
+        """
+        paths = pd.Series(paths, dtype=object)
+        if paths.empty:
+            return np.zeros(0, dtype=bool)
+        dirs = paths.str.rsplit("/", n=1).str[0].str.lstrip("/")
+        dirs = dirs.where(dirs != "", ".")
+        checked = dirs.isin(self.listed) | ~dirs.isin(self.directories)
+        return (checked & ~paths.isin(self.files)).values
+
+
+class _IntervalIndex:
+    """
+    A static structure for fast time-overlap queries on an index.
+
+    Rows are sorted by starttime and a running maximum of endtime is kept so
+    that overlap queries only inspect the rows between two binary searches:
+    those starting before the end of the query after the first row whose
+    running maximum endtime reaches its start. A query costs O(log n) plus
+    the number of these rows, which is not bounded by the rows returned; a
+    long row raises the running maximum for all rows after it, so queries
+    after its start scan from it onwards.
+
+    Parameters
+    ----------
+    starttimes
+        An array-like of starttimes (datetime64 or int of ns).
+    endtimes
+        An array-like of endtimes, the same length as starttimes.
+    """
+
+    def __init__(self, starttimes, endtimes):
+        starts = _to_ns_array(starttimes)
+        ends = _to_ns_array(endtimes)
+        self._order = np.argsort(starts, kind="mergesort")
+        self._starts = starts[self._order]
+        self._ends = ends[self._order]
+        self._max_ends = np.maximum.accumulate(self._ends) if len(ends) else ends
+
+    def __len__(self):
+        return len(self._starts)
+
+    def query(self, starttime, endtime, closed: bool = False) -> np.ndarray:
+        """
+        Return the positions of rows which overlap a time range.
+
+        Positions are returned in ascending order so the original row order
+        of the index is preserved when used with iloc.
+
+        Parameters
+        ----------
+        starttime
+            The start of the time range.
+        endtime
+            The end of the time range.
+        closed
+            If True, rows which only touch the edges of the time range are
+            considered overlapping.
+        """
+        t1 = np.datetime64(starttime, "ns").astype(np.int64)
+        t2 = np.datetime64(endtime, "ns").astype(np.int64)
+        if closed:  # starttime <= t2 and endtime >= t1
+            stop = np.searchsorted(self._starts, t2, side="right")
+            start = np.searchsorted(self._max_ends, t1, side="left")
+        else:  # starttime < t2 and endtime > t1
+            stop = np.searchsorted(self._starts, t2, side="left")
+            start = np.searchsorted(self._max_ends, t1, side="right")
+        if start >= stop:
+            return np.empty(0, dtype=np.int64)
+        ends = self._ends[start:stop]
+        in_range = ends >= t1 if closed else ends > t1
+        return np.sort(self._order[start:stop][in_range])
+
+
+def _interval_join(left_codes, left_starts, left_ends, codes, starts, ends):
+    """
+    Find the pairs of left and right rows which share a code and overlap.
+
+    Intervals are closed (rows which only touch overlap). Codes are ints,
+    negative codes never match. Returns the positions of the left and right
+    rows of each pair, ordered by left row.
+
+    Right rows are sorted by (code, starttime) and keyed by code and the rank
+    of their times, so one binary search per left row finds the rows of its
+    code which start before it ends. As in _IntervalIndex, a running maximum
+    of endtime bounds the rows which may end after it starts.
+    """
+    left_codes, codes = np.asarray(left_codes), np.asarray(codes)
+    left_starts, left_ends = _to_ns_array(left_starts), _to_ns_array(left_ends)
+    starts, ends = _to_ns_array(starts), _to_ns_array(ends)
+    times = np.unique(np.concatenate([left_starts, left_ends, starts, ends]))
+    num = len(times) + 1
+
+    def _key(code, time):
+        return code.astype(np.int64) * num + np.searchsorted(times, time)
+
+    order = np.lexsort((starts, codes))
+    start_keys = _key(codes[order], starts[order])
+    end_keys = _key(codes[order], ends[order])
+    max_end_keys = np.maximum.accumulate(end_keys) if len(end_keys) else end_keys
+    stops = np.searchsorted(start_keys, _key(left_codes, left_ends), side="right")
+    firsts = np.searchsorted(max_end_keys, _key(left_codes, left_starts), side="left")
+    counts = np.clip(stops - firsts, 0, None)
+    left_pos = np.repeat(np.arange(len(left_codes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_pos = order[np.repeat(firsts, counts) + offsets]
+    keep = ends[right_pos] >= left_starts[left_pos]
+    return left_pos[keep], right_pos[keep]
+
+
+def _segmented_max(codes, values) -> np.ndarray:
+    """
+    Return the running maximum of values which restarts at each new code.
+
+    Codes must be sorted. Values are keyed by code and rank, as in
+    _interval_join, so one running maximum covers every code at once.
+    """
+    uniques, ranks = np.unique(values, return_inverse=True)
+    num = len(uniques)
+    return uniques[np.maximum.accumulate(codes * num + ranks) - codes * num]
+
+
+def _coalesce_intervals(codes, starts, ends, tolerance=0):
+    """
+    Return the group of each interval after merging intervals which share a
+    code and overlap or are separated by no more than tolerance.
+
+    Codes are ints and times are int64 ns. tolerance is either one value or
+    one per interval. Groups are numbered in order of (code, starttime).
+    Intervals are sorted by (code, starttime) and _segmented_max gives the
+    latest end of the preceding intervals of each code.
+    """
+    codes = np.asarray(codes).astype(np.int64)
+    starts, ends = _to_ns_array(starts), _to_ns_array(ends)
+    if not len(codes):
+        return np.array([], dtype=np.int64)
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    tolerance = np.broadcast_to(tolerance, order.shape)[order][1:]
+    max_ends = _segmented_max(codes, ends)
+    new = np.ones(len(codes), dtype=bool)
+    new[1:] = (codes[1:] != codes[:-1]) | (starts[1:] > max_ends[:-1] + tolerance)
+    out = np.empty(len(codes), dtype=np.int64)
+    out[order] = np.cumsum(new) - 1
+    return out
+
+
+def _interval_gaps(codes, starts, ends, tolerance=0):
+    """
+    Return (positions, gap starts, gap ends) for the gaps longer than
+    tolerance between the intervals of each code.
+
+    Codes are ints and times are int64 ns. tolerance is either one value or
+    one per interval. Positions are those of the interval after each gap.
+    Intervals are sorted by (code, starttime) once and a gap starts at the
+    latest end of the preceding intervals of the same code.
+    """
+    codes = np.asarray(codes).astype(np.int64)
+    starts, ends = _to_ns_array(starts), _to_ns_array(ends)
+    if not len(codes):
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    tolerance = np.broadcast_to(tolerance, order.shape)[order][1:]
+    max_ends = _segmented_max(codes, ends)
+    is_gap = (codes[1:] == codes[:-1]) & (starts[1:] > max_ends[:-1] + tolerance)
+    before = np.flatnonzero(is_gap)
+    return order[before + 1], max_ends[before], starts[before + 1]
+
+
+def _binned_coverage(codes, starts, ends, edges) -> np.ndarray:
+    """
+    Return the fraction of each bin covered by the intervals of each code.
+
+    Codes are ints from 0 to n_codes - 1, intervals of the same code must
+    not overlap. Times and bin edges are int64 ns. Returns an array of
+    shape (n_codes, len(edges) - 1).
+
+    The time covered before each edge is found for every code at once:
+    intervals are sorted by (code, starttime) and keyed by code and the rank
+    of their start, as in _interval_join, so one binary search finds the
+    last interval of each code which starts before each edge.
+    """
+    codes = np.asarray(codes).astype(np.int64)
+    starts, ends = _to_ns_array(starts), _to_ns_array(ends)
+    edges = np.asarray(edges).astype(np.int64)
+    num_codes = codes.max() + 1 if len(codes) else 0
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    durations = ends - starts
+    # time covered by the preceding intervals of the same code
+    before = np.cumsum(durations) - durations
+    before -= before[np.searchsorted(codes, codes)]
+    times = np.unique(np.concatenate([starts, edges]))
+    num = len(times)
+    keys = codes * num + np.searchsorted(times, starts)
+    query_codes = np.repeat(np.arange(num_codes), len(edges))
+    query_times = np.tile(edges, num_codes)
+    query_keys = query_codes * num + np.searchsorted(times, query_times)
+    pos = np.searchsorted(keys, query_keys, side="right") - 1
+    valid = (pos >= 0) & (codes[np.clip(pos, 0, None)] == query_codes)
+    pos = np.clip(pos, 0, None)
+    partial = np.clip(query_times - starts[pos], 0, durations[pos])
+    covered = np.where(valid, before[pos] + partial, 0)
+    covered = covered.reshape(num_codes, len(edges))
+    return np.diff(covered, axis=1) / np.diff(edges)
+
+
+def _merge_coverage(df: pd.DataFrame, columns, tolerance):
+    """
+    Merge the time intervals of a dataframe into coverage intervals.
+
+    Rows which share the values of columns are merged if they overlap or are
+    separated by no more than tolerance, which is one value or one per row.
+    Columns are ints, times and tolerance are int64 ns. Returns a dataframe
+    of columns, starttime and endtime sorted by columns and starttime.
+    """
+    columns = list(columns)
+    if df.empty:
+        return df[columns + ["starttime", "endtime"]].iloc[0:0]
+    codes = df.groupby(columns, sort=True).ngroup().values
+    groups = _coalesce_intervals(codes, df["starttime"], df["endtime"], tolerance)
+    agg = {x: "first" for x in columns}
+    agg.update(starttime="min", endtime="max")
+    return df.groupby(groups, sort=True).agg(agg).reset_index(drop=True)
+
+
+def _find_gaps(df: pd.DataFrame, columns, tolerance) -> pd.DataFrame:
+    """
+    Find the gaps between the time intervals of a dataframe.
+
+    Gaps longer than tolerance, which is one value or one per row, are found
+    between rows which share the values of columns. Times and tolerance are
+    int64 ns or datetimes. Returns a dataframe of columns, starttime, endtime
+    and gap_duration sorted by columns and starttime.
+    """
+    columns = list(columns)
+    codes = df.groupby(columns, sort=True, observed=True).ngroup().values
+    pos, starts, ends = _interval_gaps(codes, df["starttime"], df["endtime"], tolerance)
+    out = df.iloc[pos][columns].reset_index(drop=True)
+    out["starttime"] = starts.astype(df["starttime"].dtype)
+    out["endtime"] = ends.astype(df["endtime"].dtype)
+    out["gap_duration"] = out["endtime"] - out["starttime"]
+    return out
+
+
+def _to_ns_array(values) -> np.ndarray:
+    """ Convert an array-like of times to an int64 array of ns. """
+    values = getattr(values, "values", values)
+    return np.asarray(values).astype("datetime64[ns]").astype(np.int64)
+
+
+def _sorted_categories(values) -> tuple:
+    """
+    Return a categorical dtype with the values of a lookup table sorted, and
+    the code in it of each position of the table, so categoricals don't
+    depend on the order values were added to the table.
+    """
+    values = pd.Index(values, dtype=object)
+    order = np.argsort(values.values.astype(str), kind="mergesort")
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = np.arange(len(values))
+    return pd.CategoricalDtype(values[order]), ranks
+
+
+def _recode(codes, ranks) -> np.ndarray:
+    """ Map the codes of a lookup table to those of its sorted categories. """
+    codes = np.asarray(codes, dtype=np.int64)
+    out = np.full(len(codes), -1, dtype=np.int64)  # -1 is null
+    valid = codes >= 0
+    out[valid] = ranks[codes[valid]]
+    return out
+
+
 class _IndexCache:
     """ A simple class for caching indexes """
 
+    _columns = "t1 t2 kwargs filters cindex intervals".split()
+    _max_query_codes = 16  # most codes of a column to select in a query
+    _max_block_files = 10_000  # most files to cache the record blocks of
+
     def __init__(self, bank, cache_size=5):
         self.max_size = cache_size
         self.bank = bank
-        self.cache = pd.DataFrame(
-            index=range(cache_size), columns="t1 t2 kwargs cindex".split()
-        )
+        self.cache = pd.DataFrame(index=range(cache_size), columns=self._columns)
         self.next_index = itertools.cycle(self.cache.index)
+        self._categories = {}  # cached lookup table, dtype and ranks of columns
+        self.record_blocks = OrderedDict()  # (stat, blocks or None) of each path
 
-    def __call__(self, starttime, endtime, buffer, **kwargs):
-        """ get start and end times, perform in kernel lookup """
+    def __getstate__(self):
+        return {"bank": self.bank, "max_size": self.max_size}  # not the cache
+
+    def __setstate__(self, state):
+        self.__init__(state["bank"], cache_size=state["max_size"])
+
+    def __call__(self, starttime, endtime, buffer, filters=None, **kwargs):
+        """
+        get start and end times, perform in kernel lookup
+
+        filters is an optional dict of str (unix style) patterns of
+        categorical columns which are used to select rows in the query. The
+        returned index may still contain rows which don't match them.
+        """
         # get defaults if starttime or endtime is none
         starttime = None if pd.isnull(starttime) else starttime
         endtime = None if pd.isnull(endtime) else endtime
         starttime = to_datetime64(starttime or SMALLDT64)
         endtime = to_datetime64(endtime or LARGEDT64)
-        # find out if the query falls within one cached times
+        filters = filters or {}
+        filter_str = self._kwargs_to_str(filters)
+        # find out if the query falls within one cached times, an index
+        # cached without filters has the rows of any filters
         con1 = self.cache.t1 <= starttime
         con2 = self.cache.t2 >= endtime
         con3 = self.cache.kwargs == self._kwargs_to_str(kwargs)
-        cached_index = self.cache[con1 & con2 & con3]
+        con4 = self.cache.filters.isin([filter_str, self._kwargs_to_str({})])
+        cached_index = self.cache[con1 & con2 & con3 & con4]
         if not len(cached_index):  # query is not cached get it from hdf5 file
-            where = _get_kernel_query(int(starttime), int(endtime), int(buffer))
-            raw_index = self._get_index(where, **kwargs)
-            # replace "None" with None
-            ic = self.bank.index_str
-            raw_index.loc[:, ic] = raw_index.loc[:, ic].replace(["None"], [None])
+            # bounds of the query, None if unbounded
+            t1, t2 = np.array([starttime, endtime], "datetime64[ns]").astype(np.int64)
+            t1 = int(t1) - int(buffer) if starttime > SMALLDT64 else None
+            t2 = int(t2) + int(buffer) if endtime < LARGEDT64 else None
+            raw_index = self._get_index(t1, t2, filters, **kwargs)
             # convert data types used by bank back to those seen by user
             index = raw_index.astype(dict(self.bank._dtypes_output))
-            self._set_cache(index, starttime, endtime, kwargs)
+            intervals = _IntervalIndex(index["starttime"], index["endtime"])
+            self._set_cache(index, intervals, starttime, endtime, kwargs, filter_str)
         else:
             index = cached_index.iloc[0]["cindex"]
+            intervals = cached_index.iloc[0]["intervals"]
         # trim down index
-        con1 = index["starttime"] >= (endtime + buffer)
-        con2 = index["endtime"] <= (starttime - buffer)
-        return index[~(con1 | con2)]
+        t1, t2 = starttime - buffer, endtime + buffer
+        return index.iloc[intervals.query(t1, t2)]
 
-    def _set_cache(self, index, starttime, endtime, kwargs):
+    def _set_cache(self, index, intervals, starttime, endtime, kwargs, filters):
         """ cache the current index """
-        ser = pd.Series(
-            {
-                "t1": starttime,
-                "t2": endtime,
-                "cindex": index,
-                "kwargs": self._kwargs_to_str(kwargs),
-            }
-        )
-        self.cache.loc[next(self.next_index)] = ser
+        values = {
+            "t1": starttime,
+            "t2": endtime,
+            "cindex": index,
+            "intervals": intervals,
+            "kwargs": self._kwargs_to_str(kwargs),
+            "filters": filters,
+        }
+        # fill an object array one item at a time; a series made from the
+        # dict would convert the index to an array of its values
+        row = np.empty(len(self._columns), dtype=object)
+        for num, column in enumerate(self._columns):
+            row[num] = values[column]
+        self.cache.loc[next(self.next_index)] = row
 
     def _kwargs_to_str(self, kwargs):
         """ convert kwargs to a string """
@@ -207,25 +704,830 @@ class _IndexCache:
         ou = str([(item, kwargs[item]) for item in keys])
         return ou
 
-    def _get_index(self, where, fail_counts=0, **kwargs):
-        """ read the hdf5 file """
-        try:
-            return pd.read_hdf(
-                self.bank.index_path, self.bank._index_node, where=where, **kwargs
-            )
-
-        except (ClosedNodeError, Exception) as e:
-            # Sometimes in concurrent updates the nodes need time to open/close
-            if fail_counts > 10:
-                raise e
-            # Wait a bit and try again (up to 10 times)
-            time.sleep(0.1)
-            return self._get_index(where, fail_counts=fail_counts + 1, **kwargs)
+    def _get_index(self, starttime, endtime, filters=None, **kwargs):
+        """
+        read the hdf5 file
+
+        Rows which may overlap starttime and endtime (int64 ns, None if
+        unbounded) are selected, along with the codes which match filters.
+        """
+        shared = self.bank._shared_index
+        if shared is not None and not kwargs:  # kwargs are for pytables
+            index = shared.select(starttime, endtime, filters)
+            if index is not None:  # else no generation has been published
+                return index
+        # the index lock is held while reading; updates are written to a copy
+        # of the index which replaces it, so each is seen whole or not at all
+        with self.bank._open_index() as store:
+            codes = self._filter_codes(store, filters or {})
+            select_kwargs = dict(kwargs)
+            if any(not len(x) for x in codes.values()):
+                select_kwargs["stop"] = 0  # a filter matches no values
+            max_codes = self._max_query_codes
+            codes = {i: v for i, v in codes.items() if len(v) <= max_codes}
+            where = _plan_index_query(starttime, endtime, codes)
+            select = self.bank._select_index
+            index = select(store, where, starttime, endtime, **select_kwargs)
+            return self._decode_categories(store, index)
+
+    def _filter_codes(self, store, filters: dict) -> dict:
+        """
+        Return the codes of the values of categorical columns which match
+        the (unix style) patterns in filters.
+        """
+        out = {}
+        for col, pattern in filters.items():
+            node = self.bank._category_node(col)
+            nrows = store.get_storer(node).nrows if node in store else 0
+            cached = self._categories.get(col)
+            if cached is not None and len(cached[0]) != nrows:
+                del self._categories[col]  # the index was re-created
+            values = self.lookup(store, col, nrows)[0]
+            matches = values.astype(str).str.match(get_regex(pattern))
+            out[col] = np.flatnonzero(matches)
+        return out
+
+    def _decode_categories(self, store, index):
+        """
+        Convert integer code columns to categoricals, with sorted categories,
+        using the bank's lookup tables.
+        """
+        columns = getattr(self.bank, "_categorical_columns", ())
+        for col in set(columns) & set(index.columns):
+            codes = index[col].values
+            size = int(codes.max()) + 1 if len(codes) else 0
+            _, dtype, ranks = self.lookup(store, col, size)
+            index[col] = pd.Categorical.from_codes(_recode(codes, ranks), dtype=dtype)
+        return index
+
+    def lookup(self, store, col, size: int = 0) -> tuple:
+        """
+        Return the lookup table of a categorical column, as an index of its
+        values by code, and its sorted dtype and ranks (see
+        _sorted_categories).
+
+        Lookup tables are only ever appended to, so the cached table is only
+        re-read if it has fewer than size values.
+        """
+        cached = self._categories.get(col)
+        if cached is None or len(cached[0]) < size:
+            values = self.bank._read_categories(store, col)
+            cached = self._categories[col] = (values, *_sorted_categories(values))
+        return cached
+
+    def get_record_blocks(self, path) -> Optional[np.ndarray]:
+        """
+        Return the cached (offset, nbytes, starttime, endtime) rows of the
+        record blocks of a path, None if it has none. A KeyError is raised
+        if the path is not cached or its size or mtime has changed since.
+        """
+        stat, blocks = self.record_blocks[path]
+        if _stat_file(str(self.bank.bank_path) + path) != stat:
+            raise KeyError(path)
+        self.record_blocks.move_to_end(path)
+        return blocks
+
+    def set_record_blocks(self, path, blocks: Optional[np.ndarray]):
+        """
+        Cache the record blocks of a path with its size and mtime, dropping
+        the least recent.
+        """
+        stat = _stat_file(str(self.bank.bank_path) + path)
+        self.record_blocks[path] = (stat, blocks)
+        self.record_blocks.move_to_end(path)
+        while len(self.record_blocks) > self._max_block_files:
+            self.record_blocks.popitem(last=False)
 
     def clear_cache(self):
         """ removes all cached dataframes. """
-        self.cache = pd.DataFrame(
-            index=range(self.max_size), columns="t1 t2 kwargs cindex".split()
+        self.cache = pd.DataFrame(index=range(self.max_size), columns=self._columns)
+        self._categories = {}
+        self.record_blocks = OrderedDict()
+
+
+class _FileLock:
+    """
+    A re-entrant lock of a file, shared or exclusive, for processes and
+    threads.
+
+    The lock is taken with flock on a lock file which is opened by the
+    first holder in a process and closed when the last releases it, so it
+    is never inherited by forked processes. Any number of threads can hold
+    the lock shared; an exclusive holder waits for the other threads to
+    release it, then keeps them waiting. A thread lock only guards this
+    bookkeeping. Nested acquisitions of an exclusive lock inside a shared
+    one convert the lock until they are released; as with flock, threads
+    converting at once give way to each other, so the shared lock isn't
+    held throughout. Without fcntl (eg windows), or if the lock file can't
+    be created (eg a read-only bank), the lock is only between threads.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Condition()  # guards the attributes below
+        self._file = None
+        self._depths = {}  # thread id: number of nested acquisitions
+        self._converting = set()  # threads waiting to convert their lock
+        self._writer = None  # thread id of the exclusive holder
+        self._exclusive = False
+
+    def __getstate__(self):
+        return {"path": self.path}  # locks are held by one process
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def _depth(self) -> int:
+        """ The number of nested acquisitions of the calling thread. """
+        return self._depths.get(threading.get_ident(), 0)
+
+    @contextlib.contextmanager
+    def __call__(self, exclusive: bool = False):
+        thread = threading.get_ident()
+        writer = self._acquire(thread, exclusive)
+        try:
+            yield
+        finally:
+            self._release(thread, writer)
+
+    def _acquire(self, thread, exclusive: bool) -> bool:
+        """
+        Acquire the lock for a thread, return True if it became the
+        exclusive holder.
+        """
+        with self._lock:
+            if self._writer == thread or not exclusive:
+                self._lock.wait_for(lambda: self._writer in (None, thread))
+                if not self._depths:
+                    self._open()
+                    self._flock(False)
+                self._depths[thread] = self._depths.get(thread, 0) + 1
+                return False
+            self._converting.add(thread)
+            try:
+                self._lock.wait_for(lambda: self._is_free(thread))
+            finally:
+                self._converting.discard(thread)
+            if not self._depths:
+                self._open()
+            self._flock(True)
+            self._writer = thread
+            self._depths[thread] = self._depths.get(thread, 0) + 1
+            return True
+
+    def _is_free(self, thread) -> bool:
+        """ Return True if a thread can take the lock exclusively. """
+        others = set(self._depths) - {thread}
+        return self._writer is None and others <= self._converting
+
+    def _release(self, thread, writer: bool):
+        """ Release an acquisition of a thread, see _acquire. """
+        with self._lock:
+            self._depths[thread] -= 1
+            if not self._depths[thread]:
+                del self._depths[thread]
+            if writer:
+                self._writer = None
+                if self._depths:  # still held shared
+                    self._flock(False)
+            if not self._depths:
+                self._close()
+            self._lock.notify_all()
+
+    def _open(self):
+        """ Open the lock file, if locks between processes are supported. """
+        if fcntl is None:
+            return
+        try:
+            self._file = open(self.path, "a")
+        except OSError:
+            self._file = None
+
+    def _flock(self, exclusive: bool):
+        """ Take the lock of the file, blocking until it is available. """
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self._exclusive = exclusive
+
+    def _close(self):
+        """ Close the lock file, which releases the lock. """
+        if self._file is not None:
+            self._file.close()
+        self._file, self._exclusive = None, False
+
+
+class _IndexSnapshot:
+    """
+    A read-only copy of a bank's index file kept open in memory.
+
+    The file is read whole and opened as an in-memory image with the HDF5
+    core driver, so queries never touch the disk and other handles of the
+    file (eg for writing) are not affected. Each use only stats the file;
+    when the stat changes the update time stored in the file is read, and
+    the image is only loaded again if the update time changed. A snapshot
+    can be used from several threads.
+    """
+
+    _node_cache_slots = 1024  # nodes kept loaded, the indexes have many
+
+    def __init__(self, bank):
+        self.bank = bank
+        self.store: Optional[pd.HDFStore] = None
+        self.last_updated = None
+        self.loads = 0  # number of times the file was loaded
+        self._stat = None
+        self._close = None  # finalizer which closes the store
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        return {"bank": self.bank}  # each process loads its own snapshot
+
+    def __setstate__(self, state):
+        self.__init__(state["bank"])
+
+    @contextlib.contextmanager
+    def open(self):
+        """ Yield the store of the snapshot, loading the index if needed. """
+        with self._lock:
+            store = self.refresh()
+            try:
+                yield store
+            except HDF5ExtError:
+                self.close()  # the image may be of a partly written file
+                raise
+
+    def refresh(self) -> pd.HDFStore:
+        """
+        Load the index if it has been updated since it was loaded, clearing
+        the bank's cache, and return the store.
+        """
+        with self._lock:
+            stat = _stat_key(self.bank.index_path)
+            if self.store is not None and stat == self._stat:
+                return self.store
+            if self.store is None or self._read_last_updated() != self.last_updated:
+                self.close()
+                self.store, stat = self._load()
+                self.last_updated = self._read_last_updated(self.store)
+                self.loads += 1
+                # the cached queries may not match the new index
+                self.bank.clear_cache()
+            self._stat = stat
+            return self.store
+
+    def _load(self):
+        """ Read the index file and open its image, return it and its stat. """
+        path = self.bank.index_path
+        with self.bank._index_lock():  # no writes while the file is read
+            stat = _stat_key(path)
+            image = path.read_bytes()
+        # the name only needs to differ from files opened by pytables
+        name = f"{path}.snapshot-{id(self)}"
+        kwargs = dict(driver_core_image=image, driver_core_backing_store=0)
+        kwargs["node_cache_slots"] = self._node_cache_slots
+        store = pd.HDFStore(name, "r", driver="H5FD_CORE", **kwargs)
+        # close the store when the snapshot is collected or python exits
+        self._close = weakref.finalize(self, store.close)
+        return store, stat
+
+    def _read_last_updated(self, store=None):
+        """ Read the update time from store, or from the index file. """
+        if store is None:
+            with self.bank._open_index(snapshot=False) as store:
+                return self._read_last_updated(store)
+        try:
+            return store.get(self.bank._time_node)[0]
+        except (IndexError, KeyError, ValueError, AttributeError):
+            return None
+
+    def close(self):
+        """ Close the store, the next use loads the index again. """
+        with self._lock:
+            if self._close is not None:
+                self._close()
+            self.store = self._stat = self._close = None
+
+
+def _encode_strings(values) -> tuple:
+    """
+    Return a uint8 array of the utf-8 bytes of values and an int64 array of
+    the offsets of each value (one longer than values).
+    """
+    encoded = [str(x).encode("utf-8") for x in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(buffer, offsets, codes) -> List[str]:
+    """ Decode the values of codes from arrays made by _encode_strings. """
+    codes = np.asarray(codes, dtype=np.int64)
+    if not len(codes):
+        return []
+    starts, ends = offsets[codes], offsets[codes + 1]
+    # copy the bytes spanning the values once, slicing memmaps is slow
+    first = starts.min()
+    data = bytes(buffer[first : ends.max()])
+    starts, ends = (starts - first).tolist(), (ends - first).tolist()
+    return [data[i:j].decode("utf-8") for i, j in zip(starts, ends)]
+
+
+class _IndexChanges:
+    """
+    The rows an update added to the index and the path codes of the files
+    it removed, so they can be published to the shared index without
+    reading the whole index (see _SharedIndex).
+
+    If full is True the changes are not known and the whole index is
+    published. An update adding more than _max_rows rows is published
+    whole rather than keeping its rows in memory.
+    """
+
+    _max_rows = 1_000_000
+
+    def __init__(self, base=None, full=False):
+        self.base = base  # the update time of the index before the update
+        self.full = full
+        self.added = []  # encoded dataframes with their labels
+        self.removed = np.array([], dtype=np.int64)
+        self.dead = 0  # number of removed rows
+        self.categories = {}  # the lookup tables after the update
+
+    def add(self, df: pd.DataFrame, categories: dict):
+        """
+        Add (encoded) rows appended to the index, categories is a dict of
+        the lookup tables they were encoded with.
+        """
+        self.added.append(df)
+        self.categories = categories
+        if sum(len(x) for x in self.added) > self._max_rows:
+            self.full, self.added = True, []
+
+    def remove(self, codes, num_rows: int):
+        """ Remove the files of path codes which had num_rows rows. """
+        codes = np.asarray(codes, dtype=np.int64)
+        self.added = [x[~np.isin(x["path"].values, codes)] for x in self.added]
+        self.removed = np.union1d(self.removed, codes)
+        self.dead += num_rows
+
+
+class _SharedIndex:
+    """
+    A copy of a bank's index in memory-mapped files shared by processes.
+
+    The copy is a list of segments, directories of .npy files holding the
+    encoded index columns of some rows, sorted by starttime, and the values
+    added to the lookup tables since the previous segment. Each update
+    publishes the rows it added as a new segment, along with the path codes
+    of the files it removed, whose rows in earlier segments are then
+    skipped. Small segments are merged into the new one so there are only
+    a few, and the whole index is published again if many rows were
+    removed or the changes of an update are not known (eg if an update was
+    interrupted). A small json file names the segments of the current
+    generation.
+
+    Readers memory-map the arrays of the current generation so all processes
+    share the pages of one copy through the OS page cache, rather than each
+    reading the index into its own memory, and only the rows a query selects
+    are decoded. Each use only stats the json file; a new generation is
+    mapped when it changes. Readers never write, until a generation is
+    published queries read the index file. No locks or file handles are
+    held, so a bank can be used in forked processes.
+    """
+
+    _current_name = "current.json"
+    _pending_name = "pending"  # exists while an update is being written
+    _map_attempts = 5  # times to retry mapping if generations are replaced
+    _max_segments = 16
+
+    def __init__(self, bank):
+        self.bank = bank
+        self.generation = None
+        self.maps = 0  # number of generations mapped
+        self._current = None
+        self._stat = None
+        self._state = None  # (segment arrays, lookup tables) of the generation
+
+    def __getstate__(self):
+        return {"bank": self.bank}  # each process maps the arrays itself
+
+    def __setstate__(self, state):
+        self.__init__(state["bank"])
+
+    @property
+    def path(self) -> Path:
+        """ The directory holding the generations. """
+        return self.bank.index_path.with_name(self.bank.index_name + ".shared")
+
+    def track(self, base) -> _IndexChanges:
+        """
+        Start tracking the changes of an update, base is the update time of
+        the index before it. The write lock must be held.
+        """
+        pending = self.path / self._pending_name
+        full = pending.exists()  # an earlier update was not published
+        self.path.mkdir(parents=True, exist_ok=True)
+        pending.touch()
+        return _IndexChanges(base, full)
+
+    def publish(self, changes: Optional[_IndexChanges] = None, full: bool = False):
+        """
+        Publish the changes of an update as a new generation, the whole
+        index if they can't be, or if full is True. Without changes, a
+        generation is only published if the current one is out of date.
+        """
+        with self.bank._write_lock(exclusive=True):  # one publisher at a time
+            self._publish(changes, full)
+
+    def _publish(self, changes, full):
+        """ Publish a new generation, the write lock must be held. """
+        bank, columns = self.bank, self.bank._categorical_columns
+        if not bank.index_path.exists():
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        current = self._read_current()
+        pending = (self.path / self._pending_name).exists()
+        with bank._open_index(snapshot=False) as store:
+            update_time = self._read_update_time(store)
+            if changes is None:
+                stale = pending or current is None
+                stale = stale or current["update_time"] != update_time
+                if not (stale or full):
+                    return
+            full = full or changes is None or changes.full or current is None
+            full = full or current["update_time"] != changes.base
+            if not full:
+                segments, dead = current["segments"], current["dead"] + changes.dead
+                full = dead > sum(x["rows"] for x in segments) // 2
+            if full:
+                counts = {x: self._count_categories(store, x) for x in columns}
+                segments, dead = [], 0
+                arrays = self._read_index(store, counts)
+        if not full:
+            arrays, counts = self._read_changes(changes, current["counts"])
+        self._remove_unused(current)
+        # merge the last segments into the new one while they are not much
+        # bigger, so the segments grow geometrically
+        while segments and (
+            segments[-1]["rows"] <= 2 * len(arrays["label"])
+            or len(segments) >= self._max_segments
+        ):
+            old = self._load(self.path / segments.pop()["name"])
+            arrays = self._merge(old, arrays, drop_removed=not segments)
+        if not segments:
+            dead = 0  # the removed rows were dropped by the merges
+        generation = (current or dict(generation=0))["generation"] + 1
+        name = self._write_segment(arrays, generation)
+        segments = segments + [dict(name=name, rows=len(arrays["label"]))]
+        current = dict(
+            generation=generation,
+            update_time=update_time,
+            counts=counts,
+            dead=dead,
+            segments=segments,
+        )
+        (self.path / f"{name}.json").write_text(json.dumps(current))
+        os.replace(self.path / f"{name}.json", self.path / self._current_name)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path / self._pending_name)
+        self._remove_unused(current)
+
+    def _read_update_time(self, store) -> Optional[float]:
+        """ Read the update time stored in the index, None if there is none. """
+        try:
+            return float(store.get(self.bank._time_node)[0])
+        except (IndexError, KeyError, ValueError, AttributeError):
+            return None
+
+    def _count_categories(self, store, column) -> int:
+        """ Return the number of values in the lookup table of a column. """
+        node = self.bank._category_node(column)
+        return int(store.get_storer(node).nrows) if node in store else 0
+
+    def _read_index(self, store, counts) -> dict:
+        """ Read the arrays of a segment of all the rows of the index. """
+        bank = self.bank
+        df = bank._select_index(store)
+        arrays = self._encode_rows(df)
+        for col in bank._categorical_columns:
+            values = bank._read_categories(store, col)[: counts[col]]
+            arrays[f"{col}_values"], arrays[f"{col}_offsets"] = _encode_strings(values)
+        arrays["removed"] = np.array([], dtype=np.int64)
+        return arrays
+
+    def _read_changes(self, changes, starts) -> tuple:
+        """
+        Return the arrays of a segment of the changes of an update, and the
+        number of values in each lookup table after it.
+        """
+        columns = self.bank._categorical_columns
+        dfs = [x for x in changes.added if len(x)]
+        df = pd.concat(dfs) if dfs else pd.DataFrame(columns=self.bank.index_columns)
+        arrays, counts = self._encode_rows(df), dict(starts)
+        for col in columns:
+            values = changes.categories.get(col, pd.Index([]))[starts[col] :]
+            arrays[f"{col}_values"], arrays[f"{col}_offsets"] = _encode_strings(values)
+            counts[col] += len(values)
+        arrays["removed"] = changes.removed
+        return arrays, counts
+
+    def _encode_rows(self, df: pd.DataFrame) -> dict:
+        """ Return the arrays of (encoded) index rows sorted by starttime. """
+        df = df.iloc[np.argsort(df["starttime"].values, kind="mergesort")]
+        columns = self.bank._categorical_columns
+        arrays = {}
+        for col in self.bank.index_columns:
+            dtype = np.int32 if col in columns else np.int64
+            arrays[col] = df[col].values.astype(dtype)
+        arrays["label"] = df.index.values.astype(np.int64)
+        return arrays
+
+    def _merge(self, old: dict, new: dict, drop_removed: bool) -> dict:
+        """
+        Merge the arrays of a segment into those of the next one. The rows
+        of old which new removed are dropped; the path codes removed by
+        both are kept for earlier segments unless drop_removed.
+        """
+        keep = ~np.isin(old["path"], new["removed"])
+        rows = list(self.bank.index_columns) + ["label"]
+        out = {x: np.concatenate([old[x][keep], new[x]]) for x in rows}
+        order = np.argsort(out["starttime"], kind="mergesort")
+        out = {x: v[order] for x, v in out.items()}
+        for col in self.bank._categorical_columns:
+            values, offsets = f"{col}_values", f"{col}_offsets"
+            out[values] = np.concatenate([old[values], new[values]])
+            shifted = new[offsets][1:] + old[offsets][-1]
+            out[offsets] = np.concatenate([old[offsets], shifted])
+        removed = np.union1d(old["removed"], new["removed"])
+        out["removed"] = removed[:0] if drop_removed else removed
+        return out
+
+    def _write_segment(self, arrays: dict, generation: int) -> str:
+        """ Write the arrays of a segment to a new directory, return its name. """
+        ends = arrays["endtime"]
+        max_end = np.maximum.accumulate(ends) if len(ends) else ends
+        arrays = dict(arrays, max_end=max_end)
+        # the pid keeps the directories of different publishers apart
+        name = f"s{generation}_{os.getpid()}"
+        temp = self.path / f"{name}.tmp"
+        temp.mkdir(parents=True)
+        for key, array in arrays.items():
+            np.save(temp / f"{key}.npy", array)
+        shutil.rmtree(self.path / name, ignore_errors=True)
+        os.rename(temp, self.path / name)
+        return name
+
+    def _remove_unused(self, current: Optional[dict]):
+        """
+        Remove the segments current doesn't use, and files left by
+        publishers which didn't finish. Mappings of removed files stay valid
+        on posix, readers which are mapping them try again.
+        """
+        names = {x["name"] for x in (current or {}).get("segments", [])}
+        names |= {self._current_name, self._pending_name}
+        for path in self.path.iterdir():
+            if path.name in names:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def _read_current(self) -> Optional[dict]:
+        """ Read the current generation, None if there isn't one. """
+        try:
+            current = json.loads((self.path / self._current_name).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        return current if "segments" in current else None  # an old layout
+
+    def refresh(self) -> Optional[tuple]:
+        """
+        Map the current generation if it has changed and return its
+        segments and lookup tables, None if none has been published. The
+        bank's cache is cleared when a new generation is mapped.
+        """
+        path = self.path / self._current_name
+        try:
+            stat = _stat_key(path)
+        except FileNotFoundError:
+            self._current = self._stat = self._state = None
+            return None
+        if stat == self._stat:
+            return self._state
+        for _ in range(self._map_attempts):
+            current = self._read_current()
+            if current == self._current:
+                break
+            try:
+                state = self._map(current)
+            except (FileNotFoundError, KeyError):  # replaced by a newer generation
+                continue
+            self._state, self._current = state, current
+            self.generation = current["generation"] if current else None
+            self.maps += 1
+            self.bank.clear_cache()
+            break
+        else:
+            return self._state  # try again on the next use
+        self._stat = stat
+        return self._state
+
+    def _map(self, current: Optional[dict]) -> Optional[tuple]:
+        """
+        Memory-map the arrays of the segments of a generation and decode the
+        small lookup tables. A KeyError or FileNotFoundError is raised if the
+        segments are removed while they are mapped.
+        """
+        if current is None:
+            return None
+        segments = [self._load(self.path / x["name"]) for x in current["segments"]]
+        removed = np.array([], dtype=np.int64)
+        path_start = 0
+        for arrays in segments[::-1]:  # rows removed by later segments
+            arrays["dropped"] = removed
+            removed = np.union1d(removed, arrays["removed"])
+        for arrays in segments:
+            arrays["path_start"] = path_start
+            path_start += len(arrays["path_offsets"]) - 1
+        lookups = {}
+        for col in NSLC:
+            values = []
+            for arrays in segments:
+                buffer, offsets = arrays[f"{col}_values"], arrays[f"{col}_offsets"]
+                values += _decode_strings(buffer, offsets, range(len(offsets) - 1))
+            lookups[col] = (pd.Index(values, dtype=object), *_sorted_categories(values))
+        return segments, lookups
+
+    def _load(self, directory: Path) -> dict:
+        """ Memory-map the arrays of a segment. """
+        arrays = {x.stem: np.load(x, mmap_mode="r") for x in directory.glob("*.npy")}
+        keys = list(self.bank.index_columns) + ["label", "max_end", "removed"]
+        for col in self.bank._categorical_columns:
+            keys += [f"{col}_values", f"{col}_offsets"]
+        missing = set(keys) - set(arrays)
+        if missing:  # the directory is being removed
+            raise KeyError(f"{directory} has no {sorted(missing)}")
+        return arrays
+
+    def select(self, starttime=None, endtime=None, filters=None):
+        """
+        Return the rows which may overlap starttime and endtime (int64 ns,
+        None if unbounded) and whose codes match filters, decoded and in
+        the order they were added to the index, like _IndexCache._get_index.
+        None is returned if no generation has been published.
+
+        The paths are categorical with only the paths of the rows selected.
+        """
+        state = self.refresh()
+        if state is None:
+            return None
+        segments, lookups = state
+        codes = {}
+        for col, pattern in (filters or {}).items():
+            categories = lookups[col][0].astype(str)
+            codes[col] = np.flatnonzero(categories.str.match(get_regex(pattern)))
+        columns = list(self.bank.index_columns) + ["label"]
+        parts = {x: [] for x in columns}
+        for arrays in segments:
+            positions = self._select_positions(arrays, starttime, endtime, codes)
+            for col in columns:
+                parts[col].append(np.asarray(arrays[col][positions]))
+        values = {x: np.concatenate(v) for x, v in parts.items()}
+        labels = values.pop("label")
+        order = np.argsort(labels, kind="mergesort")
+        labels = labels[order]
+        out = {}
+        for col in self.bank.index_columns:
+            col_values = values[col][order]
+            if col in lookups:
+                _, dtype, ranks = lookups[col]
+                codes = _recode(col_values, ranks)
+                col_values = pd.Categorical.from_codes(codes, dtype=dtype)
+            elif col == "path":
+                col_values = self._decode_paths(segments, col_values)
+            out[col] = col_values
+        return pd.DataFrame(out, index=pd.Index(labels))
+
+    @staticmethod
+    def _select_positions(arrays, starttime, endtime, codes) -> np.ndarray:
+        """ Return the positions of the rows of a segment a query selects. """
+        starts, ends = arrays["starttime"], arrays["endtime"]
+        start, stop = 0, len(starts)
+        if starttime is not None:
+            start = np.searchsorted(arrays["max_end"], starttime, side="left")
+        if endtime is not None:
+            stop = np.searchsorted(starts, endtime, side="right")
+        positions = np.arange(start, max(start, stop))
+        if starttime is not None:
+            positions = positions[ends[positions] >= starttime]
+        for col, col_codes in codes.items():
+            positions = positions[np.isin(arrays[col][positions], col_codes)]
+        if len(arrays["dropped"]):
+            dropped = np.isin(arrays["path"][positions], arrays["dropped"])
+            positions = positions[~dropped]
+        return positions
+
+    @staticmethod
+    def _decode_paths(segments, codes) -> pd.Categorical:
+        """ Return a categorical of the paths of codes, -1 is null. """
+        uniques, inverse = np.unique(codes, return_inverse=True)
+        valid = uniques >= 0
+        categories = []
+        # each segment has the paths added since the previous one
+        for arrays in segments:
+            first = arrays["path_start"]
+            offsets = arrays["path_offsets"]
+            sub = uniques[valid]
+            sub = sub[(sub >= first) & (sub < first + len(offsets) - 1)] - first
+            categories += _decode_strings(arrays["path_values"], offsets, sub)
+        # null codes are first in uniques, shift the others down to match
+        inverse = inverse - (len(uniques) - valid.sum())
+        dtype, ranks = _sorted_categories(categories)
+        return pd.Categorical.from_codes(_recode(inverse, ranks), dtype=dtype)
+
+
+class _TraceCache:
+    """
+    A least recently used cache of decoded traces with a budget in bytes.
+
+    Keys are (path, mtime, trace id) and values are lists of the traces
+    with that id read from the file. Entries larger than the budget are not
+    cached; a budget of 0 disables the cache. The cache can be used from
+    several threads (eg when prefetching streams).
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # key: (traces, nbytes)
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}  # not the cached traces
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key) -> Optional[List[obspy.Trace]]:
+        """ Return the traces of a key, or None, updating hit counts. """
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return value[0]
+
+    def put(self, key, traces: List[obspy.Trace]):
+        """ Cache traces under key, evicting the least recently used. """
+        nbytes = sum(tr.data.nbytes for tr in traces)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._cache[key] = (traces, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, old_bytes) = self._cache.popitem(last=False)
+                self.nbytes -= old_bytes
+
+    def _pop(self, key):
+        """ Remove a key if it is cached. """
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self.nbytes -= value[1]
+
+    def invalidate(self, paths):
+        """ Remove all the entries of the given paths. """
+        paths = set(paths)
+        with self._lock:
+            for key in [x for x in self._cache if x[0] in paths]:
+                self._pop(key)
+
+    def clear(self):
+        """ Remove all entries and reset the counters. """
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+    def info(self) -> dict:
+        """ Return the counters and size of the cache. """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self),
+            nbytes=self.nbytes,
+            max_bytes=self.max_bytes,
         )
 
 
@@ -245,22 +1547,27 @@ def sql_connection(path, **kwargs):
     con.close()  # this is needed on windows but not linux, weird...
 
 
-def _get_kernel_query(starttime: int, endtime: int, buffer: int):
+def _plan_index_query(
+    starttime: Optional[int] = None, endtime: Optional[int] = None, codes=None
+) -> Optional[str]:
     """
-    Create a HDF5 kernel query based on start and end times.
+    Create a HDF5 kernel query for index rows between starttime and endtime.
 
-    This is necessary because hdf5 doesnt accept inverted conditions.
-    A slight buffer is applied to the ranges to make sure no edge files
-    are excluded.
+    Times are int64 ns, or None if the query is unbounded on that side.
+    codes is an optional dict of {column: codes}, rows must have one of the
+    codes of each column. Only the needed conditions are used, each is a
+    range or equality so the indexes of the columns can be used, and None
+    is returned if there are none so the whole table is read.
     """
-    t1 = starttime - buffer
-    t2 = endtime + buffer
-    con = (
-        f"(starttime>{t1:d} & starttime<{t2:d}) | "
-        f"((endtime>{t1:d} & endtime<{t2:d}) | "
-        f"(starttime<{t1:d} & endtime>{t2:d}))"
-    )
-    return con
+    terms = []
+    if endtime is not None:
+        terms.append(f"(starttime <= {endtime:d})")
+    if starttime is not None:
+        terms.append(f"(endtime >= {starttime:d})")
+    for col, values in sorted((codes or {}).items()):
+        equals = " | ".join(f"({col} == {x:d})" for x in values)
+        terms.append(f"({equals})" if len(values) > 1 else equals)
+    return " & ".join(terms) or None
 
 
 # --- SQL stuff
@@ -400,3 +1707,34 @@ def _try_read_stream(stream_path, format=None, **kwargs):
             warnings.warn(msg, UserWarning)
     finally:
         return stt if stt else None
+
+
+def _try_read_stream_times(path_times, format=None):
+    """
+    Try to read a waveform file between some times, if raises return None.
+
+    path_times is a tuple of the path, starttime and endtime.
+    """
+    path, starttime, endtime = path_times
+    kwargs = dict(starttime=to_utc(starttime), endtime=to_utc(endtime))
+    return _try_read_stream(path, format=format, **kwargs)
+
+
+def _try_read_byte_ranges(path_ranges, format=None, **kwargs):
+    """
+    Try to read only some byte ranges of a waveform file, if raises return None.
+
+    path_ranges is a tuple of the path and an array of (offset, nbytes) rows,
+    if the array is None the whole file is read.
+    """
+    path, ranges = path_ranges
+    if ranges is None:
+        return _try_read_stream(path, format=format, **kwargs)
+    if not len(ranges):
+        return None
+    chunks = []
+    with open(path, "rb") as fi:
+        for offset, nbytes in ranges:
+            fi.seek(offset)
+            chunks.append(fi.read(nbytes))
+    return _try_read_stream(io.BytesIO(b"".join(chunks)), format=format, **kwargs)
@@ -4,8 +4,11 @@ Slimmed down bits of obspy's mseed module.
 Copyrights to ObsPy developers still apply.
 """
 import os
+import struct
+from functools import lru_cache
 
 import numpy as np
+import pandas as pd
 from obspy.io.mseed.core import DATATYPES, C, clibmseed
 
 
@@ -28,8 +31,8 @@ def _get_lil(mseed_object):
     length = os.path.getsize(mseed_object)
     assert 128 < length < 2 ** 31, "data length is outside of the save range"
 
-    # Assume a file was passed
-    bfr_np = np.fromfile(mseed_object, dtype=np.int8)
+    # Assume a file was passed, map it rather than reading it into memory
+    bfr_np = np.memmap(mseed_object, dtype=np.int8, mode="r")
 
     buflen = len(bfr_np)
     all_data = []
@@ -108,3 +111,355 @@ def summarize_mseed(mseed_object):
     if not traces:
         raise IOError(f"could not read {mseed_object}")
     return traces
+
+
+# --- a pure NumPy scanner of miniSEED record headers
+
+# the fixed section of the data header (48 bytes) of each record
+_FIXED_HEADER = [
+    ("sequence", "S6"),
+    ("quality", "S1"),
+    ("reserved", "S1"),
+    ("seed_id", "V12"),  # station, location, channel, network
+    ("year", "u2"),
+    ("julday", "u2"),
+    ("hour", "u1"),
+    ("minute", "u1"),
+    ("second", "u1"),
+    ("unused", "u1"),
+    ("fraction", "u2"),
+    ("samples", "u2"),
+    ("rate_factor", "i2"),
+    ("rate_multiplier", "i2"),
+    ("activity_flags", "u1"),
+    ("io_flags", "u1"),
+    ("quality_flags", "u1"),
+    ("blockette_count", "u1"),
+    ("time_correction", "i4"),
+    ("data_offset", "u2"),
+    ("blockette_offset", "u2"),
+]
+_HEADER_LENGTH = 48
+# files smaller than this are faster to summarize with libmseed
+_MIN_SCAN_BYTES = 1_000_000
+# the number of bytes of a file the scanner maps at once
+_WINDOW_BYTES = 2 ** 24
+_VALID_QUALITY = b"DRQM"
+# days from 1970-01-01 to the start of each year from 1900 to 2100
+_FIRST_YEAR = 1900
+_YEAR_DAYS = (
+    np.arange(_FIRST_YEAR - 1970, 2101 - 1970)
+    .astype("datetime64[Y]")
+    .astype("datetime64[D]")
+    .astype(np.int64)
+)
+
+
+@lru_cache()
+def _header_dtype(byteorder: str) -> np.dtype:
+    """ Return the structured dtype of the fixed header for a byte order. """
+    fields = [(name, byteorder + kind) for name, kind in _FIXED_HEADER]
+    return np.dtype(fields)
+
+
+def _get_byteorder(raw: np.ndarray) -> str:
+    """ Guess the byte order of the headers from the year of the first one. """
+    year = raw[20:22]
+    if 1900 <= int(year.view(">u2")[0]) <= 2100:
+        return ">"
+    if 1900 <= int(year.view("<u2")[0]) <= 2100:
+        return "<"
+    raise ValueError("could not determine byte order of miniSEED headers")
+
+
+def _read_bytes(records: np.ndarray, offsets: np.ndarray, nbytes) -> np.ndarray:
+    """ Read nbytes at offsets (one per record) from each record. """
+    if (offsets == offsets[0]).all():  # usual case, blockettes are aligned
+        return records[:, offsets[0] : offsets[0] + nbytes]
+    rows = np.arange(len(records))[:, None]
+    return records[rows, offsets[:, None] + np.arange(nbytes)]
+
+
+def _read_uint(records: np.ndarray, offsets: np.ndarray, nbytes, byteorder):
+    """ Read an unsigned int, at offsets (one per record), from each record. """
+    values = np.ascontiguousarray(_read_bytes(records, offsets, nbytes))
+    return values.view(f"{byteorder}u{nbytes}")[:, 0].astype(np.int64)
+
+
+def _first_record_blockettes(raw: np.ndarray, byteorder: str) -> list:
+    """ Return a list of (type, offset) for the blockettes of the first record. """
+    buffer = raw[:4096].tobytes()
+    count = buffer[39]
+    (offset,) = struct.unpack_from(byteorder + "H", buffer, 46)
+    out = []
+    while offset >= _HEADER_LENGTH and offset + 8 <= len(buffer) and len(out) < count:
+        kind, next_offset = struct.unpack_from(byteorder + "HH", buffer, offset)
+        out.append((kind, offset))
+        offset = next_offset
+    return out
+
+
+def _scan_blockettes(records, headers, byteorder, first_blockettes=None):
+    """
+    Walk the blockette chain of each record (vectorized across records).
+
+    Returns a dict of {blockette type: offset}, offsets are -1 for records
+    without the blockette.
+    """
+    reclen = records.shape[1]
+    count = len(records)
+    found = {x: np.full(count, -1, dtype=np.int64) for x in (100, 1000, 1001)}
+    # usual case; every record has the same blockettes as the first one
+    offsets = headers["blockette_offset"]
+    if first_blockettes and (offsets == offsets[0]).all():
+        first = records[0]
+        same = [
+            (records[:, x : x + 4] == first[x : x + 4]).all()
+            for _, x in first_blockettes
+        ]
+        if all(same):
+            for kind, offset in first_blockettes:
+                if kind in found:
+                    found[kind][:] = offset
+            return found
+    # otherwise follow the chain of each record
+    offsets = offsets.astype(np.int64)
+    for _ in range(int(headers["blockette_count"].max())):
+        active = (offsets >= _HEADER_LENGTH) & (offsets + 8 <= reclen)
+        if not active.any():
+            break
+        safe = np.where(active, offsets, _HEADER_LENGTH)
+        kind = _read_uint(records, safe, 2, byteorder)
+        next_offset = _read_uint(records, safe + 2, 2, byteorder)
+        for key, out in found.items():
+            is_key = active & (kind == key)
+            out[is_key] = safe[is_key]
+        offsets = np.where(active, next_offset, 0)
+    return found
+
+
+def _get_sampling_periods(headers) -> np.ndarray:
+    """ Get sampling periods (us) from the rate factors and multipliers. """
+    factor = headers["rate_factor"].astype(np.float64)
+    mult = headers["rate_multiplier"].astype(np.float64)
+    # positive values multiply the rate, negative values divide it
+    with np.errstate(divide="ignore"):
+        factor = np.where(factor < 0, -1 / factor, factor)
+        mult = np.where(mult < 0, -1 / mult, mult)
+        return 1_000_000 / (factor * mult)
+
+
+def _get_starttimes(records, headers, blockettes) -> np.ndarray:
+    """ Get the starttime (as int of us) of each record. """
+    days = _YEAR_DAYS[headers["year"].astype(np.int64) - _FIRST_YEAR]
+    days += headers["julday"].astype(np.int64) - 1
+    seconds = (
+        days * 86400
+        + headers["hour"].astype(np.int64) * 3600
+        + headers["minute"].astype(np.int64) * 60
+        + headers["second"]
+    )
+    out = seconds * 1_000_000 + headers["fraction"].astype(np.int64) * 100
+    # apply time correction if it has not already been applied
+    not_applied = (headers["activity_flags"] & 0x02) == 0
+    out += np.where(not_applied, headers["time_correction"].astype(np.int64), 0) * 100
+    # add microseconds from blockette 1001
+    b1001 = blockettes[1001]
+    if (b1001 >= 0).any():
+        rows = np.flatnonzero(b1001 >= 0)
+        out[rows] += _read_bytes(records[rows], b1001[rows] + 5, 1)[:, 0].view(np.int8)
+    return out
+
+
+def _get_segments(seed_ids, start, end, period) -> np.ndarray:
+    """
+    Return a bool array which is True where a new segment starts.
+
+    Records are contiguous if they share a seed id and sampling rate and
+    the next record starts within half a sample of the expected time.
+    """
+    same_id = seed_ids[1:] == seed_ids[:-1]
+    same_rate = np.abs(1 - period[1:] / period[:-1]) < 0.0001
+    close = np.abs(start[1:] - (end[:-1] + period[:-1])) <= period[:-1] / 2
+    return np.concatenate([[True], ~(same_id & same_rate & close)])
+
+
+def _decode_seed_id(seed_id: np.void) -> tuple:
+    """ Decode the station, location, channel, network bytes into NSLC. """
+    raw = bytes(seed_id).decode()
+    sta, loc, cha, net = raw[:5], raw[5:7], raw[7:10], raw[10:12]
+    return net.strip(), sta.strip(), loc.strip(), cha.strip()
+
+
+def _iter_record_windows(path, size: int, reclen: int, window_bytes: int):
+    """
+    Yield memory maps of consecutive windows of whole records in a file.
+
+    Each window is unmapped once the next is requested, so the memory used
+    does not depend on the size of the file.
+    """
+    step = max(window_bytes // reclen, 1) * reclen
+    for offset in range(0, size, step):
+        length = min(step, size - offset)
+        window = np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=length)
+        yield window.reshape(-1, reclen)
+
+
+def _scan_record_times(records: np.ndarray, byteorder: str, first_blockettes: list):
+    """
+    Scan a 2D array of records, return (seed_id, start, end, period) of each.
+
+    Times are in us, as in libmseed. A ValueError is raised if any record is
+    not supported by the scanner.
+    """
+    reclen = records.shape[1]
+    headers = np.ndarray(
+        shape=(len(records),),
+        dtype=_header_dtype(byteorder),
+        buffer=records,
+        strides=(reclen,),
+    )
+    blockettes = _scan_blockettes(records, headers, byteorder, first_blockettes)
+    period = _get_sampling_periods(headers)
+    samples = headers["samples"].astype(np.int64)
+    exponents = _read_bytes(records, blockettes[1000] + 6, 1)[:, 0]
+    if (
+        not set(np.unique(headers["quality"]).tobytes()) <= set(_VALID_QUALITY)
+        or (blockettes[1000] < 0).any()
+        or (blockettes[100] >= 0).any()
+        or (2 ** exponents.astype(np.int64) != reclen).any()
+        or not np.isfinite(period).all()
+        or (samples <= 0).any()
+    ):
+        raise ValueError("found records which cannot be scanned")
+    start = _get_starttimes(records, headers, blockettes)
+    end = start + np.round((samples - 1) * period).astype(np.int64)
+    return headers["seed_id"], start, end, period
+
+
+def _scan_records(records: np.ndarray, byteorder: str, first_blockettes: list):
+    """
+    Scan a 2D array of records, return the contiguous runs of records.
+
+    Runs are returned as arrays of (seed_id, start, end, period), grouped by
+    seed id in file order. The arrays are copies so records can be unmapped.
+    """
+    return _get_runs(*_scan_record_times(records, byteorder, first_blockettes))
+
+
+def _get_runs(seed_ids, start, end, period):
+    """
+    Group records (or runs of records) by seed id, keeping file order like
+    libmseed, then merge contiguous ones.
+    """
+    if not (seed_ids == seed_ids[0]).all():
+        order = np.argsort(seed_ids, kind="mergesort")
+        seed_ids, start, end = seed_ids[order], start[order], end[order]
+        period = period[order]
+    firsts = np.flatnonzero(_get_segments(seed_ids, start, end, period))
+    lasts = np.append(firsts[1:] - 1, len(seed_ids) - 1)
+    return seed_ids[firsts], start[firsts], end[lasts], period[firsts]
+
+
+def _read_layout(mseed_object) -> tuple:
+    """
+    Read (size, record length, byte order, first record blockettes) of a file.
+
+    A ValueError is raised if the file does not have fixed length records
+    described by blockette 1000.
+    """
+    size = os.path.getsize(mseed_object)
+    with open(mseed_object, "rb") as fi:
+        first = np.frombuffer(fi.read(4096), dtype=np.uint8)
+    if len(first) < 128:
+        raise ValueError(f"{mseed_object} is too small to be miniSEED")
+    byteorder = _get_byteorder(first)
+    first_blockettes = _first_record_blockettes(first, byteorder)
+    b1000 = [offset for kind, offset in first_blockettes if kind == 1000]
+    if not b1000:
+        raise ValueError(f"first record of {mseed_object} has no blockette 1000")
+    reclen = 2 ** int(first[b1000[0] + 6])
+    if reclen < 128 or size % reclen:
+        raise ValueError(f"{mseed_object} does not have fixed length records")
+    return size, reclen, byteorder, first_blockettes
+
+
+def summarize_mseed_headers(mseed_object, window_bytes=_WINDOW_BYTES):
+    """
+    Get a summary of an mseed file by scanning its record headers with NumPy.
+
+    The file is memory mapped window_bytes at a time so memory use does not
+    grow with file size. Only fixed length records with blockette 1000 are
+    supported. A ValueError is raised for other files, see
+    summarize_mseed_auto.
+    """
+    size, reclen, byteorder, first_blockettes = _read_layout(mseed_object)
+    windows = _iter_record_windows(mseed_object, size, reclen, window_bytes)
+    runs = [_scan_records(x, byteorder, first_blockettes) for x in windows]
+    if len(runs) > 1:  # merge runs which span windows
+        runs = [_get_runs(*(np.concatenate(x) for x in zip(*runs)))]
+    out = []
+    for seed_id, start, end, period in zip(*runs[0]):
+        net, sta, loc, cha = _decode_seed_id(seed_id)
+        out.append(
+            {
+                "network": net,
+                "station": sta,
+                "location": loc,
+                "channel": cha,
+                "path": mseed_object,
+                "starttime": int(start) * 1_000,
+                "endtime": int(end) * 1_000,
+                "sampling_period": int(period) * 1_000,
+            }
+        )
+    return out
+
+
+def summarize_mseed_blocks(
+    mseed_object, records_per_block: int, window_bytes=_WINDOW_BYTES
+) -> pd.DataFrame:
+    """
+    Get the byte range and time range of each block of records in a file.
+
+    Blocks are records_per_block consecutive records; the time range of each
+    covers all the samples of its records padded by one sampling period, so
+    reads trimmed to the nearest sample find every record they need. Times
+    are int64 ns. The same files as summarize_mseed_headers are supported.
+    """
+    size, reclen, byteorder, first_blockettes = _read_layout(mseed_object)
+    block_bytes = reclen * records_per_block
+    window_bytes = max(window_bytes // block_bytes, 1) * block_bytes
+    offset, out = 0, []
+    for records in _iter_record_windows(mseed_object, size, reclen, window_bytes):
+        _, start, end, period = _scan_record_times(records, byteorder, first_blockettes)
+        period = np.ceil(period).astype(np.int64)
+        firsts = np.arange(0, len(records), records_per_block)
+        counts = np.diff(np.append(firsts, len(records)))
+        block = pd.DataFrame(
+            {
+                "offset": offset + firsts * reclen,
+                "nbytes": counts * reclen,
+                "starttime": np.minimum.reduceat(start - period, firsts) * 1_000,
+                "endtime": np.maximum.reduceat(end + period, firsts) * 1_000,
+            }
+        )
+        out.append(block)
+        offset += records.nbytes
+    return pd.concat(out, ignore_index=True)
+
+
+def summarize_mseed_auto(mseed_object):
+    """
+    Summarize an mseed file with libmseed or the NumPy header scanner.
+
+    The scanner has a larger fixed cost than libmseed but a smaller cost per
+    record, so it is used for files of at least _MIN_SCAN_BYTES. libmseed is
+    also used for files the scanner does not support.
+    """
+    if os.path.getsize(mseed_object) >= _MIN_SCAN_BYTES:
+        try:
+            return summarize_mseed_headers(mseed_object)
+        except (ValueError, IndexError):
+            pass
+    return summarize_mseed(mseed_object)
@@ -9,6 +9,7 @@ from typing import Optional, Sequence, Mapping, Collection, Iterable, Union
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import is_categorical_dtype
 
 import obspy
 from obsplus.constants import (
@@ -250,12 +251,44 @@ def get_seed_id_series(df: pd.DataFrame, null_codes=NULL_SEED_CODES) -> pd.Serie
     >>> out = get_seed_id_series(df)
     """
     assert set(NSLC).issubset(df.columns), f"dataframe must have columns {NSLC}"
+    if all(is_categorical_dtype(df[x]) for x in NSLC):
+        return _get_categorical_seed_id_series(df, null_codes)
     replace_dict = {x: "" for x in null_codes}
     nslc = df[list(NSLC)].astype(str).replace(replace_dict)
     net, sta, loc, chan = [nslc[x] for x in NSLC]
     return net + "." + sta + "." + loc + "." + chan
 
 
+def _get_categorical_seed_id_series(df: pd.DataFrame, null_codes) -> pd.Series:
+    """
+    Create a seed_id series from categorical NSLC columns.
+
+    The seed ids are only assembled for each unique combination of codes,
+    the result is then expanded to the length of the dataframe.
+    """
+    # categories are compared as str, so None and nan match "None" and "nan"
+    null_codes = [str(x) for x in null_codes]
+    key = np.zeros(len(df), dtype=np.int64)
+    code_strs = []
+    for col in NSLC:
+        cat = df[col].cat
+        # the extra (last) entry is used for null values which have a code of -1
+        strs = np.array(list(cat.categories.astype(str)) + [""], dtype=object)
+        strs[np.isin(strs, null_codes)] = ""
+        code_strs.append(strs)
+        codes = cat.codes.values.astype(np.int64)
+        codes[codes < 0] = len(strs) - 1
+        key = key * len(strs) + codes
+    inverse, unique_keys = pd.factorize(key)
+    # unravel the unique keys back into codes for each column
+    seed_ids = np.full(len(unique_keys), "", dtype=object)
+    for num, strs in enumerate(reversed(code_strs)):
+        unique_keys, codes = np.divmod(unique_keys, len(strs))
+        sep = "." if num else ""
+        seed_ids = strs[codes] + sep + seed_ids
+    return pd.Series(seed_ids[inverse], index=df.index)
+
+
 def filter_index(
     index: pd.DataFrame,
     network: Optional = None,
@@ -340,7 +373,15 @@ def filter_df(df: pd.DataFrame, **kwargs) -> np.array:
     bool_index = np.ones(len(df), dtype=bool)
     # filter on non-collection queries
     for key, val in flat_query.items():
-        if isinstance(val, str):
+        if isinstance(val, str) and is_categorical_dtype(df[key]):
+            # only match unique values, then expand to rows using codes
+            cat = df[key].cat
+            regex = get_regex(val)
+            matches = np.append(cat.categories.astype(str).str.match(regex), False)
+            # null values have a code of -1 which selects the appended False
+            new = matches[cat.codes.values]
+            bool_index = np.logical_and(bool_index, new)
+        elif isinstance(val, str):
             regex = get_regex(val)
             new = df[key].str.match(regex).values
             bool_index = np.logical_and(bool_index, new)
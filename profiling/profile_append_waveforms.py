@@ -0,0 +1,70 @@
+"""
+Profile putting short streams into a long file, as real-time data arrive.
+
+Without append, put_waveforms reads the file, merges the new traces into it
+and rewrites all of it, so each put costs more as the file grows. With
+append=True the new records are written to the end of the file and only
+their rows are added to the index; consolidate merges them later.
+
+Ten seconds of three 100 Hz channels are put into a file which already has
+num_hours of them. The mean time of a put, and the time to consolidate the
+file after the appends, are reported.
+
+Usage:
+    python profiling/profile_append_waveforms.py [num_hours] [num_puts]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+
+def make_stream(start, seconds):
+    """ Return seconds of three 100 Hz channels starting at start (s). """
+    rand = np.random.RandomState(13)
+    traces = []
+    for channel in ["HHE", "HHN", "HHZ"]:
+        data = rand.randint(-1000, 1000, seconds * 100).astype(np.int32)
+        header = dict(network="UU", station="DAY", channel=channel)
+        header.update(sampling_rate=100, starttime=obspy.UTCDateTime(start))
+        traces.append(obspy.Trace(data, header=header))
+    return obspy.Stream(traces)
+
+
+def time_puts(path: Path, num_hours, num_puts, append):
+    """ Return the mean time of a put and the time to consolidate. """
+    kwargs = dict(name_structure="{network}_{station}", path_structure="")
+    bank = obsplus.WaveBank(path, **kwargs)
+    bank.put_waveforms(make_stream(0, num_hours * 3600))
+    start = num_hours * 3600
+    streams = [make_stream(start + x * 10, 10) for x in range(num_puts)]
+    t1 = time.perf_counter()
+    for st in streams:
+        bank.put_waveforms(st, append=append)
+    duration = (time.perf_counter() - t1) / num_puts
+    t1 = time.perf_counter()
+    bank.consolidate()
+    return duration, time.perf_counter() - t1
+
+
+def main(num_hours=12, num_puts=30):
+    """ Print the mean time of a put with and without append. """
+    print(f"{num_puts} puts of 10 s into a file of {num_hours} hours")
+    print(f"{'append':>6} {'put (ms)':>9} {'consolidate (s)':>16}")
+    for append in [False, True]:
+        path = Path(tempfile.mkdtemp())
+        try:
+            duration, consolidate = time_puts(path, num_hours, num_puts, append)
+        finally:
+            shutil.rmtree(path)
+        print(f"{str(append):>6} {duration * 1000:9.2f} {consolidate:16.3f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,74 @@
+"""
+Profile binning the coverage of many channels over years.
+
+WaveBank.get_coverage finds the fraction of each bin covered by the
+coverage intervals of each channel with one vectorized search of the bin
+edges. This times that step for synthetic coverage of many channels with
+random outages, compared to looping over channels and intervals.
+
+Usage:
+    python profiling/profile_binned_coverage.py [num_channels] [num_years]
+"""
+import sys
+import time
+
+import numpy as np
+
+from obsplus.utils.bank import _binned_coverage
+
+HOUR = 3600 * 1_000_000_000
+
+
+def make_coverage(num_channels, num_years, outages_per_year=50):
+    """ Return codes, starts and ends of coverage with random outages. """
+    rand = np.random.RandomState(42)
+    total = num_years * 365 * 24 * HOUR
+    codes, starts, ends = [], [], []
+    for code in range(num_channels):
+        num = outages_per_year * num_years
+        outage_starts = np.sort(rand.randint(0, total, num))
+        outage_ends = outage_starts + rand.randint(HOUR // 60, 48 * HOUR, num)
+        # coverage is the time between the (merged) outages
+        outage_ends = np.maximum.accumulate(outage_ends)
+        keep = np.r_[True, outage_starts[1:] > outage_ends[:-1]]
+        cov_starts = np.r_[0, outage_ends[keep]]
+        cov_ends = np.r_[outage_starts[keep], total]
+        valid = cov_ends > cov_starts
+        codes.append(np.full(valid.sum(), code))
+        starts.append(cov_starts[valid])
+        ends.append(cov_ends[valid])
+    return np.concatenate(codes), np.concatenate(starts), np.concatenate(ends)
+
+
+def loop_coverage(codes, starts, ends, edges):
+    """ Bin the coverage with a loop over channels and intervals. """
+    out = np.zeros((codes.max() + 1, len(edges) - 1))
+    for code, start, end in zip(codes, starts, ends):
+        first = max(np.searchsorted(edges, start, side="right") - 1, 0)
+        last = np.searchsorted(edges, end, side="left")
+        for num in range(first, min(last, len(edges) - 1)):
+            overlap = min(end, edges[num + 1]) - max(start, edges[num])
+            out[code, num] += max(overlap, 0)
+    return out / np.diff(edges)
+
+
+def main(num_channels=1000, num_years=2):
+    """ Print the time to bin the coverage into days and hours. """
+    codes, starts, ends = make_coverage(num_channels, num_years)
+    total = num_years * 365 * 24 * HOUR
+    print(f"{num_channels} channels, {len(codes)} coverage intervals")
+    print(f"{'bins':>6} {'vectorized (s)':>15} {'loop (s)':>9}")
+    for name, size in [("days", 24 * HOUR), ("hours", HOUR)]:
+        edges = np.arange(0, total + 1, size)
+        t1 = time.perf_counter()
+        out = _binned_coverage(codes, starts, ends, edges)
+        vector_time = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        expected = loop_coverage(codes, starts, ends, edges)
+        loop_time = time.perf_counter() - t1
+        assert np.allclose(out, expected)
+        print(f"{name:>6} {vector_time:15.3f} {loop_time:9.3f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
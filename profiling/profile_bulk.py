@@ -0,0 +1,74 @@
+"""
+Profile WaveBank.get_waveforms_bulk with many short requests.
+
+The bulk requests are joined to the index at once, each file is read once
+and the output is assembled from the decoded traces. The same requests made
+one at a time with get_waveforms are timed for comparison.
+
+Usage:
+    python profiling/profile_bulk.py [num_requests]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+DURATION = 10  # seconds of data per request
+
+
+def make_bank(path: Path, num_hours=6, num_channels=3, sampling_rate=100.0):
+    """ Write hour long files for a few channels. """
+    rand = np.random.RandomState(42)
+    samples = int(3600 * sampling_rate)
+    for hour in range(num_hours):
+        for num in range(num_channels):
+            data = rand.randint(-1000, 1000, samples).astype(np.int32)
+            tr = obspy.Trace(data=data)
+            tr.stats.update(dict(network="UU", station="TEST", channel=f"HH{num}"))
+            tr.stats.update(dict(starttime=obspy.UTCDateTime(hour * 3600)))
+            tr.stats.sampling_rate = sampling_rate
+            tr.write(str(path / f"{hour}_{num}.mseed"), "mseed", encoding="STEIM2")
+
+
+def make_bulk(num_requests, num_hours=6, num_channels=3):
+    """ Return bulk requests for random channels and times. """
+    rand = np.random.RandomState(13)
+    starts = rand.uniform(0, num_hours * 3600 - DURATION, num_requests)
+    channels = rand.randint(0, num_channels, num_requests)
+    out = []
+    for start, cha in zip(starts, channels):
+        t1 = obspy.UTCDateTime(start)
+        out.append(("UU", "TEST", "", f"HH{cha}", t1, t1 + DURATION))
+    return out
+
+
+def main(num_requests=500):
+    """ Print the time to get the requests in bulk and one at a time. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path)
+        bank = obsplus.WaveBank(path).update_index()
+        bulk = make_bulk(num_requests)
+        bank.read_index()  # warm up the index cache
+        t1 = time.perf_counter()
+        bank.get_waveforms_bulk(bulk)
+        bulk_time = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        for net, sta, loc, cha, start, end in bulk:
+            bank.get_waveforms(net, sta, loc, cha, start, end)
+        single_time = time.perf_counter() - t1
+    finally:
+        shutil.rmtree(path)
+    print(f"{'requests':>8} {'bulk (s)':>9} {'single (s)':>11} {'speedup':>8}")
+    speedup = single_time / bulk_time
+    print(f"{num_requests:8d} {bulk_time:9.3f} {single_time:11.3f} {speedup:8.1f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
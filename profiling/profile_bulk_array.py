@@ -0,0 +1,83 @@
+"""
+Profile getting the samples of a bulk request as arrays.
+
+get_waveforms_array copies the decoded samples of each request into one
+array. The same requests are also made with get_waveforms_bulk_split, which
+creates, merges and trims traces for each request, and the samples copied
+into an array of the same shape.
+
+Usage:
+    python profiling/profile_bulk_array.py [num_requests]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+DURATION = 10  # seconds of data per request
+
+
+def make_bank(path: Path, num_hours=6, num_channels=3, sampling_rate=100.0):
+    """ Write hour long files for a few channels. """
+    rand = np.random.RandomState(42)
+    samples = int(3600 * sampling_rate)
+    for hour in range(num_hours):
+        for num in range(num_channels):
+            data = rand.randint(-1000, 1000, samples).astype(np.int32)
+            tr = obspy.Trace(data=data)
+            tr.stats.update(dict(network="UU", station="TEST", channel=f"HH{num}"))
+            tr.stats.update(dict(starttime=obspy.UTCDateTime(hour * 3600)))
+            tr.stats.sampling_rate = sampling_rate
+            tr.write(str(path / f"{hour}_{num}.mseed"), "mseed", encoding="STEIM2")
+
+
+def make_bulk(num_requests, num_hours=6):
+    """ Return requests for all channels of the station at random times. """
+    rand = np.random.RandomState(13)
+    starts = rand.uniform(0, num_hours * 3600 - DURATION, num_requests)
+    out = []
+    for start in starts:
+        t1 = obspy.UTCDateTime(start)
+        out.append(("UU", "TEST", "", "HH?", t1, t1 + DURATION))
+    return out
+
+
+def streams_to_array(streams, num_samples):
+    """ Copy the samples of each stream into an array. """
+    out = np.full((len(streams), 3, num_samples), np.nan)
+    for num, st in enumerate(streams):
+        for chan, tr in enumerate(st):
+            out[num, chan, : len(tr.data)] = tr.data[:num_samples]
+    return out
+
+
+def main(num_requests=500):
+    """ Print the time to get the requests as arrays and as streams. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path)
+        bank = obsplus.WaveBank(path).update_index()
+        bulk = make_bulk(num_requests)
+        bank.read_index()  # warm up the index cache
+        t1 = time.perf_counter()
+        data, _, _ = bank.get_waveforms_array(bulk)
+        array_time = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        streams = bank.get_waveforms_bulk_split(bulk)
+        streams_to_array(streams, data.shape[-1])
+        stream_time = time.perf_counter() - t1
+    finally:
+        shutil.rmtree(path)
+    print(f"{'requests':>8} {'array (s)':>10} {'streams (s)':>12} {'speedup':>8}")
+    speedup = stream_time / array_time
+    print(f"{num_requests:8d} {array_time:10.3f} {stream_time:12.3f} {speedup:8.1f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
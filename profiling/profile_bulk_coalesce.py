@@ -0,0 +1,78 @@
+"""
+Profile bulk requests with many overlapping windows per channel.
+
+Pick windows cluster around events, so a bulk request has many overlapping
+windows on each channel. The windows of each file are coalesced into spans
+of windows separated by no more than gap_tolerance, and each span is read
+once. A very large tolerance reads each file once between its first and
+last window, a tolerance of 0 only merges overlapping windows.
+
+Usage:
+    python profiling/profile_bulk_coalesce.py [num_events]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+
+def make_bank(path: Path, num_channels=3, sampling_rate=100.0):
+    """ Write one day of data for a few channels, one file per channel. """
+    rand = np.random.RandomState(42)
+    samples = int(86_400 * sampling_rate)
+    for num in range(num_channels):
+        data = rand.randint(-1000, 1000, samples).astype(np.int32)
+        tr = obspy.Trace(data=data)
+        tr.stats.update(dict(network="UU", station="TEST", channel=f"HH{num}"))
+        tr.stats.sampling_rate = sampling_rate
+        tr.write(str(path / f"{num}.mseed"), "mseed", encoding="STEIM2")
+
+
+def make_bulk(num_events, picks_per_event=20, num_channels=3):
+    """ Return a few seconds around each pick of some random events. """
+    rand = np.random.RandomState(13)
+    out = []
+    for origin in rand.uniform(0, 86_000, num_events):
+        for pick in origin + rand.uniform(0, 30, picks_per_event):
+            t1 = obspy.UTCDateTime(pick) - 2
+            cha = f"HH{rand.randint(0, num_channels)}"
+            out.append(("UU", "TEST", "", cha, t1, t1 + 5))
+    return out
+
+
+def time_bulk(bank, bulk, **kwargs) -> float:
+    """ Return the time to get the bulk request. """
+    t1 = time.perf_counter()
+    bank.get_waveforms_bulk(bulk, **kwargs)
+    return time.perf_counter() - t1
+
+
+def main(num_events=10):
+    """ Print the time of bulk requests for a few gap tolerances. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path)
+        bank = obsplus.WaveBank(path).update_index()
+        bulk = make_bulk(num_events)
+        bank.read_index()  # warm up the index cache
+        t1 = time.perf_counter()
+        for net, sta, loc, cha, start, end in bulk:
+            bank.get_waveforms(net, sta, loc, cha, start, end)
+        single_time = time.perf_counter() - t1
+        print(f"{'gap_tolerance':>14} {'time (s)':>9}")
+        print(f"{'one by one':>14} {single_time:9.3f}")
+        for tolerance in [0, 60, 3600, 86_400]:
+            duration = time_bulk(bank, bulk, gap_tolerance=tolerance)
+            print(f"{tolerance:14d} {duration:9.3f}")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
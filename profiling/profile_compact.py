@@ -0,0 +1,72 @@
+"""
+Profile compacting an index written by many small updates.
+
+Each update appends a few rows to the index tables, as frequent
+put_waveforms calls do, which leaves the tables in many small chunks.
+compact_index rewrites them sorted by channel and time in one append and
+reports the size of the file and the time of a few queries before and after.
+
+The index rows of hour long files are written directly, without the files,
+so large indexes can be created quickly.
+
+Usage:
+    python profiling/profile_compact.py [num_updates] [rows_per_update]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import obsplus
+
+HOUR = 3600 * 1_000_000_000
+PERIOD = 10_000_000  # 100 Hz
+
+
+def make_rows(update, num_rows, num_channels=50):
+    """ Return index rows of hour long files written by one update. """
+    channels = np.arange(update * num_rows, (update + 1) * num_rows) % num_channels
+    hours = np.arange(update * num_rows, (update + 1) * num_rows) // num_channels
+    starts = hours * HOUR
+    return pd.DataFrame(
+        dict(
+            network="UU",
+            station=[f"S{x:04d}" for x in channels],
+            location="",
+            channel="HHZ",
+            starttime=starts,
+            endtime=starts + HOUR - PERIOD,
+            sampling_period=PERIOD,
+            path=[f"/S{x:04d}/{y}.mseed" for x, y in zip(channels, starts)],
+        )
+    )
+
+
+def main(num_updates=1000, rows_per_update=20):
+    """ Print the report of compacting a fragmented index. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        bank = obsplus.WaveBank(path)
+        for update in range(num_updates):
+            bank._write_update(make_rows(update, rows_per_update))
+        bank._write_update_time()
+        t1 = time.perf_counter()
+        report = bank.compact_index()
+        duration = time.perf_counter() - t1
+    finally:
+        shutil.rmtree(path)
+    print(f"{num_updates * rows_per_update} rows in {num_updates} updates")
+    print(f"compacted in {duration:.2f} s")
+    print(f"{'':>7} {'size (MB)':>10} {'query (s)':>10}")
+    for name in ["before", "after"]:
+        size = report[f"size_{name}"] / 1e6
+        latency = report[f"latency_{name}"]
+        print(f"{name:>7} {size:10.2f} {latency:10.4f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
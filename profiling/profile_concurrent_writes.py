@@ -0,0 +1,89 @@
+"""
+Profile reading an index while other processes write to it.
+
+Reader processes query the index of a bank in a loop while writer
+processes put small streams into it. Reads hold a shared lock of the index
+and writes an exclusive one only while they write to the file, so readers
+wait for a write to finish rather than failing and sleeping before trying
+again. The number of puts and reads, those which failed, and the mean and
+maximum time of a read are reported.
+
+Usage:
+    python profiling/profile_concurrent_writes.py [num_readers] [num_writers] [seconds]
+"""
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+
+def read(path, duration):
+    """ Read the index until duration has passed, return times and errors. """
+    bank = obsplus.WaveBank(path)
+    times, errors = [], 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        bank.clear_cache()  # so each read queries the file
+        t1 = time.perf_counter()
+        try:
+            bank.read_index(station="RJOB")
+        except Exception:
+            errors += 1
+        times.append(time.perf_counter() - t1)
+    return times, errors
+
+
+def write(path, duration, num):
+    """ Put streams until duration has passed, return puts and errors. """
+    bank = obsplus.WaveBank(path)
+    st = obspy.read()
+    end = time.perf_counter() + duration
+    count, errors = 0, 0
+    while time.perf_counter() < end:
+        for tr in st:
+            tr.stats.station = f"W{num}{count % 100:02d}"
+        try:
+            bank.put_waveforms(st)
+        except Exception:
+            errors += 1
+        count += 1
+    return count, errors
+
+
+def main(num_readers=4, num_writers=2, seconds=10):
+    """ Print the read times of readers running with writers. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        obspy.read().write(str(path / "default.mseed"), "mseed")
+        obsplus.WaveBank(path).update_index()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(num_readers + num_writers) as pool:
+            writers = [
+                pool.apply_async(write, (path, seconds, x)) for x in range(num_writers)
+            ]
+            readers = [
+                pool.apply_async(read, (path, seconds)) for _ in range(num_readers)
+            ]
+            puts = np.sum([x.get() for x in writers], axis=0)
+            results = [x.get() for x in readers]
+    finally:
+        shutil.rmtree(path)
+    times = np.concatenate([x[0] for x in results])
+    errors = sum(x[1] for x in results)
+    print(f"{num_readers} readers, {num_writers} writers")
+    header = ["puts", "errors", "reads", "errors", "mean (s)", "max (s)"]
+    print(" ".join(f"{x:>8}" for x in header))
+    row = [f"{x:8d}" for x in [puts[0], puts[1], len(times), errors]]
+    row += [f"{times.mean():8.4f}", f"{times.max():8.3f}"]
+    print(" ".join(row))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
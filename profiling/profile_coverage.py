@@ -0,0 +1,76 @@
+"""
+Profile gap and uptime reports from the coverage table.
+
+update_index keeps the merged time coverage of each channel in the index
+file. get_gaps_df and get_uptime_df read only that small table instead of
+the whole index followed by a groupby for each channel.
+
+Usage:
+    python profiling/profile_coverage.py [num_channels] [num_hours]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+import pandas as pd
+
+import obsplus
+from obsplus.constants import NSLC
+
+
+def make_bank(path: Path, num_channels, num_hours):
+    """ Write hour long files at 1 Hz for many channels, with a few gaps. """
+    rand = np.random.RandomState(42)
+    data = np.zeros(3600, dtype=np.int32)
+    for num in range(num_channels):
+        station = f"S{num:04d}"
+        # drop a random hour of some channels to create gaps
+        skip = rand.randint(0, num_hours * 4)
+        for hour in range(num_hours):
+            if hour == skip:
+                continue
+            header = dict(network="UU", station=station, channel="HHZ")
+            header["starttime"] = obspy.UTCDateTime(hour * 3600)
+            tr = obspy.Trace(data, header=header)
+            tr.write(str(path / f"{station}_{hour}.mseed"), "mseed")
+
+
+def uptime_from_index(bank):
+    """ Compute the uptime dataframe from the full index, as before. """
+    index = bank.read_index()
+    gro = index.groupby(list(NSLC), observed=True)
+    avail = pd.merge(gro.starttime.min().reset_index(), gro.endtime.max().reset_index())
+    gaps = bank._get_gaps_from_index()
+    if not gaps.empty:
+        gaps.groupby(list(NSLC), observed=True).gap_duration.sum()
+    return avail
+
+
+def main(num_channels=200, num_hours=24):
+    """ Print the time of uptime reports from the index and the coverage. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path, num_channels, num_hours)
+        bank = obsplus.WaveBank(path).update_index()
+        t1 = time.perf_counter()
+        uptime_from_index(bank)
+        index_time = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        bank.get_uptime_df()
+        coverage_time = time.perf_counter() - t1
+        with pd.HDFStore(bank.index_path, "r") as store:
+            num_coverage = len(bank._read_coverage_table(store))
+        num_rows = len(bank.read_index())
+    finally:
+        shutil.rmtree(path)
+    print(f"{'':>9} {'rows':>7} {'uptime (s)':>11}")
+    print(f"{'index':>9} {num_rows:7d} {index_time:11.3f}")
+    print(f"{'coverage':>9} {num_coverage:7d} {coverage_time:11.3f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,99 @@
+"""
+Profile finding gaps in the index of many channels.
+
+Gaps used to be found with a groupby apply, which sorts each channel and
+concatenates the results. Now all rows are sorted at once and a running
+maximum of the endtimes, restarted for each channel, finds every gap in one
+pass. Both are run on a synthetic index with a few random gaps per channel.
+
+Usage:
+    python profiling/profile_gaps.py [num_channels] [files_per_channel]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from obsplus.constants import NSLC
+from obsplus.utils.bank import _find_gaps
+
+HOUR = np.timedelta64(3600, "s")
+PERIOD = np.timedelta64(10, "ms")
+
+
+def make_index(num_channels, files_per_channel):
+    """ Return an index of hour long files with a few missing hours. """
+    rand = np.random.RandomState(42)
+    hours = np.tile(np.arange(files_per_channel), num_channels)
+    channels = np.repeat(np.arange(num_channels), files_per_channel)
+    keep = rand.uniform(size=len(hours)) > 0.05
+    hours, channels = hours[keep], channels[keep]
+    starts = np.datetime64("2020-01-01", "ns") + hours * HOUR
+    df = pd.DataFrame(
+        dict(
+            network="UU",
+            station=pd.Categorical([f"S{x:05d}" for x in channels]),
+            location="",
+            channel="HHZ",
+            starttime=starts,
+            endtime=starts + HOUR - PERIOD,
+            sampling_period=PERIOD,
+            path=[f"{x}_{y}.mseed" for x, y in zip(channels, hours)],
+        )
+    )
+    for col in NSLC:
+        df[col] = df[col].astype("category")
+    return df
+
+
+def gaps_with_apply(index):
+    """ Find the gaps with the groupby apply used before. """
+
+    def _get_gap_dfs(df):
+        """ function to apply to each group of seed_id dataframes """
+        min_gap = 1.5 * df["sampling_period"].iloc[0]
+        dd = (
+            df.drop_duplicates()
+            .sort_values(["starttime", "endtime"])
+            .reset_index(drop=True)
+        )
+        shifted_starttimes = dd.starttime.shift(-1)
+        cum_max = np.maximum.accumulate(dd["endtime"] + min_gap)
+        gap_index = cum_max < shifted_starttimes
+        df = dd[gap_index]
+        df["starttime"] = dd.endtime[gap_index]
+        df["endtime"] = shifted_starttimes[gap_index]
+        df["gap_duration"] = df["endtime"] - df["starttime"]
+        return df
+
+    group_names = list(NSLC) + ["sampling_period"]
+    group = index.groupby(group_names, as_index=False, observed=True)
+    return group.apply(_get_gap_dfs).reset_index(drop=True)
+
+
+def gaps_vectorized(index):
+    """ Find the gaps with one sort of the index. """
+    key = list(NSLC) + ["sampling_period"]
+    periods = index["sampling_period"].values.astype(np.int64)
+    return _find_gaps(index, key, (periods * 1.5).astype(np.int64))
+
+
+def main(num_channels=10_000, files_per_channel=24):
+    """ Print the time to find the gaps with apply and vectorized. """
+    index = make_index(num_channels, files_per_channel)
+    pd.options.mode.chained_assignment = None
+    t1 = time.perf_counter()
+    expected = gaps_with_apply(index)
+    apply_time = time.perf_counter() - t1
+    t1 = time.perf_counter()
+    gaps = gaps_vectorized(index)
+    vector_time = time.perf_counter() - t1
+    assert len(gaps) == len(expected)
+    print(f"{'channels':>8} {'rows':>8} {'gaps':>6} {'apply (s)':>10} {'numpy (s)':>9}")
+    row = f"{num_channels:8d} {len(index):8d} {len(gaps):6d}"
+    print(f"{row} {apply_time:10.3f} {vector_time:9.3f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,116 @@
+"""
+Profile HDF5 queries of a large WaveBank index.
+
+The index table has completely sorted indexes on the time and NSLC columns.
+Queries only use the conditions they need: no where at all for the whole
+index, and station codes are selected in the query rather than after the
+rows are read. Each query is compared to the three clause time query used
+before, which selects all stations.
+
+The index rows of hour long files are written directly, without the files,
+so large indexes can be created quickly.
+
+Usage:
+    python profiling/profile_index_queries.py [num_channels] [num_days]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import obsplus
+from obsplus.utils.bank import _plan_index_query
+
+HOUR = 3600 * 1_000_000_000
+PERIOD = 10_000_000  # 100 Hz
+
+
+def make_rows(num_channels, first_hour, num_hours):
+    """ Return index rows of hour long files for some channels and hours. """
+    hours = np.arange(first_hour, first_hour + num_hours)
+    channels = np.repeat(np.arange(num_channels), num_hours)
+    starts = np.tile(hours, num_channels) * HOUR
+    return pd.DataFrame(
+        dict(
+            network="UU",
+            station=[f"S{x:04d}" for x in channels],
+            location="",
+            channel="HHZ",
+            starttime=starts,
+            endtime=starts + HOUR - PERIOD,
+            sampling_period=PERIOD,
+            path=[f"/S{x:04d}/{y}.mseed" for x, y in zip(channels, starts)],
+        )
+    )
+
+
+def make_bank(path: Path, num_channels, num_days):
+    """ Write the index of a bank with a week of files per update. """
+    bank = obsplus.WaveBank(path)
+    for day in range(0, num_days, 7):
+        num_hours = min(7, num_days - day) * 24
+        bank._write_update(make_rows(num_channels, day * 24, num_hours))
+    bank._write_update_time()
+    return bank
+
+
+def old_query(t1, t2):
+    """ The query used for all reads before, t1 and t2 include the buffer. """
+    return (
+        f"(starttime>{t1:d} & starttime<{t2:d}) | "
+        f"((endtime>{t1:d} & endtime<{t2:d}) | "
+        f"(starttime<{t1:d} & endtime>{t2:d}))"
+    )
+
+
+def time_select(bank, where, repeat=5):
+    """ Return the mean time to select rows of the index table. """
+    with pd.HDFStore(bank.index_path, "r") as store:
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            df = store.select(bank._index_node, where=where)
+        return (time.perf_counter() - t1) / repeat, len(df)
+
+
+def main(num_channels=100, num_days=365):
+    """ Print the time of a few queries with the old and planned wheres. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        bank = make_bank(path, num_channels, num_days)
+        with pd.HDFStore(bank.index_path, "r") as store:
+            station = bank._read_categories(store, "station").get_loc("S0042")
+            num_rows = store.get_storer(bank._index_node).nrows
+        t1 = (num_days // 2) * 24 * HOUR
+        t2 = t1 + HOUR
+        small, large = np.iinfo(np.int64).min // 2, np.iinfo(np.int64).max // 2
+        queries = [
+            ("whole index", old_query(small, large), None),
+            ("one hour", old_query(t1, t2), _plan_index_query(t1, t2)),
+            (
+                "one hour, one station",
+                old_query(t1, t2),
+                _plan_index_query(t1, t2, {"station": [station]}),
+            ),
+            (
+                "one station",
+                old_query(small, large),
+                _plan_index_query(codes={"station": [station]}),
+            ),
+        ]
+        print(f"{num_rows} rows")
+        print(f"{'query':>22} {'rows':>8} {'old (s)':>8} {'rows':>8} {'new (s)':>8}")
+        for name, old, new in queries:
+            old_time, old_rows = time_select(bank, old)
+            new_time, new_rows = time_select(bank, new)
+            row = f"{name:>22} {old_rows:8d} {old_time:8.3f}"
+            print(f"{row} {new_rows:8d} {new_time:8.3f}")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,109 @@
+"""
+Compare the libmseed and NumPy header scanning summarizers used for indexing.
+
+The scanner has a larger fixed cost per file, but a smaller cost per record,
+so it only pays off for files with more than a few hundred records;
+summarize_mseed_auto (used by WaveBank) picks between them by file size.
+
+The peak resident memory of summarizing one of the largest files is also
+reported; each summarizer runs in a fresh process so their peaks are not mixed.
+
+Usage:
+    python profiling/profile_mseed_summary.py [num_files]
+"""
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+from obsplus.utils.mseed import (
+    summarize_mseed,
+    summarize_mseed_headers,
+    summarize_mseed_auto,
+)
+
+# (name, number of samples, sampling rate, record length) of files to profile
+FILE_KINDS = [
+    ("small", 1_000, 1.0, 4096),
+    ("hour_100hz", 360_000, 100.0, 4096),
+    ("hour_512", 360_000, 100.0, 512),
+    ("day_512", 8_640_000, 100.0, 512),
+]
+SUMMARIZERS = dict(
+    libmseed=summarize_mseed, numpy=summarize_mseed_headers, auto=summarize_mseed_auto
+)
+
+
+def make_files(path: Path, num_files, samples, sampling_rate, reclen):
+    """ Write num_files three-channel mseed files, return their paths. """
+    rand = np.random.RandomState(42)
+    paths = []
+    for num in range(num_files):
+        st = obspy.Stream()
+        for channel in ["HHE", "HHN", "HHZ"]:
+            data = rand.randint(-1000, 1000, samples).astype(np.int32)
+            tr = obspy.Trace(data=data)
+            tr.stats.update(dict(network="UU", station=f"S{num}", channel=channel))
+            tr.stats.sampling_rate = sampling_rate
+            st.append(tr)
+        paths.append(str(path / f"{num}.mseed"))
+        st.write(paths[-1], "mseed", encoding="STEIM2", reclen=reclen)
+    return paths
+
+
+def time_summarizer(func, paths, repeat=5) -> float:
+    """ Return the best time (s) to summarize all paths. """
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        for path in paths:
+            func(path)
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+
+def _peak_rss_growth(func, path, queue):
+    """ Put the growth of peak resident memory (MB) from summarizing path. """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(path)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((after - before) / 1024)  # ru_maxrss is in kB on linux
+
+
+def peak_rss_growth(func, path) -> float:
+    """ Return peak resident memory growth (MB) of func(path) in a new process. """
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_peak_rss_growth, args=(func, path, queue))
+    proc.start()
+    out = queue.get()
+    proc.join()
+    return out
+
+
+def main(num_files=50):
+    """ Print time per file (ms) and peak memory (MB) for each summarizer. """
+    print(f"{'files':>12}" + "".join(f"{x:>10}" for x in SUMMARIZERS))
+    for name, samples, sampling_rate, reclen in FILE_KINDS:
+        path = Path(tempfile.mkdtemp())
+        # only use a few of the large files
+        count = max(1, num_files * 10_000 // max(samples, 10_000) // 10)
+        try:
+            paths = make_files(path, count, samples, sampling_rate, reclen)
+            times = [time_summarizer(x, paths) / count for x in SUMMARIZERS.values()]
+            rss = [peak_rss_growth(x, paths[0]) for x in SUMMARIZERS.values()]
+            file_size = Path(paths[0]).stat().st_size / 1024 ** 2
+        finally:
+            shutil.rmtree(path)
+        print(f"{name:>12}" + "".join(f"{x * 1000:10.3f}" for x in times) + " ms")
+        print(f"{file_size:10.1f}MB" + "".join(f"{x:10.1f}" for x in rss) + " MB")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,80 @@
+"""
+Profile short waveform requests against day long files.
+
+Without record blocks each request reads (and scans the headers of) every
+record in the files it touches. With records_per_block set, only the blocks
+of records which overlap the requested times are read.
+
+Usage:
+    python profiling/profile_partial_reads.py [num_requests]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+DURATION = 10  # seconds of data per request
+
+
+def make_bank(path: Path, num_channels=3, sampling_rate=100.0):
+    """ Write one day of data for a few channels, one file per channel. """
+    rand = np.random.RandomState(42)
+    samples = int(86_400 * sampling_rate)
+    for num in range(num_channels):
+        data = rand.randint(-1000, 1000, samples).astype(np.int32)
+        tr = obspy.Trace(data=data)
+        tr.stats.update(dict(network="UU", station="TEST", channel=f"HH{num}"))
+        tr.stats.sampling_rate = sampling_rate
+        tr.write(str(path / f"{num}.mseed"), "mseed", encoding="STEIM2", reclen=512)
+
+
+def time_requests(bank, starttimes) -> float:
+    """ Return the mean time (s) of requests starting at starttimes. """
+    t1 = time.perf_counter()
+    for starttime in starttimes:
+        bank.get_waveforms(starttime=starttime, endtime=starttime + DURATION)
+    return (time.perf_counter() - t1) / len(starttimes)
+
+
+def bytes_read(bank, starttimes) -> float:
+    """ Return the mean number of bytes read by each request. """
+    out = []
+    for starttime in starttimes:
+        index = bank.read_index(starttime=starttime, endtime=starttime + DURATION)
+        blocks = bank._read_record_blocks(
+            index["path"].unique(), starttime, starttime + DURATION
+        )
+        out.append(sum(x[:, 1].sum() for x in blocks.values()))
+    return float(np.mean(out))
+
+
+def main(num_requests=50):
+    """ Print the mean latency of short requests with and without blocks. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path)
+        rand = np.random.RandomState(13)
+        offsets = rand.uniform(0, 86_400 - DURATION, num_requests)
+        starttimes = [obspy.UTCDateTime(0) + x for x in offsets]
+        full = obsplus.WaveBank(path).update_index()
+        full_time = time_requests(full, starttimes)
+        (path / full.index_name).unlink()
+        blocks = obsplus.WaveBank(path, records_per_block=32).update_index()
+        block_time = time_requests(blocks, starttimes)
+        size = sum(x.stat().st_size for x in path.glob("*.mseed"))
+        block_bytes = bytes_read(blocks, starttimes)
+    finally:
+        shutil.rmtree(path)
+    print(f"{'':>8} {'ms/request':>11} {'kB read':>9}")
+    print(f"{'full':>8} {full_time * 1000:11.2f} {size / 1024:9.0f}")
+    print(f"{'blocks':>8} {block_time * 1000:11.2f} {block_bytes / 1024:9.0f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,95 @@
+"""
+Profile queries and updates of an index partitioned by month.
+
+A single index table is searched whole by every query which misses the
+index cache, and every update appends to it. With index_partition="month"
+the rows are kept in one table per month so a query for a short window
+only searches the tables which overlap it, and an update of recent files
+only writes to the table of the current month.
+
+The index rows of hour long files are written directly, without the files,
+so large indexes can be created quickly.
+
+Usage:
+    python profiling/profile_partition.py [num_channels] [num_days]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import obsplus
+
+HOUR = 3600 * 1_000_000_000
+PERIOD = 10_000_000  # 100 Hz
+
+
+def make_rows(num_channels, first_hour, num_hours):
+    """ Return index rows of hour long files for some channels and hours. """
+    hours = np.arange(first_hour, first_hour + num_hours)
+    channels = np.repeat(np.arange(num_channels), num_hours)
+    starts = np.tile(hours, num_channels) * HOUR
+    return pd.DataFrame(
+        dict(
+            network="UU",
+            station=[f"S{x:04d}" for x in channels],
+            location="",
+            channel="HHZ",
+            starttime=starts,
+            endtime=starts + HOUR - PERIOD,
+            sampling_period=PERIOD,
+            path=[f"/S{x:04d}/{y}.mseed" for x, y in zip(channels, starts)],
+        )
+    )
+
+
+def make_bank(path: Path, num_channels, num_days, **kwargs):
+    """ Write the index of a bank with a week of files per update. """
+    bank = obsplus.WaveBank(path, **kwargs)
+    for day in range(0, num_days, 7):
+        num_hours = min(7, num_days - day) * 24
+        bank._write_update(make_rows(num_channels, day * 24, num_hours))
+    bank._write_update_time()
+    return bank
+
+
+def time_queries(bank, num_days, num_queries=20):
+    """ Return the mean time of reading the index for one hour, uncached. """
+    rand = np.random.RandomState(13)
+    starts = rand.choice(num_days * 24, num_queries, replace=False) * HOUR
+    bank.read_index(starttime=0, endtime=1)  # read the lookup tables once
+    t1 = time.perf_counter()
+    for start in starts:  # distinct hours, so none are in the index cache
+        bank.read_index(starttime=start / 1e9, endtime=(start + HOUR) / 1e9)
+    return (time.perf_counter() - t1) / num_queries
+
+
+def time_update(bank, num_channels, num_days):
+    """ Return the time to add a day of files at the end of the bank. """
+    t1 = time.perf_counter()
+    bank._write_update(make_rows(num_channels, num_days * 24, 24))
+    return time.perf_counter() - t1
+
+
+def main(num_channels=50, num_days=365):
+    """ Print the query and update times of single and partitioned indexes. """
+    num_rows = num_channels * num_days * 24
+    print(f"{num_channels} channels, {num_days} days, {num_rows} rows")
+    print(f"{'partition':>10} {'query (s)':>10} {'update (s)':>11}")
+    for partition in [None, "month"]:
+        path = Path(tempfile.mkdtemp())
+        try:
+            bank = make_bank(path, num_channels, num_days, index_partition=partition)
+            query_time = time_queries(bank, num_days)
+            update_time = time_update(bank, num_channels, num_days)
+        finally:
+            shutil.rmtree(path)
+        print(f"{str(partition):>10} {query_time:10.3f} {update_time:11.3f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Profile putting streams into a bank which already has many files.
+
+put_waveforms used to call update_index for the files it wrote, which read
+each of them back to summarize the traces and stat the files of the bank.
+The rows are now made from the traces in memory and appended to the index
+in one write.
+
+Each call puts an hour of three 100 Hz channels into a new file of a bank
+with a file of each of num_stations stations. The mean time of a put is
+reported.
+
+Usage:
+    python profiling/profile_put_waveforms.py [num_stations] [num_puts]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+
+def make_stream(station, hour):
+    """ Return an hour of three 100 Hz channels of a station. """
+    rand = np.random.RandomState(13)
+    traces = []
+    for channel in ["HHE", "HHN", "HHZ"]:
+        data = rand.randint(-1000, 1000, 360_000).astype(np.int32)
+        header = dict(network="UU", station=station, channel=channel)
+        header.update(sampling_rate=100, starttime=obspy.UTCDateTime(hour * 3600))
+        traces.append(obspy.Trace(data, header=header))
+    return obspy.Stream(traces)
+
+
+def make_bank(path: Path, num_stations):
+    """ Put an hour of each station into a bank. """
+    bank = obsplus.WaveBank(path)
+    for num in range(num_stations):
+        bank.put_waveforms(make_stream(f"S{num:04d}", 0), update_index=False)
+    return bank.update_index()
+
+
+def main(num_stations=100, num_puts=30):
+    """ Print the mean time of putting a stream into the bank. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        bank = make_bank(path, num_stations)
+        streams = [make_stream("NEW", x) for x in range(num_puts)]
+        t1 = time.perf_counter()
+        for st in streams:
+            bank.put_waveforms(st)
+        duration = (time.perf_counter() - t1) / num_puts
+        assert len(bank.read_index(station="NEW")) == 3 * num_puts
+    finally:
+        shutil.rmtree(path)
+    print(f"{num_stations} files, {num_puts} puts")
+    print(f"{'put (ms)':>9}")
+    print(f"{duration * 1000:9.2f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,107 @@
+"""
+Profile the memory and startup time of worker processes reading a bank.
+
+Each worker process creates its own WaveBank and reads the index of a few
+random hours, as the workers of a query service do. Without a shared index
+each worker opens the index and reads the lookup tables (eg all paths) into
+its own memory on the first query. With shared_index=True the workers map
+the arrays published by update_index, so the pages are shared and only the
+selected rows are decoded into each worker's memory.
+
+The private (dirty) memory a worker gained and the time of its first
+query are reported. The index rows of hour long files are written directly,
+without the files, so large indexes can be created quickly.
+
+Usage:
+    python profiling/profile_shared_index.py [num_workers] [num_channels] [num_days]
+"""
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import obsplus
+
+HOUR = 3600 * 1_000_000_000
+PERIOD = 10_000_000  # 100 Hz
+
+
+def make_rows(num_channels, first_hour, num_hours):
+    """ Return index rows of hour long files for some channels and hours. """
+    hours = np.arange(first_hour, first_hour + num_hours)
+    channels = np.repeat(np.arange(num_channels), num_hours)
+    starts = np.tile(hours, num_channels) * HOUR
+    return pd.DataFrame(
+        dict(
+            network="UU",
+            station=[f"S{x:04d}" for x in channels],
+            location="",
+            channel="HHZ",
+            starttime=starts,
+            endtime=starts + HOUR - PERIOD,
+            sampling_period=PERIOD,
+            path=[f"/S{x:04d}/{y}.mseed" for x, y in zip(channels, starts)],
+        )
+    )
+
+
+def make_bank(path: Path, num_channels, num_days):
+    """ Write the index of a bank with a week of files per update. """
+    bank = obsplus.WaveBank(path)
+    for day in range(0, num_days, 7):
+        num_hours = min(7, num_days - day) * 24
+        bank._write_update(make_rows(num_channels, day * 24, num_hours))
+    bank._write_update_time()
+    return bank
+
+
+def private_memory():
+    """ Return the memory written by only this process (linux) in bytes. """
+    with open("/proc/self/smaps_rollup") as fi:
+        for line in fi:
+            if line.startswith("Private_Dirty:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def work(args):
+    """ Query the bank in a worker, return memory gained and first query time. """
+    path, shared, num_days = args
+    memory = private_memory()
+    rand = np.random.RandomState(13)
+    starts = rand.choice(num_days * 24, 20, replace=False) * HOUR
+    t1 = time.perf_counter()
+    bank = obsplus.WaveBank(path, shared_index=shared)
+    for num, start in enumerate(starts):
+        bank.read_index(starttime=start / 1e9, endtime=(start + HOUR) / 1e9)
+        if not num:
+            startup = time.perf_counter() - t1
+    return private_memory() - memory, startup
+
+
+def main(num_workers=8, num_channels=50, num_days=365):
+    """ Print the memory and startup time of workers with each index. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path, num_channels, num_days)
+        obsplus.WaveBank(path, shared_index=True)._shared_index.publish(full=True)
+        print(f"{num_workers} workers, {num_channels * num_days * 24} rows")
+        print(f"{'shared':>6} {'memory (MB)':>12} {'startup (s)':>12}")
+        context = multiprocessing.get_context("fork")
+        for shared in [False, True]:
+            with context.Pool(num_workers) as pool:
+                args = [(path, shared, num_days)] * num_workers
+                out = np.array(pool.map(work, args, chunksize=1))
+            memory, startup = out[:, 0].mean() / 1e6, out[:, 1].mean()
+            print(f"{str(shared):>6} {memory:12.1f} {startup:12.3f}")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,91 @@
+"""
+Profile many small requests of a bank with and without an index snapshot.
+
+Without a snapshot every query which misses the index cache opens the index
+file, and last_updated and the metadata open it again. With snapshot=True
+the file is loaded into memory once and each request only stats it.
+
+Each request reads the index of one station for a random hour (so none are
+in the index cache) and the update time of the bank, as a service checking
+for new data would. The index rows of hour long files are written directly,
+without the files, so large indexes can be created quickly.
+
+Usage:
+    python profiling/profile_snapshot.py [num_channels] [num_days]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import obsplus
+
+HOUR = 3600 * 1_000_000_000
+PERIOD = 10_000_000  # 100 Hz
+
+
+def make_rows(num_channels, first_hour, num_hours):
+    """ Return index rows of hour long files for some channels and hours. """
+    hours = np.arange(first_hour, first_hour + num_hours)
+    channels = np.repeat(np.arange(num_channels), num_hours)
+    starts = np.tile(hours, num_channels) * HOUR
+    return pd.DataFrame(
+        dict(
+            network="UU",
+            station=[f"S{x:04d}" for x in channels],
+            location="",
+            channel="HHZ",
+            starttime=starts,
+            endtime=starts + HOUR - PERIOD,
+            sampling_period=PERIOD,
+            path=[f"/S{x:04d}/{y}.mseed" for x, y in zip(channels, starts)],
+        )
+    )
+
+
+def make_bank(path: Path, num_channels, num_days):
+    """ Write the index of a bank with a week of files per update. """
+    bank = obsplus.WaveBank(path)
+    for day in range(0, num_days, 7):
+        num_hours = min(7, num_days - day) * 24
+        bank._write_update(make_rows(num_channels, day * 24, num_hours))
+    bank._write_update_time()
+    return bank
+
+
+def time_requests(bank, num_channels, num_days, num_requests=200):
+    """ Return the mean time of a request for an hour of one station. """
+    rand = np.random.RandomState(13)
+    starts = rand.choice(num_days * 24, num_requests, replace=False) * HOUR
+    stations = rand.randint(0, num_channels, num_requests)
+    bank.read_index(starttime=0, endtime=1)  # load the lookup tables once
+    t1 = time.perf_counter()
+    for start, station in zip(starts, stations):
+        bank.last_updated_timestamp
+        kwargs = dict(starttime=start / 1e9, endtime=(start + HOUR) / 1e9)
+        bank.read_index(station=f"S{station:04d}", **kwargs)
+    return (time.perf_counter() - t1) / num_requests
+
+
+def main(num_channels=50, num_days=90):
+    """ Print the mean request time with and without a snapshot. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path, num_channels, num_days)
+        size = (path / ".index.h5").stat().st_size / 1e6
+        print(f"{num_channels * num_days * 24} rows, index of {size:.1f} MB")
+        print(f"{'snapshot':>8} {'request (ms)':>13}")
+        for snapshot in [False, True]:
+            bank = obsplus.WaveBank(path, snapshot=snapshot)
+            duration = time_requests(bank, num_channels, num_days)
+            print(f"{str(snapshot):>8} {duration * 1000:13.2f}")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
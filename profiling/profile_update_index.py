@@ -0,0 +1,72 @@
+"""
+Profile the latency of a no-op WaveBank.update_index as the bank grows.
+
+A no-op update (no files have changed since the last update) used to walk and
+stat every file in the archive. With prune_directories=True only directories
+whose mtime changed are listed.
+
+Usage:
+    python profiling/profile_update_index.py [max_files]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+FILES_PER_DIRECTORY = 50
+
+
+def make_archive(path: Path, num_files: int):
+    """ Write num_files small mseed files into nested day directories. """
+    tr = obspy.Trace(data=np.arange(100, dtype=np.int32))
+    tr.stats.network, tr.stats.station, tr.stats.channel = "UU", "TEST", "HHZ"
+    old = time.time() - 3600
+    for num in range(num_files):
+        directory = path / f"{num // 1000:03d}" / f"{num // FILES_PER_DIRECTORY:05d}"
+        directory.mkdir(parents=True, exist_ok=True)
+        tr.stats.starttime = obspy.UTCDateTime(2020, 1, 1) + num * 100
+        file_path = directory / f"{num}.mseed"
+        tr.write(str(file_path), "mseed")
+        os.utime(file_path, (old, old))
+    for root, _, _ in os.walk(path):
+        os.utime(root, (old, old))
+
+
+def time_noop_update(path: Path, prune: bool, repeat: int = 5) -> float:
+    """ Index the archive then return the median no-op update time. """
+    bank = obsplus.WaveBank(path, prune_directories=prune)
+    bank.update_index(bar=False)
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        bank.update_index(bar=False)
+        times.append(time.perf_counter() - t1)
+    return float(np.median(times))
+
+
+def main(max_files=20_000):
+    """ Print no-op update latency for several bank sizes. """
+    print(f"{'files':>8} {'full walk (s)':>14} {'pruned (s)':>11} {'speedup':>8}")
+    num_files = 1000
+    while num_files <= max_files:
+        path = Path(tempfile.mkdtemp())
+        try:
+            make_archive(path, num_files)
+            full = time_noop_update(path, prune=False)
+            os.remove(path / obsplus.WaveBank.index_name)
+            pruned = time_noop_update(path, prune=True)
+        finally:
+            shutil.rmtree(path)
+        print(f"{num_files:8d} {full:14.4f} {pruned:11.4f} {full / pruned:8.1f}")
+        num_files *= 4
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
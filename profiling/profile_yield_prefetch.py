@@ -0,0 +1,63 @@
+"""
+Profile WaveBank.yield_waveforms with and without prefetching.
+
+The consumer filters each yielded stream, standing in for downstream
+processing. Without prefetching the consumer waits for every stream to be
+read; with prefetching reads overlap the consumer's work.
+
+Usage:
+    python profiling/profile_yield_prefetch.py [num_hours]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+
+def make_bank(path: Path, num_hours, num_channels=3, sampling_rate=100.0):
+    """ Write hour long files for a few channels. """
+    rand = np.random.RandomState(42)
+    samples = int(3600 * sampling_rate)
+    for hour in range(num_hours):
+        for num in range(num_channels):
+            data = rand.randint(-1000, 1000, samples).astype(np.int32)
+            tr = obspy.Trace(data=data)
+            tr.stats.update(dict(network="UU", station="TEST", channel=f"HH{num}"))
+            tr.stats.update(dict(starttime=obspy.UTCDateTime(hour * 3600)))
+            tr.stats.sampling_rate = sampling_rate
+            tr.write(str(path / f"{hour}_{num}.mseed"), "mseed", encoding="STEIM2")
+
+
+def consume(bank, prefetch):
+    """ Return total time and time spent waiting for streams. """
+    wait_times = []
+    t1 = time.perf_counter()
+    kwargs = dict(duration=600, overlap=10, prefetch=prefetch, wait_times=wait_times)
+    for st in bank.yield_waveforms(**kwargs):
+        st.detrend("linear").filter("bandpass", freqmin=1, freqmax=10)
+    return time.perf_counter() - t1, sum(wait_times)
+
+
+def main(num_hours=6):
+    """ Print total and waiting time for a few prefetch values. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path, num_hours)
+        bank = obsplus.WaveBank(path).update_index()
+        consume(bank, 0)  # warm up the index cache and file system
+        print(f"{'prefetch':>8} {'total (s)':>10} {'waiting (s)':>12}")
+        for prefetch in [0, 1, 2, 4]:
+            total, waiting = consume(bank, prefetch)
+            print(f"{prefetch:8d} {total:10.3f} {waiting:12.3f}")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,61 @@
+"""
+Profile yielding short chunks from long files with WaveBank.yield_waveforms.
+
+By default each chunk reads the files it overlaps, so a day long file is
+read once per chunk. With read_once=True each file is read once and the
+chunks are sliced out of the decoded traces.
+
+Usage:
+    python profiling/profile_yield_read_once.py [num_days]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import obspy
+
+import obsplus
+
+
+def make_bank(path: Path, num_days, num_channels=3, sampling_rate=100.0):
+    """ Write day long files for a few channels. """
+    rand = np.random.RandomState(42)
+    samples = int(86_400 * sampling_rate)
+    for day in range(num_days):
+        for num in range(num_channels):
+            data = rand.randint(-1000, 1000, samples).astype(np.int32)
+            tr = obspy.Trace(data=data)
+            tr.stats.update(dict(network="UU", station="TEST", channel=f"HH{num}"))
+            tr.stats.update(dict(starttime=obspy.UTCDateTime(day * 86_400)))
+            tr.stats.sampling_rate = sampling_rate
+            tr.write(str(path / f"{day}_{num}.mseed"), "mseed", encoding="STEIM2")
+
+
+def time_yield(bank, **kwargs) -> float:
+    """ Return the time to yield all hour long chunks with 1 minute overlap. """
+    t1 = time.perf_counter()
+    for _ in bank.yield_waveforms(duration=3600, overlap=60, **kwargs):
+        pass
+    return time.perf_counter() - t1
+
+
+def main(num_days=1):
+    """ Print the time to yield hourly chunks with and without read_once. """
+    path = Path(tempfile.mkdtemp())
+    try:
+        make_bank(path, num_days)
+        bank = obsplus.WaveBank(path).update_index()
+        time_yield(bank, read_once=True)  # warm up the index cache
+        default = time_yield(bank)
+        read_once = time_yield(bank, read_once=True)
+    finally:
+        shutil.rmtree(path)
+    print(f"{'default (s)':>12} {'read_once (s)':>14} {'speedup':>8}")
+    print(f"{default:12.3f} {read_once:14.3f} {default / read_once:8.1f}")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
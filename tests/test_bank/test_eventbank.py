@@ -605,6 +605,38 @@ class TestPutEvents:
             ebank.put_events(event)
 
 
+class TestPruneDirectories:
+    """ Tests for skipping unchanged directories when updating the index. """
+
+    @pytest.fixture
+    def prune_ebank(self, tmp_path):
+        """ Create a bank which prunes unchanged directories. """
+        bank = EventBank(tmp_path, prune_directories=True)
+        return bank.put_events(obspy.read_events()[:2]).update_index()
+
+    def test_manifest_stored(self, prune_ebank):
+        """ The directory manifest should be stored in the index. """
+        manifest = prune_ebank._read_directory_manifest()
+        assert "." in set(manifest["path"])
+        assert manifest["file_count"].sum() == 2
+
+    def test_read_manifest_without_index(self, tmp_path):
+        """ Reading the manifest of an unindexed bank shouldn't create the index. """
+        bank = EventBank(tmp_path, prune_directories=True)
+        bank.index_path.unlink()
+        assert bank._read_directory_manifest() is None
+        assert not bank.index_path.exists()
+
+    def test_new_event_indexed(self, prune_ebank):
+        """ Events added outside the bank should still be indexed. """
+        event = obspy.read_events()[2]
+        path = prune_ebank.bank_path / "new" / "event.xml"
+        path.parent.mkdir()
+        event.write(str(path), "quakeml")
+        df = prune_ebank.update_index().read_index()
+        assert str(event.resource_id) in set(df["event_id"])
+
+
 class TestProgressBar:
     """ Tests for the progress bar functionality of banks. """
 
@@ -3,10 +3,13 @@ import functools
 import glob
 import os
 import pathlib
+import pickle
 import shutil
 import tempfile
+import threading
 import time
 import types
+from collections import defaultdict
 from concurrent.futures import as_completed, ProcessPoolExecutor
 from contextlib import suppress
 
@@ -63,6 +66,26 @@ def strip_processing(st: obspy.Stream) -> obspy.Stream:
     return st
 
 
+def station_stream(station: str) -> obspy.Stream:
+    """ Return the default stream with its station code replaced. """
+    st = obspy.read()
+    for tr in st:
+        tr.stats.station = station
+    return st
+
+
+def write_traces(path, name="{num}.mseed") -> Path:
+    """
+    Write each trace of the default stream to its own file, name is formatted
+    with the number of the trace and may include directories.
+    """
+    for num, tr in enumerate(obspy.read()):
+        file = Path(path) / name.format(num=num)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tr.write(str(file), "mseed")
+    return Path(path)
+
+
 # ------------------------------ Fixtures
 
 
@@ -101,6 +124,23 @@ def empty_bank(tmp_path):
     return WaveBank(tmp_path)
 
 
+@pytest.fixture
+def trace_dir(tmp_path):
+    """ Return a directory with a file for each trace of the default stream. """
+    return write_traces(tmp_path)
+
+
+@pytest.fixture
+def split_bank(tmp_path):
+    """ Create a bank with the default stream split into short files. """
+    st = obspy.read()
+    t1 = st[0].stats.starttime
+    for num, start in enumerate(range(0, 30, 6)):
+        sub = st.slice(t1 + start, t1 + start + 6 - st[0].stats.delta)
+        sub.write(str(tmp_path / f"{num}.mseed"), "mseed")
+    return WaveBank(tmp_path).update_index()
+
+
 # ------------------------------ Tests
 
 
@@ -226,6 +266,23 @@ class TestBankBasics:
         assert bank2._index_version == obsplus.__version__
         assert Path(bank2.index_path).exists()
 
+    def test_old_schema_recreates_index(self, default_wbank, monkeypatch):
+        """
+        An index created with an older schema version should be deleted and
+        re-created.
+        """
+        bank = default_wbank
+        monkeypatch.setattr(WaveBank, "_schema_version", 0)
+        os.remove(bank.index_path)
+        bank.update_index()
+        monkeypatch.undo()
+        with pytest.warns(UserWarning):
+            bank2 = WaveBank(bank.bank_path)
+        assert not Path(bank2.index_path).exists()
+        bank2.update_index()
+        schema_version = bank2._read_metadata()["schema_version"].iloc[0]
+        assert schema_version == WaveBank._schema_version
+
     def test_empty_bank_raises(self, tmpdir):
         """
         Test that an empty bank can be inited, but that an error is
@@ -286,6 +343,40 @@ class TestBankBasics:
         expected_order = expected_order_1 + expected_order_2
         assert [str(x) for x in df.columns] == list(expected_order)
 
+    def test_nslc_and_path_are_categorical(self, ta_bank_index):
+        """ The NSLC and path columns should be returned as categoricals. """
+        df = ta_bank_index.read_index()
+        for col in list(NSLC) + ["path"]:
+            assert isinstance(df[col].dtype, pd.CategoricalDtype)
+
+    def test_nslc_and_path_stored_as_codes(self, ta_bank_index):
+        """ The index table should only store integer codes for str columns. """
+        bank = ta_bank_index
+        with pd.HDFStore(bank.index_path, "r") as store:
+            raw = store.select(bank._index_node)
+            paths = store.select(bank._category_node("path"))
+        for col in list(NSLC) + ["path"]:
+            assert np.issubdtype(raw[col].dtype, np.integer)
+        # each file should have one entry in the path lookup table
+        assert len(paths) == len(raw["path"].unique())
+        assert paths.is_unique
+
+    def test_categories_extended_on_update(self, tmp_path):
+        """ New codes should be added without changing existing rows. """
+        bank = WaveBank(tmp_path)
+        bank.put_waveforms(obspy.read())
+        df1 = bank.read_index()
+        st = obspy.read()
+        for tr in st:
+            tr.stats.network = "UU"
+        bank.put_waveforms(st)
+        df2 = bank.read_index()
+        assert len(df2) == len(df1) + len(st)
+        assert set(df2["network"]) == {"BW", "UU"}
+        # the original rows should be unchanged
+        old = df2[df2["network"] == "BW"].astype(str).reset_index(drop=True)
+        assert old.equals(df1.astype(str).reset_index(drop=True))
+
 
 class TestEmptyBank:
     """ tests for graceful handling of empty WaveBanks"""
@@ -399,6 +490,712 @@ class TestReadIndex:
         assert df1.equals(df2)
 
 
+class TestIndexQueries:
+    """ Tests for the HDF5 queries used to read the index. """
+
+    @pytest.fixture
+    def bank(self, tmp_path):
+        """ Create a bank with a few stations. """
+        for station in ["RJOB", "RJOC", "BOB"]:
+            st = station_stream(station)
+            st.write(str(tmp_path / f"{station}.mseed"), "mseed")
+        return WaveBank(tmp_path).update_index()
+
+    @pytest.fixture
+    def wheres(self, monkeypatch):
+        """ Record the where argument of each select of the index table. """
+        out = []
+        select = pd.HDFStore.select
+
+        def _select(self, key, where=None, *args, **kwargs):
+            if key.endswith("/index"):
+                out.append(where)
+            return select(self, key, where, *args, **kwargs)
+
+        monkeypatch.setattr(pd.HDFStore, "select", _select)
+        return out
+
+    def test_csi_indexes(self, bank):
+        """ The time and NSLC columns should have completely sorted indexes. """
+        with pd.HDFStore(bank.index_path, "r") as store:
+            table = store.get_storer(bank._index_node).table
+            for col in list(NSLC) + ["starttime", "endtime"]:
+                assert table.colinstances[col].index.is_csi
+            assert not table.colinstances["sampling_period"].is_indexed
+        # the indexes should still be complete after an update
+        st = station_stream("NEW")
+        bank.put_waveforms(st)
+        with pd.HDFStore(bank.index_path, "r") as store:
+            table = store.get_storer(bank._index_node).table
+            assert table.colinstances["station"].index.is_csi
+            assert table.colinstances["station"].index.nelements == 12
+
+    def test_unbounded_query_has_no_where(self, bank, wheres):
+        """ Reading the whole index shouldn't use a query. """
+        assert len(bank.read_index()) == 9
+        assert wheres == [None]
+
+    def test_one_sided_query(self, bank, wheres):
+        """ A query with only a starttime needs one condition. """
+        bank.read_index(starttime=obspy.read()[0].stats.starttime + 10)
+        assert wheres[0].count("starttime") == 0
+        assert "endtime >=" in wheres[0]
+
+    def test_nslc_pushed_into_query(self, bank, wheres):
+        """ Station codes and patterns should be selected in the query. """
+        df = bank.read_index(station="RJOB")
+        assert set(df["station"]) == {"RJOB"} and len(df) == 3
+        assert "station ==" in wheres[0]
+        df = bank.read_index(station="RJO?", channel="*Z")
+        assert set(df["station"]) == {"RJOB", "RJOC"} and len(df) == 2
+        assert "channel ==" in wheres[1] and "|" in wheres[1]
+
+    def test_no_matching_codes(self, bank):
+        """ A pattern which matches no codes should give an empty index. """
+        df = bank.read_index(station="NOPE*")
+        assert df.empty
+        assert list(df.columns) == list(bank.read_index().columns)
+
+    def test_cache_with_filters(self, bank, wheres):
+        """ An unfiltered index can be used for any filter, not the reverse. """
+        bank.read_index(station="BOB")
+        bank.read_index(station="RJOB")
+        assert len(wheres) == 2
+        bank.read_index()
+        bank.read_index(station="RJOC")
+        assert len(wheres) == 3
+
+    def test_new_codes_found(self, bank):
+        """ Codes added by another bank instance should be found. """
+        bank.read_index(station="BOB")
+        st = station_stream("NEW")
+        WaveBank(bank.bank_path).put_waveforms(st)
+        assert len(bank.read_index(station="NEW", starttime=st[0].stats.starttime)) == 3
+
+
+class TestUpdateIndexChunks:
+    """ Tests for indexing files in chunks and resuming interrupted updates. """
+
+    @pytest.fixture
+    def chunked_bank(self, trace_dir, monkeypatch):
+        """ Return a bank which flushes the summary of each file. """
+        bank = WaveBank(trace_dir)
+        monkeypatch.setattr(bank, "_max_files_in_memory", 1)
+        return bank
+
+    def test_each_chunk_written(self, chunked_bank, monkeypatch):
+        """ Each chunk should be written to the index separately. """
+        write_update = chunked_bank._write_update
+        wrapped = count_calls(chunked_bank, write_update, "write_count")
+        monkeypatch.setattr(chunked_bank, "_write_update", wrapped)
+        df = chunked_bank.update_index().read_index()
+        assert chunked_bank.write_count == 3
+        assert len(df) == 3
+
+    def test_resume_interrupted_update(self, chunked_bank, monkeypatch):
+        """ An interrupted update should resume without re-reading files. """
+        index_files = chunked_bank._index_files
+        calls = []
+
+        def _index_files(files, *args, **kwargs):
+            calls.extend(files)
+            if len(calls) > 2:
+                raise KeyboardInterrupt
+            return index_files(files, *args, **kwargs)
+
+        monkeypatch.setattr(chunked_bank, "_index_files", _index_files)
+        with pytest.raises(KeyboardInterrupt):
+            chunked_bank.update_index()
+        monkeypatch.setattr(chunked_bank, "_index_files", index_files)
+        # the timestamp is only written when the update finishes
+        assert chunked_bank.last_updated_timestamp is None
+        summarized = []
+        summarize = obsplus.bank.wavebank._summarize_wave_file
+
+        def _summarize(path, *args, **kwargs):
+            summarized.append(path)
+            return summarize(path, *args, **kwargs)
+
+        monkeypatch.setattr(obsplus.bank.wavebank, "_summarize_wave_file", _summarize)
+        df = chunked_bank.update_index().read_index()
+        assert len(summarized) == 1
+        assert len(df) == 3 and not df.duplicated().any()
+
+    def test_readers_see_whole_updates(self, chunked_bank, trace_dir, monkeypatch):
+        """ Other banks should read the old index until an update finishes. """
+        chunked_bank.update_index()
+        station_stream("BOB").write(str(trace_dir / "bob.mseed"), "mseed")
+        write_traces(trace_dir, name="bob_{num}.mseed")
+        index_files = chunked_bank._index_files
+        seen = []
+
+        def _index_files(*args, **kwargs):
+            out = index_files(*args, **kwargs)
+            seen.append(len(WaveBank(trace_dir).read_index()))
+            return out
+
+        monkeypatch.setattr(chunked_bank, "_index_files", _index_files)
+        chunked_bank.update_index()
+        assert seen == [3] * 4
+        assert len(WaveBank(trace_dir).read_index()) == 9
+        assert not list(trace_dir.glob("*.update"))
+
+    def test_stale_staged_copy_removed(self, chunked_bank, trace_dir, monkeypatch):
+        """ A copy staged from an index since replaced should be removed. """
+        chunked_bank.update_index()
+        write_traces(trace_dir, name="new_{num}.mseed")
+        index_files = chunked_bank._index_files
+
+        def _index_files(*args, **kwargs):
+            index_files(*args, **kwargs)
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(chunked_bank, "_index_files", _index_files)
+        with pytest.raises(KeyboardInterrupt):
+            chunked_bank.update_index()
+        monkeypatch.setattr(chunked_bank, "_index_files", index_files)
+        (staged,) = trace_dir.glob("*.update")
+        assert len(chunked_bank.read_index()) == 3  # the copy isn't read
+        chunked_bank.compact_index()  # replaces the index the copy was made from
+        df = chunked_bank.update_index().read_index()
+        assert not staged.exists()
+        assert len(df) == 6 and not df.duplicated().any()
+
+    def test_labels_read_once(self, chunked_bank, trace_dir, monkeypatch):
+        """ The row labels should be read once per update, not per chunk. """
+        chunked_bank.update_index()
+        time.sleep(0.01)
+        for num, tr in enumerate(obspy.read()):  # rewrite each file, shifted
+            tr.stats.starttime += 100
+            tr.write(str(trace_dir / f"{num}.mseed"), "mseed")
+        reads = []
+        select_column = pd.HDFStore.select_column
+
+        def _select_column(store, key, column, *args, **kwargs):
+            if column == "index" and "start" not in kwargs:  # the whole column
+                reads.append(key)
+            return select_column(store, key, column, *args, **kwargs)
+
+        monkeypatch.setattr(pd.HDFStore, "select_column", _select_column)
+        df = chunked_bank.update_index().read_index()
+        assert len(reads) == 1
+        assert len(df) == 3
+        assert (df["starttime"] > to_datetime64(obspy.read()[0].stats.endtime)).all()
+
+
+class TestRemovedAndRewrittenFiles:
+    """ Tests for purging index rows of files which were removed or changed. """
+
+    @pytest.fixture
+    def bank(self, tmp_path):
+        """ Create a bank with one file per trace in separate directories. """
+        return WaveBank(write_traces(tmp_path, "dir_{num}/data.mseed")).update_index()
+
+    def test_file_manifest(self, bank):
+        """ Each file should have a row range in the file manifest. """
+        with pd.HDFStore(bank.index_path, "r") as store:
+            manifest = bank._read_file_manifest(store)
+        assert len(manifest) == 3
+        assert ((manifest["stop"] - manifest["start"]) == 1).all()
+        assert (manifest["size"] > 0).all()
+
+    def test_removed_file(self, bank):
+        """ Rows of removed files should be dropped. """
+        os.remove(bank.bank_path / "dir_0" / "data.mseed")
+        df = bank.update_index().read_index()
+        assert len(df) == 2
+        assert "/dir_0/data.mseed" not in set(df["path"])
+
+    def test_removed_directory(self, bank):
+        """ Rows of files in a removed directory should be dropped. """
+        shutil.rmtree(bank.bank_path / "dir_1")
+        df = bank.update_index().read_index()
+        assert set(df["path"]) == {"/dir_0/data.mseed", "/dir_2/data.mseed"}
+
+    def test_rewritten_file(self, bank):
+        """ A rewritten file should have its rows replaced, not duplicated. """
+        path = bank.bank_path / "dir_2" / "data.mseed"
+        st = station_stream("BOB")
+        time.sleep(0.01)
+        st.write(str(path), "mseed")
+        df = bank.update_index().read_index()
+        sub = df[df["path"] == "/dir_2/data.mseed"]
+        assert len(df) == 5
+        assert set(sub["station"]) == {"BOB"} and len(sub) == 3
+
+    def test_reindexing_does_not_duplicate(self, bank):
+        """ Indexing the same files again should not duplicate rows. """
+        df1 = bank.read_index()
+        time.sleep(0.01)
+        for path in bank.bank_path.rglob("*.mseed"):
+            path.touch()
+        bank.update_index(paths=["dir_0", "dir_1"])
+        df2 = bank.read_index()
+        assert len(df1) == len(df2)
+        assert not df2.duplicated().any()
+
+
+class TestPruneDirectories:
+    """ Tests for skipping unchanged directories when updating the index. """
+
+    @staticmethod
+    def age_directories(path, seconds=100):
+        """ Set the mtime of all directories in path to seconds ago. """
+        old = time.time() - seconds
+        for root, _, _ in os.walk(path):
+            os.utime(root, (old, old))
+
+    @pytest.fixture
+    def prune_bank(self, tmp_path):
+        """ Create a bank which prunes unchanged directories. """
+        write_traces(tmp_path, "dir_{num}/sub/{num}.mseed")
+        self.age_directories(tmp_path)
+        return WaveBank(tmp_path, prune_directories=True).update_index()
+
+    def test_manifest_stored(self, prune_bank):
+        """ The directory manifest should be stored in the index. """
+        manifest = prune_bank._read_directory_manifest()
+        assert {"dir_0", "dir_0/sub", "dir_2/sub"}.issubset(set(manifest["path"]))
+        counts = manifest.set_index("path")["file_count"]
+        assert counts["dir_1/sub"] == 1
+
+    def test_noop_update_lists_only_root(self, prune_bank, monkeypatch):
+        """ Only the root (which holds the index) should be listed again. """
+        listed = []
+        scandir = os.scandir
+
+        def _scandir(path):
+            listed.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr(os, "scandir", _scandir)
+        prune_bank.update_index()
+        assert set(listed) == {str(prune_bank.bank_path)}
+
+    def test_new_file_indexed(self, prune_bank):
+        """ Files added to an existing directory should still be indexed. """
+        tr = obspy.read()[0]
+        tr.stats.station = "BOB"
+        path = prune_bank.bank_path / "dir_1" / "sub" / "new.mseed"
+        tr.write(str(path), "mseed")
+        df = prune_bank.update_index().read_index()
+        assert "BOB" in set(df["station"])
+        assert len(df) == 4
+
+
+class TestIndexPartition:
+    """ Tests for indexes with one table per month or year. """
+
+    days = [
+        "2017-01-15",
+        "2017-01-31T23:59:00",
+        "2017-02-15",
+        "2017-03-15",
+        "2018-06-01",
+    ]
+
+    @staticmethod
+    def write_day(path, day, station="RJOB"):
+        """ Write ten minutes of data for three channels starting on day. """
+        for channel in ["EHE", "EHN", "EHZ"]:
+            header = dict(network="BW", station=station, channel=channel)
+            header["starttime"] = UTC(day)
+            tr = obspy.Trace(np.arange(600, dtype=np.int32), header=header)
+            name = f"{station}_{channel}_{day.replace(':', '')}.mseed"
+            tr.write(str(path / name), "mseed")
+
+    @pytest.fixture
+    def bank_path(self, tmp_path):
+        """ Create a directory with data spread over a few months. """
+        for day in self.days:
+            self.write_day(tmp_path, day)
+        return tmp_path
+
+    @pytest.fixture
+    def bank(self, bank_path):
+        """ A bank with an index partitioned by month. """
+        return WaveBank(bank_path, index_partition="month").update_index()
+
+    @pytest.fixture
+    def single_bank(self, bank_path, tmp_path_factory):
+        """ A bank of the same files with a single index table. """
+        path = tmp_path_factory.mktemp("single")
+        for file in bank_path.glob("*.mseed"):
+            shutil.copy(file, path)
+        return WaveBank(path).update_index()
+
+    @pytest.fixture
+    def node_spy(self, monkeypatch):
+        """ Record the nodes selected from, appended to and removed from. """
+        nodes = defaultdict(list)
+        for name in ["select", "append", "remove"]:
+            method = getattr(pd.HDFStore, name)
+
+            def _spy(self, key, *args, _method=method, _name=name, **kwargs):
+                nodes[_name].append(key)
+                return _method(self, key, *args, **kwargs)
+
+            monkeypatch.setattr(pd.HDFStore, name, _spy)
+        return nodes
+
+    def assert_same_index(self, bank1, bank2, **kwargs):
+        """ The indexes of two banks should have the same rows. """
+        df1 = bank1.read_index(**kwargs).astype(str).sort_values(["path"])
+        df2 = bank2.read_index(**kwargs).astype(str).sort_values(["path"])
+        assert df1.reset_index(drop=True).equals(df2.reset_index(drop=True))
+
+    def test_shards(self, bank):
+        """ There should be one table for each month with data. """
+        with pd.HDFStore(bank.index_path, "r") as store:
+            shards = bank._read_shard_manifest(store)
+            nodes = bank._index_nodes(store)
+            assert bank._index_node not in store
+            assert [store.get_storer(x).nrows for x in nodes] == [6, 3, 3, 3]
+        assert nodes[0].endswith("m2017_01")
+        # the file which starts in January ends in February
+        assert shards["endtime"].iloc[0] > to_datetime64("2017-02-01").astype(int)
+
+    def test_same_as_single_table(self, bank, single_bank):
+        """ Queries should return the same rows as from a single table. """
+        self.assert_same_index(bank, single_bank)
+        for t1, t2 in [("2017-02-01", "2017-02-01T00:00:30"), ("2017-03-15", None)]:
+            kwargs = dict(starttime=t1, endtime=t2)
+            self.assert_same_index(bank, single_bank, **kwargs)
+        t1 = UTC("2017-03-15T00:05:00")
+        st1 = bank.get_waveforms(starttime=t1, endtime=t1 + 10)
+        st2 = single_bank.get_waveforms(starttime=t1, endtime=t1 + 10)
+        assert len(st1) == len(st2) == 3
+        assert all(np.all(x.data == y.data) for x, y in zip(st1, st2))
+
+    def test_query_reads_overlapping_shards(self, bank, node_spy):
+        """ Only the tables which overlap the query should be read. """
+        t1 = UTC("2017-02-15T00:01:00")
+        assert len(bank.read_index(starttime=t1, endtime=t1 + 10)) == 3
+        shards = {x for x in node_spy["select"] if "/shards/" in x}
+        assert shards == {bank._shard_node("month", 565)}  # February 2017
+
+    def test_update_touches_modified_shards(self, bank, node_spy):
+        """ Adding a file should only write the table of its month. """
+        self.write_day(bank.bank_path, "2017-03-20", station="BOB")
+        bank.update_index()
+        written = node_spy["append"] + node_spy["remove"]
+        shards = {x for x in written if "/shards/" in x}
+        assert shards == {bank._shard_node("month", 566)}  # March 2017
+        assert len(bank.read_index(station="BOB")) == 3
+
+    def test_removed_file(self, bank, single_bank):
+        """ Rows of removed files should be dropped from their table. """
+        for bank_ in [bank, single_bank]:
+            for path in bank_.bank_path.glob("*2017-02-15*"):
+                os.remove(path)
+            bank_.update_index()
+        self.assert_same_index(bank, single_bank)
+        assert len(bank.read_index(starttime="2017-02-10", endtime="2017-02-20")) == 0
+        gaps1, gaps2 = bank.get_gaps_df(), single_bank.get_gaps_df()
+        assert len(gaps1) == len(gaps2)
+
+    def test_changed_partition_rebuilds(self, bank):
+        """ A bank with a different partition should rebuild the index. """
+        expected = bank.read_index()
+        with pytest.warns(UserWarning):
+            year_bank = WaveBank(bank.bank_path, index_partition="year").update_index()
+        with pd.HDFStore(year_bank.index_path, "r") as store:
+            assert year_bank._read_partition(store) == "year"
+            assert len(year_bank._index_nodes(store)) == 2
+        assert len(year_bank.read_index()) == len(expected)
+        # a bank without a partition uses the layout of the index
+        assert len(WaveBank(bank.bank_path).update_index().read_index()) == 15
+
+    def test_bad_partition(self, bank_path):
+        """ Unsupported partitions should raise. """
+        with pytest.raises(ValueError):
+            WaveBank(bank_path, index_partition="week")
+
+
+class TestCompactIndex:
+    """ Tests for rewriting a fragmented index. """
+
+    t0 = UTC("2017-01-01")
+
+    @pytest.fixture(params=[None, "month"])
+    def bank(self, tmp_path, request):
+        """ Create a bank with many small updates and a removed file. """
+        bank = WaveBank(tmp_path, index_partition=request.param)
+        for hour in range(0, 24 * 60, 24 * 10):
+            for channel in ["EHZ", "EHN"]:
+                header = dict(network="BW", station="RJOB", channel=channel)
+                header["starttime"] = self.t0 + hour * 3600
+                tr = obspy.Trace(np.arange(100, dtype=np.int32), header=header)
+                tr.write(str(tmp_path / f"{hour}_{channel}.mseed"), "mseed")
+            bank.update_index()
+        # a file with three channels, and a file which is removed
+        obspy.read().write(str(tmp_path / "three.mseed"), "mseed")
+        bank.update_index()
+        os.remove(tmp_path / "240_EHZ.mseed")
+        return bank.update_index()
+
+    @pytest.fixture
+    def compacted(self, bank):
+        """ Compact the index, return the bank and the report. """
+        expected = bank.read_index().astype(str)
+        report = bank.compact_index()
+        return bank, report, expected
+
+    def read_tables(self, bank):
+        """ Read the raw index rows and the file manifest. """
+        with pd.HDFStore(bank.index_path, "r") as store:
+            df = bank._select_index(store)
+            files = bank._read_file_manifest(store)
+        return df, files
+
+    def test_same_index(self, compacted):
+        """ Compacting shouldn't change the index rows. """
+        bank, _, expected = compacted
+        df = bank.read_index().astype(str)
+        sort = ["path", "channel"]
+        df = df.sort_values(sort).reset_index(drop=True)
+        assert df.equals(expected.sort_values(sort).reset_index(drop=True))
+        assert len(bank.get_waveforms(station="RJOB")) == 14
+
+    def test_sorted_and_relabeled(self, compacted):
+        """ Rows should be sorted by channel and time with new labels. """
+        bank, _, _ = compacted
+        df, files = self.read_tables(bank)
+        assert list(df.index) == list(range(len(df)))
+        one_channel = df[~df.duplicated("path", keep=False)]
+        keys = one_channel[list(NSLC) + ["starttime"]]
+        if bank.index_partition is None:
+            assert keys.equals(keys.sort_values(list(keys.columns)))
+        # each file has the label range of its rows
+        for _, row in files.iterrows():
+            assert (df.loc[row["start"] : row["stop"] - 1, "path"] == row["path"]).all()
+        assert (files["stop"] - files["start"]).sum() == len(df)
+
+    def test_updates_after_compact(self, compacted):
+        """ Files should still be removed and added after compacting. """
+        bank, _, expected = compacted
+        os.remove(bank.bank_path / "three.mseed")
+        obspy.read()[:1].write(str(bank.bank_path / "one.mseed"), "mseed")
+        df = bank.update_index().read_index()
+        assert len(df) == len(expected) - 2
+        assert "/three.mseed" not in set(df["path"])
+        gaps = bank.get_gaps_df(station="RJOB")
+        assert len(gaps) == len(bank._get_gaps_from_index(station="RJOB"))
+
+    def test_report(self, compacted):
+        """ The sizes and query times should be reported. """
+        bank, report, _ = compacted
+        assert report["size_after"] == bank.index_path.stat().st_size
+        assert report["size_after"] < report["size_before"]
+        assert report["latency_before"] > 0 and report["latency_after"] > 0
+        assert not list(bank.bank_path.glob("*.compact"))
+
+    def test_indexes_rebuilt(self, compacted):
+        """ The index tables should have complete indexes. """
+        bank, _, _ = compacted
+        with pd.HDFStore(bank.index_path, "r") as store:
+            for node in bank._index_nodes(store):
+                table = store.get_storer(node).table
+                assert table.colinstances["starttime"].index.is_csi
+
+    def test_empty_bank(self, tmp_path):
+        """ An empty bank has nothing to compact. """
+        assert WaveBank(tmp_path).compact_index() == {}
+
+
+class TestIndexSnapshot:
+    """ Tests for banks which keep an in-memory copy of the index open. """
+
+    @pytest.fixture
+    def bank(self, trace_dir):
+        """ Create a bank of the default stream with a snapshot. """
+        WaveBank(trace_dir).update_index()
+        return WaveBank(trace_dir, snapshot=True)
+
+    @pytest.fixture
+    def opened(self, monkeypatch):
+        """ Record the paths of the HDF5 files opened. """
+        paths = []
+        method = pd.HDFStore.open
+
+        def _spy(self, *args, **kwargs):
+            paths.append(self._path)
+            return method(self, *args, **kwargs)
+
+        monkeypatch.setattr(pd.HDFStore, "open", _spy)
+        return paths
+
+    def test_same_as_plain_bank(self, bank):
+        """ The snapshot should return the same index and waveforms. """
+        plain = WaveBank(bank.bank_path)
+        assert bank.read_index().equals(plain.read_index())
+        t1 = UTC("2009-08-24T00:20:10")
+        st1 = bank.get_waveforms(starttime=t1, endtime=t1 + 5)
+        assert st1 == plain.get_waveforms(starttime=t1, endtime=t1 + 5)
+        assert bank.get_availability_df().equals(plain.get_availability_df())
+        assert bank.last_updated == plain.last_updated
+
+    def test_index_loaded_once(self, bank, opened):
+        """ Queries should not open the index file once it is loaded. """
+        bank.read_index()
+        opened.clear()
+        t1 = UTC("2009-08-24T00:20:10")
+        for num in range(5):
+            bank.read_index(starttime=t1 + num, endtime=t1 + num + 1)
+            bank.get_waveforms(channel="EHZ", starttime=t1, endtime=t1 + num + 1)
+            assert bank.last_updated_timestamp is not None
+        assert str(bank.index_path) not in opened
+        assert bank._snapshot.loads == 1
+
+    def test_refreshed_after_update(self, bank):
+        """ Updates by other banks should be seen by the snapshot. """
+        assert len(bank.read_index()) == 3
+        WaveBank(bank.bank_path).put_waveforms(station_stream("BOB"))
+        assert len(bank.read_index()) == 6
+        assert len(bank.get_waveforms(station="BOB")) == 3
+        assert bank._snapshot.loads == 2
+        assert bank.last_updated == WaveBank(bank.bank_path).last_updated
+
+    def test_not_refreshed_without_update(self, bank):
+        """ Writes which don't change the update time don't reload the index. """
+        expected = bank.read_index()
+        WaveBank(bank.bank_path).compact_index()
+        assert bank.read_index().equals(expected)
+        assert bank._snapshot.loads == 1
+
+    def test_own_updates(self, bank):
+        """ The bank itself should still be able to update the index. """
+        bank.read_index()
+        st = station_stream("BOB")
+        bank.put_waveforms(st)
+        assert len(bank.read_index(station="BOB")) == 3
+
+
+class TestSharedIndex:
+    """ Tests for banks which query memory-mapped copies of the index. """
+
+    @pytest.fixture
+    def bank(self, trace_dir):
+        """ Create a bank of the default stream with a shared index. """
+        WaveBank(trace_dir, records_per_block=1).update_index()
+        return WaveBank(trace_dir, shared_index=True).update_index()
+
+    def test_same_as_plain_bank(self, bank):
+        """ Queries should return the same rows as from the hdf5 index. """
+        plain = WaveBank(bank.bank_path)
+        t1 = UTC("2009-08-24T00:20:10")
+        queries = [
+            {},
+            dict(station="RJOB", channel="EHZ"),
+            dict(channel="EH[NE]", starttime=t1, endtime=t1 + 1),
+            dict(starttime=t1 + 100),
+            dict(station="BOB"),
+        ]
+        for query in queries:
+            df1, df2 = bank.read_index(**query), plain.read_index(**query)
+            assert df1.astype(str).equals(df2.astype(str))
+        st1 = bank.get_waveforms(starttime=t1, endtime=t1 + 5)
+        assert st1 == plain.get_waveforms(starttime=t1, endtime=t1 + 5)
+
+    def test_arrays_are_mapped(self, bank):
+        """ The index columns should be memory-mapped, not read. """
+        bank.read_index()
+        segments, _ = bank._shared_index.refresh()
+        assert isinstance(segments[0]["starttime"], np.memmap)
+        assert (bank._shared_index.path / "current.json").exists()
+
+    def test_new_generation_after_update(self, bank):
+        """ Updates by other banks should publish a new generation. """
+        assert len(bank.read_index()) == 3
+        generation = bank._shared_index.generation
+        WaveBank(bank.bank_path).put_waveforms(station_stream("BOB"))
+        assert len(bank.read_index()) == 6
+        assert len(bank.get_waveforms(station="BOB")) == 3
+        assert bank._shared_index.generation == generation + 1
+        # the directories of old generations are removed
+        dirs = [x for x in bank._shared_index.path.iterdir() if x.is_dir()]
+        assert len(dirs) == 1
+
+    def test_not_remapped_without_update(self, bank):
+        """ The same generation should be used until the index is updated. """
+        for _ in range(3):
+            bank.read_index(station="RJOB")
+            bank.update_index()
+        assert bank._shared_index.maps == 1
+
+    def test_readers_do_not_publish(self, trace_dir):
+        """ Queries without a published generation should read the index. """
+        WaveBank(trace_dir).update_index()
+        bank = WaveBank(trace_dir, shared_index=True)
+        assert len(bank.read_index()) == 3
+        assert not bank._shared_index.path.exists()
+
+    def test_updates_publish_changes(self, bank, monkeypatch):
+        """
+        Updates should publish only the rows they change, removed files
+        should be dropped from earlier segments.
+        """
+        plain = WaveBank(bank.bank_path)
+
+        def _read_index(*args, **kwargs):
+            raise AssertionError("the whole index was read")
+
+        monkeypatch.setattr(obsplus.utils.bank._SharedIndex, "_read_index", _read_index)
+        for num in range(10):
+            WaveBank(bank.bank_path).put_waveforms(station_stream(f"S{num}"))
+        # rewrite a file, then remove one
+        st = obspy.read()
+        for tr in st:
+            tr.stats.station, tr.stats.starttime = "S3", tr.stats.starttime + 3600
+        plain.put_waveforms(st)
+        path = plain.read_index(station="S5")["path"].iloc[0]
+        os.remove(str(bank.bank_path) + path)
+        plain.update_index()
+        df1, df2 = bank.read_index(), plain.read_index()
+        assert df1.astype(str).equals(df2.astype(str))
+        assert len(bank._shared_index.refresh()[0]) < 10
+
+    def test_full_publish_after_interrupted_update(self, bank):
+        """ The whole index should be published if an update didn't finish. """
+        (bank._shared_index.path / "pending").touch()
+        st = station_stream("BOB")
+        st.write(str(bank.bank_path / "bob.mseed"), "mseed")
+        WaveBank(bank.bank_path).update_index()
+        segments, _ = bank._shared_index.refresh()
+        assert len(segments) == 1 and len(segments[0]["label"]) == 6
+        assert not (bank._shared_index.path / "pending").exists()
+
+    def test_compact_index_publishes(self, bank):
+        """ The relabeled rows of a compacted index should be published. """
+        WaveBank(bank.bank_path).put_waveforms(station_stream("BOB"))
+        bank.compact_index()
+        plain = WaveBank(bank.bank_path)
+        assert bank.read_index().astype(str).equals(plain.read_index().astype(str))
+
+    def test_stale_temp_directories_removed(self, bank):
+        """ Directories left by publishers which died should be removed. """
+        stale = bank._shared_index.path / "s99_1.tmp"
+        stale.mkdir()
+        WaveBank(bank.bank_path).put_waveforms(station_stream("BOB"))
+        assert not stale.exists()
+
+    def test_map_retried_if_removed(self, bank, monkeypatch):
+        """ Generations removed part way through mapping should be retried. """
+        shared, load = bank._shared_index, obsplus.utils.bank._SharedIndex._load
+        calls = []
+
+        def _load(self, directory):
+            calls.append(directory)
+            if len(calls) == 1:  # as if some arrays were already removed
+                raise KeyError("network_values")
+            return load(self, directory)
+
+        WaveBank(bank.bank_path).put_waveforms(station_stream("BOB"))
+        monkeypatch.setattr(obsplus.utils.bank._SharedIndex, "_load", _load)
+        assert len(bank.read_index()) == 6
+        assert len(calls) == 2
+
+
 class TestYieldStreams:
     """ tests for yielding streams from the bank """
 
@@ -457,6 +1254,60 @@ class TestYieldStreams:
             assert all([abs(x.stats.endtime - t2) < 2.0 for x in st])
             t1 += dur
 
+    def test_prefetch(self, ta_bank_index):
+        """ Prefetching should yield the same streams and record waits. """
+        expected = list(ta_bank_index.yield_waveforms(**self.query2))
+        wait_times = []
+        kwargs = dict(self.query2, prefetch=2, wait_times=wait_times)
+        out = list(ta_bank_index.yield_waveforms(**kwargs))
+        assert out == expected
+        assert len(wait_times) == len(out)
+        assert all(x >= 0 for x in wait_times)
+
+    def test_stop_while_prefetching(self, ta_bank_index):
+        """ Closing the generator early should not read remaining streams. """
+        kwargs = dict(self.query2, prefetch=3)
+        gen = ta_bank_index.yield_waveforms(**kwargs)
+        assert isinstance(next(gen), obspy.Stream)
+        gen.close()
+
+    def test_read_once(self, ta_bank_index):
+        """ Streams sliced from files read once should match normal reads. """
+        expected = list(ta_bank_index.yield_waveforms(**self.query2))
+        for kwargs in [dict(read_once=True), dict(read_once=True, prefetch=2)]:
+            out = list(ta_bank_index.yield_waveforms(**self.query2, **kwargs))
+            assert len(out) == len(expected)
+            for st1, st2 in zip(out, expected):
+                assert len(st1) == len(st2)
+                for tr1, tr2 in zip(st1, st2):
+                    assert tr1.id == tr2.id
+                    assert tr1.stats.starttime == tr2.stats.starttime
+                    assert np.all(tr1.data == tr2.data)
+
+    def test_read_once_reads_each_file_once(self, trace_dir, monkeypatch):
+        """ Each file should be read once no matter how many chunks use it. """
+        bank = WaveBank(trace_dir).update_index()
+        reads = []
+        read_stream = obsplus.bank.wavebank._try_read_stream
+
+        def _count_reads(path, **kwargs):
+            reads.append(path)
+            return read_stream(path, **kwargs)
+
+        monkeypatch.setattr(obsplus.bank.wavebank, "_try_read_stream", _count_reads)
+        out = list(bank.yield_waveforms(duration=5, overlap=1, read_once=True))
+        assert len(out) > 1
+        assert sorted(reads) == sorted(set(reads)) and len(reads) == 3
+
+    def test_read_once_output_is_copied(self, ta_bank_index):
+        """ Modifying a stream should not change the next, overlapping, one. """
+        expected = list(ta_bank_index.yield_waveforms(**self.query2))
+        kwargs = dict(self.query2, read_once=True)
+        for st1, st2 in zip(ta_bank_index.yield_waveforms(**kwargs), expected):
+            assert all(np.all(x.data == y.data) for x, y in zip(st1, st2))
+            for tr in st1:
+                tr.data *= 0
+
 
 class TestGetWaveforms:
     """ tests for getting waveforms from the index """
@@ -600,6 +1451,172 @@ class TestGetWaveforms:
         assert len(st) == 3
 
 
+class TestRecordBlocks:
+    """ Tests for reading only the records which overlap requested times. """
+
+    @pytest.fixture
+    def bank(self, tmp_path):
+        """ Create a bank with a long file and a small one. """
+        st = obspy.read()
+        st.merge(method=1)
+        long_st = obspy.Stream()
+        for tr in st:
+            tr = tr.copy()
+            tr.data = np.tile(tr.data.astype(np.int32), 20)
+            long_st.append(tr)
+        long_st.write(str(tmp_path / "long.mseed"), "mseed", reclen=512)
+        obspy.read()[:1].write(str(tmp_path / "small.mseed"), "mseed")
+        return WaveBank(tmp_path, records_per_block=8).update_index()
+
+    @pytest.fixture
+    def full_bank(self, bank):
+        """ The same bank without partial reads. """
+        return WaveBank(bank.bank_path)
+
+    def read_blocks(self, bank):
+        """ Read the record blocks with decoded paths. """
+        with pd.HDFStore(bank.index_path, "r") as store:
+            df = store.select(bank._record_node)
+            categories = bank._read_categories(store, "path")
+        return df.assign(path=categories[df["path"].values])
+
+    def test_blocks_cover_long_file(self, bank):
+        """ Only the long file has blocks, they tile the whole file. """
+        df = self.read_blocks(bank)
+        assert set(df["path"]) == {"/long.mseed"}
+        size = (bank.bank_path / "long.mseed").stat().st_size
+        assert df["nbytes"].sum() == size
+
+    def test_same_as_full_read(self, bank, full_bank):
+        """ Reads of the blocks should give the same data as full reads. """
+        df = bank.read_index()
+        t1 = to_utc(df["starttime"].min())
+        for start, duration in [(0, 1), (17.003, 0.5), (300, 25), (-10, 20)]:
+            kwargs = dict(starttime=t1 + start, endtime=t1 + start + duration)
+            st1 = bank.get_waveforms(**kwargs)
+            st2 = full_bank.get_waveforms(**kwargs)
+            assert len(st1) == len(st2)
+            for tr1, tr2 in zip(st1, st2):
+                assert tr1.id == tr2.id
+                assert tr1.stats.starttime == tr2.stats.starttime
+                assert np.all(tr1.data == tr2.data)
+
+    def test_reads_few_bytes(self, bank):
+        """ A short request should read a small part of the long file. """
+        df = bank.read_index()
+        t1 = to_utc(df["starttime"].min()) + 100
+        blocks = bank._read_record_blocks(df["path"].unique(), t1, t1 + 1)
+        size = (bank.bank_path / "long.mseed").stat().st_size
+        assert blocks["/long.mseed"][:, 1].sum() < size / 5
+        assert "/small.mseed" not in blocks
+
+    def test_rewritten_file(self, bank):
+        """ The blocks of a rewritten file should be replaced. """
+        path = bank.bank_path / "long.mseed"
+        time.sleep(0.01)
+        obspy.read().write(str(path), "mseed", reclen=512)
+        bank.update_index()
+        df = self.read_blocks(bank)
+        assert df["nbytes"].sum() == path.stat().st_size
+
+    def test_blocks_cached(self, bank, monkeypatch):
+        """ The blocks of each file should only be read from the index once. """
+        selected = []
+        select = bank._select_record_blocks
+
+        def _select_record_blocks(missing):
+            selected.extend(missing)
+            return select(missing)
+
+        monkeypatch.setattr(bank, "_select_record_blocks", _select_record_blocks)
+        t1 = to_utc(bank.read_index()["starttime"].min())
+        for start in [10, 100, 200]:
+            bank.get_waveforms(starttime=t1 + start, endtime=t1 + start + 1)
+        assert sorted(selected) == ["/long.mseed", "/small.mseed"]
+        # the blocks are read again if the file's size or mtime changes
+        obspy.read().write(str(bank.bank_path / "long.mseed"), "mseed", reclen=512)
+        bank._read_record_blocks(pd.Series(["/long.mseed"]), t1, t1 + 30)
+        assert selected[2:] == ["/long.mseed"]
+        path = bank.bank_path / "small.mseed"
+        os.utime(path, (path.stat().st_atime, path.stat().st_mtime + 10))
+        bank._read_record_blocks(pd.Series(["/small.mseed"]), t1, t1 + 30)
+        assert selected[3:] == ["/small.mseed"]
+
+
+class TestTraceCache:
+    """ Tests for caching decoded traces in the bank. """
+
+    @pytest.fixture
+    def bank(self, trace_dir):
+        """ Create a bank with a trace cache and one file per trace. """
+        return WaveBank(trace_dir, trace_cache_bytes=1_000_000).update_index()
+
+    @pytest.fixture
+    def kwargs(self, bank):
+        """ Query kwargs for part of the data. """
+        t1 = to_utc(bank.read_index()["starttime"].min())
+        return dict(starttime=t1 + 5, endtime=t1 + 10)
+
+    def test_repeated_queries_hit(self, bank, kwargs):
+        """ The second of the same query should be served from the cache. """
+        st1 = bank.get_waveforms(**kwargs)
+        info1 = bank.trace_cache_info()
+        assert info1["misses"] == 3 and info1["hits"] == 0
+        assert info1["entries"] == 3 and info1["nbytes"] > 0
+        st2 = bank.get_waveforms(**kwargs)
+        info2 = bank.trace_cache_info()
+        assert info2["misses"] == 3 and info2["hits"] == 3
+        assert st1 == st2
+
+    def test_same_as_uncached(self, bank, kwargs):
+        """ Cached and uncached banks should return the same streams. """
+        bank.get_waveforms()
+        uncached = WaveBank(bank.bank_path)
+        for query in [kwargs, dict(channel="*Z")]:
+            st1, st2 = bank.get_waveforms(**query), uncached.get_waveforms(**query)
+            assert len(st1) == len(st2)
+            for tr1, tr2 in zip(st1, st2):
+                assert tr1.id == tr2.id
+                assert tr1.stats.starttime == tr2.stats.starttime
+                assert tr1.stats.processing == tr2.stats.processing
+                assert np.all(tr1.data == tr2.data)
+
+    def test_output_does_not_change_cache(self, bank, kwargs):
+        """ Modifying returned data in place should not affect the cache. """
+        st1 = bank.get_waveforms(**kwargs)
+        expected = st1.copy()
+        for tr in st1:
+            tr.data *= 0
+        assert bank.get_waveforms(**kwargs) == expected
+
+    def test_byte_budget(self, bank):
+        """ Least recently used traces should be evicted to stay in budget. """
+        nbytes = obspy.read()[0].data.nbytes
+        bank._trace_cache.max_bytes = int(nbytes * 1.5)
+        bank.get_waveforms()
+        info = bank.trace_cache_info()
+        assert info["entries"] == 1 and info["nbytes"] <= info["max_bytes"]
+
+    def test_changed_file_invalidated(self, bank, kwargs):
+        """ Traces of a changed file should be removed and read again. """
+        bank.get_waveforms(**kwargs)
+        path = bank.bank_path / "0.mseed"
+        tr = obspy.read(str(path))[0]
+        tr.data = np.zeros_like(tr.data)
+        time.sleep(0.01)
+        tr.write(str(path), "mseed")
+        bank.update_index()
+        assert bank.trace_cache_info()["entries"] == 2
+        st = bank.get_waveforms(station=tr.stats.station, channel=tr.stats.channel)
+        assert not st[0].data.any()
+
+    def test_no_record_blocks(self, bank, kwargs, monkeypatch):
+        """ Record blocks should not be read, cached files are read whole. """
+        bank.records_per_block = 8
+        monkeypatch.setattr(bank, "_read_record_blocks", None)
+        assert len(bank.get_waveforms(**kwargs)) == 3
+
+
 class TestGetBulkWaveforms:
     """ tests for pulling multiple waveforms using get_bulk_waveforms """
 
@@ -635,6 +1652,32 @@ class TestGetBulkWaveforms:
         bank.update_index()
         return bank
 
+    @pytest.fixture
+    def random_bulk(self, split_bank):
+        """ Create many bulk requests with random channels and times. """
+        rand = np.random.RandomState(42)
+        t0 = to_utc(split_bank.read_index()["starttime"].min())
+        channels = ["EHZ", "EHN", "EHE", "EH?", "*"]
+        bulk = []
+        for _ in range(40):
+            t1 = t0 + rand.uniform(-2, 30)
+            t2 = t1 + rand.uniform(0, 10)
+            bulk.append(("BW", "RJOB", "", rand.choice(channels), t1, t2))
+        # repeated windows should only be returned once
+        return bulk + bulk[:5]
+
+    @pytest.fixture
+    def read_paths(self, monkeypatch):
+        """ Record the paths of the files read by the bank. """
+        paths = []
+
+        def _read(path, *args, **kwargs):
+            paths.append(path)
+            return obspy.read(path, *args, **kwargs)
+
+        monkeypatch.setattr(obsplus.utils.bank, "_try_read_stream", _read)
+        return paths
+
     # tests
     def test_equal_results(self, ta_bulk_1, ta_standard_1):
         """ the two queries should return the same streams """
@@ -684,6 +1727,217 @@ class TestGetBulkWaveforms:
         stt = ta_bank.get_waveforms_bulk(bulk)
         assert isinstance(stt, obspy.Stream)
 
+    def test_same_as_get_waveforms(self, split_bank, random_bulk):
+        """ The bulk output should be the same as a query for each window. """
+        st = split_bank.get_waveforms_bulk(random_bulk)
+        expected = obspy.Stream()
+        windows = defaultdict(set)
+        for *_, channel, t1, t2 in random_bulk:
+            windows[(t1.ns, t2.ns)].add(channel)
+        for (t1, t2), channels in sorted(windows.items()):
+            use_all = "*" in channels or "EH?" in channels
+            kwargs = dict(starttime=UTC(ns=t1), endtime=UTC(ns=t2))
+            channel = "*" if use_all else list(channels)
+            expected += split_bank.get_waveforms(channel=channel, **kwargs)
+        # stats.mseed depends on how much of each file was read
+        assert len(st) == len(expected)
+        for tr1, tr2 in zip(st, expected):
+            assert tr1.id == tr2.id
+            assert tr1.stats.starttime == tr2.stats.starttime
+            assert tr1.stats.processing == tr2.stats.processing
+            assert np.all(tr1.data == tr2.data)
+
+    def test_files_read_once(self, split_bank, random_bulk, read_paths):
+        """ Each file should be read at most once for a bulk request. """
+        split_bank.get_waveforms_bulk(random_bulk)
+        assert len(read_paths) == len(set(read_paths)) == 5
+
+    def test_cached_bank(self, split_bank, random_bulk):
+        """ A bank with a trace cache should return the same streams. """
+        path = split_bank.bank_path
+        cached = WaveBank(path, trace_cache_bytes=1_000_000).update_index()
+        st1 = split_bank.get_waveforms_bulk(random_bulk)
+        assert cached.get_waveforms_bulk(random_bulk) == st1
+
+    @pytest.mark.parametrize("cache_bytes", [0, 1_000_000])
+    @pytest.mark.parametrize("gap_tolerance", [0, 10])
+    def test_nested_windows(self, split_bank, gap_tolerance, cache_bytes):
+        """ A window inside a longer one shouldn't shorten the longer one. """
+        bank = WaveBank(split_bank.bank_path, trace_cache_bytes=cache_bytes)
+        t0 = to_utc(bank.read_index()["starttime"].min())
+        # the short window sorts after the long one, and ends first
+        bulk = [
+            ("BW", "RJOB", "", "EHZ", t0, t0 + 20),
+            ("BW", "RJOB", "", "EHZ", t0 + 4, t0 + 5),
+        ]
+        st = bank.get_waveforms_bulk(bulk, gap_tolerance=gap_tolerance)
+        assert st[0].stats.endtime == t0 + 20
+        long, short = bank.get_waveforms_bulk_split(bulk)
+        assert long[0].stats.starttime == t0
+        assert long[0].stats.endtime == t0 + 20
+        assert short[0].stats.starttime == t0 + 4
+        assert short[0].stats.endtime == t0 + 5
+
+    def test_wildcards_with_null_codes(self, split_bank):
+        """ Wildcard requests with null codes should each match channels. """
+        t0 = to_utc(split_bank.read_index()["starttime"].min())
+        bulk = [
+            ("BW", "RJOB", None, "EH*", t0, t0 + 5),
+            ("BW", "*", None, "EHZ", t0, t0 + 5),
+            ("BW", "R*", "", "EHN", t0, t0 + 5),
+        ]
+        st = split_bank.get_waveforms_bulk(bulk)
+        assert {tr.id for tr in st} == {"BW.RJOB..EHE", "BW.RJOB..EHN", "BW.RJOB..EHZ"}
+
+    def test_default_tolerance_reads_requested_times(self, tmp_path, monkeypatch):
+        """ By default windows which don't overlap should be read separately. """
+        obspy.read().write(str(tmp_path / "0.mseed"), "mseed")
+        bank = WaveBank(tmp_path).update_index()
+        t0 = to_utc(bank.read_index()["starttime"].min())
+        bulk = [
+            ("BW", "RJOB", "", "EHZ", t0 + 1, t0 + 3),
+            ("BW", "RJOB", "", "EHZ", t0 + 10, t0 + 12),
+        ]
+        times = []
+
+        def _read(path, *args, **kwargs):
+            times.append((kwargs["starttime"], kwargs["endtime"]))
+            return obspy.read(path, *args, **kwargs)
+
+        monkeypatch.setattr(obsplus.utils.bank, "_try_read_stream", _read)
+        bank.get_waveforms_bulk(bulk)
+        assert sorted(times) == [(t0 + 1, t0 + 3), (t0 + 10, t0 + 12)]
+
+    def test_gap_tolerance(self, tmp_path, read_paths):
+        """ Windows farther apart than the tolerance are read separately. """
+        obspy.read().write(str(tmp_path / "0.mseed"), "mseed")
+        bank = WaveBank(tmp_path).update_index()
+        t0 = to_utc(bank.read_index()["starttime"].min())
+        bulk = [
+            ("BW", "RJOB", "", "EHZ", t0 + 1, t0 + 3),
+            ("BW", "RJOB", "", "EHZ", t0 + 20, t0 + 22),
+            ("BW", "RJOB", "", "EHN", t0 + 21, t0 + 23),
+        ]
+        st1 = bank.get_waveforms_bulk(bulk, gap_tolerance=0)
+        assert len(read_paths) == 2
+        st2 = bank.get_waveforms_bulk(bulk, gap_tolerance=20)
+        assert len(read_paths) == 3
+        assert len(st1) == len(st2) == 3
+        for tr1, tr2 in zip(st1, st2):
+            assert tr1.id == tr2.id
+            assert np.all(tr1.data == tr2.data)
+
+    def test_split(self, split_bank, random_bulk):
+        """ Each request should get the stream of its own query. """
+        out = split_bank.get_waveforms_bulk_split(random_bulk)
+        assert len(out) == len(random_bulk)
+        for st, (*nslc, t1, t2) in zip(out, random_bulk):
+            expected = split_bank.get_waveforms(*nslc, t1, t2)
+            assert len(st) == len(expected)
+            for tr1, tr2 in zip(st, expected):
+                assert tr1.id == tr2.id
+                assert tr1.stats.starttime == tr2.stats.starttime
+                assert np.all(tr1.data == tr2.data)
+        # repeated requests shouldn't share traces
+        assert out[0][0] is not out[-5][0]
+
+    def test_split_empty(self, split_bank):
+        """ Requests without data should get empty streams. """
+        t1 = obspy.UTCDateTime("2012-01-01")
+        bulk = [("bob", "is", "no", "sta", t1, t1 + 10)]
+        assert split_bank.get_waveforms_bulk_split(bulk) == [obspy.Stream()]
+        assert split_bank.get_waveforms_bulk_split([]) == []
+
+
+class TestGetWaveformsArray:
+    """ Tests for getting bulk requests as arrays. """
+
+    @pytest.fixture
+    def t0(self, split_bank):
+        """ Return the start of the data in the bank. """
+        return to_utc(split_bank.read_index()["starttime"].min())
+
+    @pytest.fixture
+    def bulk(self, t0):
+        """ Requests which span files, extend past the data, and miss. """
+        return [
+            ("BW", "RJOB", "", "*", t0 + 4.505, t0 + 14.003),
+            ("BW", "RJOB", "", "EHZ", t0 - 2, t0 + 3),
+            ("BW", "RJOB", "", "EH[NE]", t0 + 28, t0 + 33),
+            ("BW", "BOB", "", "EHZ", t0, t0 + 3),
+        ]
+
+    @pytest.fixture
+    def array_out(self, split_bank, bulk):
+        """ Return the output of get_waveforms_array for the bulk. """
+        return split_bank.get_waveforms_array(bulk)
+
+    def test_shape(self, array_out):
+        """ The output should have a channel axis for the widest request. """
+        data, mask, stats = array_out
+        assert data.shape == mask.shape == (4, 3, 950)
+        assert mask.dtype == np.bool_
+        assert len(stats) == 6
+        assert list(stats["request"]) == [0, 0, 0, 1, 2, 2]
+        assert list(stats["channel"]) == ["EHE", "EHN", "EHZ", "EHZ", "EHE", "EHN"]
+
+    def test_same_as_streams(self, split_bank, bulk, array_out):
+        """ The filled samples should be the samples of each request. """
+        data, mask, stats = array_out
+        streams = split_bank.get_waveforms_bulk_split(bulk)
+        for _, row in stats.iterrows():
+            seed_id = ".".join(row[list(NSLC)])
+            tr = streams[row.request].select(id=seed_id).merge()[0]
+            sub_mask = mask[row.request, row.channel_index]
+            assert row.npts == sub_mask.sum() == len(tr.data)
+            assert np.all(data[row.request, row.channel_index][sub_mask] == tr.data)
+            # the first sample should be filled where the trace starts
+            first = np.flatnonzero(sub_mask)[0]
+            starttime = to_utc(row.starttime) + first / row.sampling_rate
+            assert abs(starttime - tr.stats.starttime) < 1e-6
+
+    def test_unfilled(self, array_out):
+        """ Samples without data should be masked and NaN. """
+        data, mask, _ = array_out
+        assert not mask[3].any()
+        assert np.isnan(data[3]).all()
+        assert np.isnan(data[~mask]).all()
+        # only the first 3 seconds of the second request have data
+        assert mask[1, 0, 200:501].all() and not mask[1, 0, :200].any()
+
+    def test_empty(self, split_bank, t0):
+        """ Requests without data should give empty arrays. """
+        data, mask, stats = split_bank.get_waveforms_array([])
+        assert data.shape == (0, 0, 0) and stats.empty
+        bulk = [("BW", "BOB", "", "EHZ", t0, t0 + 3)]
+        data, mask, stats = split_bank.get_waveforms_array(bulk)
+        assert data.shape == (1, 0, 0) and stats.empty
+
+    def test_mixed_sampling_rates(self, split_bank, t0):
+        """ Channels with different sampling rates need a sampling_rate. """
+        tr = obspy.read()[0]
+        tr.stats.update(dict(channel="HHZ", sampling_rate=200))
+        split_bank.put_waveforms(tr)
+        bulk = [("BW", "RJOB", "", "*", t0, t0 + 3)]
+        with pytest.raises(ValueError, match="sampling rates"):
+            split_bank.get_waveforms_array(bulk)
+        data, mask, stats = split_bank.get_waveforms_array(bulk, sampling_rate=200)
+        assert list(stats["npts"]) == [0, 0, 0, 601]
+        data, mask, stats = split_bank.get_waveforms_array(bulk, sampling_rate=100)
+        assert list(stats["npts"]) == [301, 301, 301, 0]
+
+    def test_zero_sampling_rate(self, split_bank, t0):
+        """ Channels with a sampling rate of 0 need a sampling_rate. """
+        tr = obspy.Trace(np.zeros(1, dtype=np.int32), header=dict(sampling_rate=0))
+        tr.stats.update(dict(network="BW", station="RJOB", channel="LOG"))
+        tr.stats.starttime = t0 + 1
+        split_bank.put_waveforms(tr)
+        bulk = [("BW", "RJOB", "", "LOG", t0, t0 + 3)]
+        with pytest.raises(ValueError, match="sampling rate of 0"):
+            split_bank.get_waveforms_array(bulk)
+        data, mask, stats = split_bank.get_waveforms_array(bulk, sampling_rate=100)
+        assert data.shape == (1, 1, 301) and not mask.any()
+
 
 class TestBankCache:
     """ test that the time cache avoids repetitive queries to the h5 index """
@@ -783,6 +2037,186 @@ class TestPutWaveForm:
         assert set(df.station) == {"RJOB"}
 
 
+class TestPutWaveformsIndex:
+    """ Tests for indexing the traces put into a bank without reading them. """
+
+    @pytest.fixture
+    def stream(self):
+        """ Return the default stream with odd start times and rates. """
+        st = obspy.read()
+        for tr, rate in zip(st, [3.0, 1.5, 100.0]):
+            tr.stats.starttime += 0.123456789
+            tr.stats.sampling_rate = rate
+        return st
+
+    @pytest.fixture
+    def bank(self, tmp_path, stream, monkeypatch):
+        """ Put the stream into a bank twice, the second time shifted. """
+        bank = WaveBank(tmp_path)
+        bank.put_waveforms(stream)
+        # files should not be read or summarized from now on
+        for name in ["_summarize_wave_file", "_try_read_stream"]:
+            monkeypatch.setattr(obsplus.bank.wavebank, name, None)
+        monkeypatch.setattr(bank, "update_index", None)
+        shifted = stream.copy()
+        for tr in shifted:
+            tr.stats.starttime += 5000
+        bank.put_waveforms(shifted)
+        return bank
+
+    def sorted_index(self, bank):
+        """ Return the index sorted by channel and starttime. """
+        df = bank.read_index().sort_values(["channel", "starttime"])
+        return df.reset_index(drop=True)
+
+    def test_index_matches_update(self, bank, monkeypatch):
+        """ The rows should match those from indexing the files. """
+        index = self.sorted_index(bank)
+        monkeypatch.undo()
+        new = WaveBank(bank.bank_path)
+        os.remove(new.index_path)
+        expected = self.sorted_index(new.update_index())
+        assert len(index) == len(expected) == 6
+        for col in set(index.columns) - {"endtime"}:
+            assert index[col].equals(expected[col])
+        # endtimes are summed from the records in the file
+        assert (index["endtime"] - expected["endtime"]).abs().max() <= to_timedelta64(
+            0.000001
+        )
+
+    def test_merged_file_rows_replaced(self, bank, stream):
+        """ Rows of a file put into again should be replaced. """
+        bank.put_waveforms(stream)
+        index = bank.read_index()
+        assert len(index) == 6
+        assert not index.duplicated(["channel", "starttime"]).any()
+
+    def test_no_index_update(self, bank, stream):
+        """ Traces put with update_index=False should not be indexed. """
+        for tr in stream:
+            tr.stats.station = "BOB"
+        bank.put_waveforms(stream, update_index=False)
+        assert "BOB" not in set(bank.read_index()["station"])
+
+    def test_zero_sampling_rate(self, tmp_path):
+        """ Traces with a sampling rate of 0 should have a period of 0. """
+        header = dict(station="BOB", sampling_rate=0)
+        tr = obspy.Trace(np.zeros(1, dtype=np.int32), header=header)
+        bank = WaveBank(tmp_path)
+        bank.put_waveforms(obspy.Stream([tr]))
+        index = bank.read_index()
+        os.remove(bank.index_path)
+        expected = WaveBank(tmp_path).update_index().read_index()
+        assert (index["sampling_period"] == EMPTYTD64).all()
+        assert index.equals(expected)
+
+
+class TestAppendWaveforms:
+    """ Tests for appending records to files and consolidating them. """
+
+    num_appends = 3
+
+    def shifted(self, stream, num):
+        """ Return the stream shifted to follow itself num times. """
+        out = stream.copy()
+        for tr in out:
+            tr.stats.starttime += num * (tr.stats.endtime - tr.stats.starttime + 0.01)
+        return out
+
+    def make_bank(self, path, **kwargs) -> WaveBank:
+        """ Put the default stream into a file per channel, then append. """
+        bank = WaveBank(path, name_structure="{network}_{station}", **kwargs)
+        st = obspy.read()
+        bank.put_waveforms(st)
+        for num in range(1, self.num_appends + 1):
+            bank.put_waveforms(self.shifted(st, num), append=True)
+        return bank
+
+    @pytest.fixture
+    def bank(self, tmp_path):
+        """ Return a bank with records appended to its files. """
+        return self.make_bank(tmp_path)
+
+    def test_records_appended(self, bank):
+        """ Files should have index rows for each put until consolidated. """
+        paths = bank._appended_files()
+        assert len(paths) == 3
+        for path in paths:
+            assert len(obspy.read(path)[0].data) == 3000 * (self.num_appends + 1)
+        assert len(bank.read_index()) == 3 * (self.num_appends + 1)
+
+    def test_waveforms_merged(self, bank):
+        """ The waveforms read should be merged. """
+        st = bank.get_waveforms()
+        assert len(st) == 3
+        assert all(len(x.data) == 3000 * (self.num_appends + 1) for x in st)
+
+    def test_update_keeps_rows(self, bank):
+        """ update_index should not index the appended files again. """
+        index = bank.read_index()
+        new = WaveBank(bank.bank_path).update_index()
+        assert len(new.read_index()) == len(index)
+        assert len(new._appended_files()) == 3
+
+    def test_consolidate(self, bank):
+        """ Consolidated files should hold one trace and row per channel. """
+        st = bank.get_waveforms()
+        bank.consolidate()
+        assert not bank._appended_files()
+        assert len(bank.read_index()) == 3
+        for path in bank.read_index()["path"]:
+            assert len(obspy.read(str(bank.bank_path) + path)) == 1
+        assert bank.get_waveforms() == st
+
+    def test_consolidate_paths(self, bank):
+        """ Only the given files should be consolidated. """
+        path = bank.read_index()["path"].iloc[0]
+        bank.consolidate(paths=[path])
+        assert len(bank._appended_files()) == 2
+        assert len(bank.read_index()) == 3 * (self.num_appends + 1) - self.num_appends
+
+    def test_consolidate_gaps(self, bank):
+        """ Files with gaps between the records appended should consolidate. """
+        st = self.shifted(obspy.read(), self.num_appends + 2)
+        bank.put_waveforms(st, append=True)
+        bank.consolidate()
+        assert not bank._appended_files()
+        assert len(bank.read_index()) == 6  # a row each side of the gaps
+        st = bank.get_waveforms()
+        assert sum(len(x.data) for x in st) == 3 * 3000 * (self.num_appends + 2)
+
+    def test_bad_file_skipped(self, bank):
+        """ Files which can't be consolidated should not stop the others. """
+        paths = bank._appended_files()
+        Path(paths[0]).write_bytes(b"not a waveform file")
+        with pytest.warns(UserWarning, match="failed to consolidate"):
+            bank.consolidate()
+        assert bank._appended_files() == paths[:1]
+
+    def test_unindexed_file_merged(self, bank):
+        """ Files not indexed as they are on disk should be merged into. """
+        for path in bank._appended_files():
+            obspy.read(path).merge().write(path, "mseed")  # modified after index
+        st = self.shifted(obspy.read(), self.num_appends + 1)
+        bank.put_waveforms(st, append=True)
+        assert len(bank.read_index()) == 3  # a row for each merged file
+        assert not bank._appended_files()
+        for tr in bank.get_waveforms():
+            assert len(tr.data) == 3000 * (self.num_appends + 2)
+
+    def test_record_blocks(self, tmp_path):
+        """ Reads of appended files should find the records of each put. """
+        bank = self.make_bank(tmp_path, records_per_block=1)
+        st = bank.get_waveforms()
+        for tr in st:
+            start = tr.stats.starttime + 60
+            out = bank.get_waveforms(starttime=start, endtime=start + 10)
+            assert (
+                out.select(id=tr.id)[0].data.tolist()
+                == tr.slice(start, start + 10).data.tolist()
+            )
+
+
 class TestPutMultipleTracesOneFile:
     """ ensure that multiple waveforms can be put into one file """
 
@@ -1014,6 +2448,27 @@ class TestGetAvailability:
                 assert isinstance(val, obspy.UTCDateTime)
             assert isinstance(av[0], str)
 
+    def test_sorted_when_indexed_out_of_order(self, tmp_path):
+        """ The outputs should be sorted by NSLC whatever the indexing order. """
+        outputs = []
+        for stations in [["ZZZ", "MMM", "AAA"], ["AAA", "MMM", "ZZZ"]]:
+            bank = WaveBank(tmp_path / stations[0])
+            for station in stations:  # each update adds a station
+                bank.put_waveforms(station_stream(station), update_index=False)
+                bank.update_index()
+            avail = bank.get_availability_df()
+            uptime = bank.get_uptime_df()
+            for df in [avail, uptime]:
+                nslc = df[list(NSLC)].astype(str)
+                assert nslc.equals(nslc.sort_values(list(NSLC)))
+            assert bank.availability() == sorted(bank.availability())
+            index = bank.read_index()
+            for col in list(NSLC) + ["path"]:
+                assert index[col].cat.categories.is_monotonic_increasing
+            outputs.append((avail.astype(str), uptime.astype(str)))
+        for first, second in zip(*outputs):
+            assert first.equals(second)
+
 
 class TestGetGaps:
     """ test that the get_gaps method returns info about gaps """
@@ -1202,6 +2657,190 @@ class TestGetGaps:
         gap_df = small_overlap_gaps.get_gaps_df()
         assert len(gap_df) == 0
 
+    def test_gap_after_nested_file(self, tmp_path):
+        """ A gap should start at the end of the longest preceding file. """
+        t0 = UTC("2017-01-01")
+        # a three hour file, a short file inside it, then a file at hour four
+        for num, (start, samples) in enumerate([(0, 10800), (600, 60), (14400, 60)]):
+            header = dict(station="RJOB", network="BW", channel="EHZ")
+            header["starttime"] = t0 + start
+            tr = obspy.Trace(np.zeros(samples, dtype=np.int32), header=header)
+            tr.write(str(tmp_path / f"{num}.mseed"), "mseed")
+        bank = WaveBank(tmp_path).update_index()
+        expected_start = to_datetime64(t0 + 10799)
+        for gaps in [bank.get_gaps_df(), bank.get_gaps_df(min_gap=0.5)]:
+            assert len(gaps) == 1
+            assert gaps["starttime"].iloc[0] == expected_start
+            assert gaps["endtime"].iloc[0] == to_datetime64(t0 + 14400)
+
+
+class TestCoverage:
+    """ Tests for the per channel coverage table kept in the index. """
+
+    t0 = UTC("2017-01-01")
+    missing_hours = (3, 4, 10)
+
+    @pytest.fixture
+    def hour_bank(self, tmp_path):
+        """ Create a bank of hour long files with a few missing hours. """
+        for hour in set(range(12)) - set(self.missing_hours):
+            for channel in ["EHE", "EHN", "EHZ"]:
+                header = dict(station="RJOB", network="BW", channel=channel)
+                header["starttime"] = self.t0 + hour * 3600
+                tr = obspy.Trace(np.zeros(3600, dtype=np.int32), header=header)
+                path = tmp_path / f"{hour}_{channel}.mseed"
+                tr.write(str(path), "mseed")
+        return WaveBank(tmp_path).update_index()
+
+    def assert_coverage_matches_index(self, bank, min_gap=None, **kwargs):
+        """ Gaps and availability should be the same as from the index. """
+        gaps = bank.get_gaps_df(min_gap=min_gap, **kwargs)
+        expected = bank._get_gaps_from_index(min_gap=min_gap, **kwargs)
+        columns = list(WaveBank._gap_columns)
+        sort_cols = list(NSLC) + ["starttime"]
+        gaps = gaps[columns].astype(str).sort_values(sort_cols)
+        expected = expected[columns].astype(str).sort_values(sort_cols)
+        assert gaps.reset_index(drop=True).equals(expected.reset_index(drop=True))
+        avail = bank.get_availability_df(**kwargs).astype(str)
+        index = bank.read_index(**kwargs)
+        gro = index.groupby(list(NSLC), observed=True)
+        expected = pd.merge(
+            gro.starttime.min().reset_index(), gro.endtime.max().reset_index()
+        )
+        assert avail.equals(expected.astype(str))
+
+    def test_coverage_table(self, hour_bank):
+        """ Contiguous files of each channel should be merged. """
+        with pd.HDFStore(hour_bank.index_path, "r") as store:
+            coverage = hour_bank._read_coverage_table(store)
+        # three channels, each with 3 contiguous stretches of files
+        assert len(coverage) == 9
+        assert len(hour_bank.read_index()) == 27
+
+    def test_matches_index(self, hour_bank):
+        """ Gaps and availability should match those found from the index. """
+        self.assert_coverage_matches_index(hour_bank)
+        self.assert_coverage_matches_index(hour_bank, channel="*Z")
+        gaps = hour_bank.get_gaps_df()
+        assert len(gaps) == 6
+
+    def test_index_not_read(self, hour_bank, monkeypatch):
+        """ Gaps, availability and uptime should only read the coverage. """
+
+        def _raise(*args, **kwargs):
+            raise AssertionError("the index should not be read")
+
+        monkeypatch.setattr(hour_bank, "read_index", _raise)
+        uptime = hour_bank.get_uptime_df()
+        assert len(uptime) == 3
+        assert np.allclose(uptime["availability"], 9 / 12, atol=0.001)
+        assert not hour_bank.get_coverage().empty
+
+    def test_removed_and_added_files(self, hour_bank):
+        """ Coverage should be updated when files are removed or added. """
+        path = hour_bank.bank_path / "6_EHZ.mseed"
+        data = path.read_bytes()
+        path.unlink()
+        hour_bank.update_index()
+        gaps = hour_bank.get_gaps_df(channel="EHZ")
+        assert len(gaps) == 3
+        self.assert_coverage_matches_index(hour_bank)
+        path.write_bytes(data)
+        hour_bank.update_index()
+        assert len(hour_bank.get_gaps_df(channel="EHZ")) == 2
+        self.assert_coverage_matches_index(hour_bank)
+
+    def test_only_changed_rows_read(self, hour_bank, monkeypatch):
+        """ Updates should only read and replace the nearby changed rows. """
+        selected, wheres = [], []
+        select_coverage, select_index = (
+            hour_bank._select_coverage,
+            hour_bank._select_index,
+        )
+
+        def _select_coverage(store, changed):
+            coords, coverage = select_coverage(store, changed)
+            selected.append(coverage)
+            return coords, coverage
+
+        def _select_index(store, where=None, *args, **kwargs):
+            wheres.append(where)
+            return select_index(store, where, *args, **kwargs)
+
+        monkeypatch.setattr(hour_bank, "_select_coverage", _select_coverage)
+        monkeypatch.setattr(hour_bank, "_select_index", _select_index)
+        monkeypatch.setattr(hour_bank, "_read_coverage_table", None)
+        header = dict(station="RJOB", network="BW", channel="EHZ")
+        header["starttime"] = self.t0 + 12 * 3600
+        tr = obspy.Trace(np.zeros(3600, dtype=np.int32), header=header)
+        tr.write(str(hour_bank.bank_path / "12_EHZ.mseed"), "mseed")
+        hour_bank.update_index()
+        # only the last stretch of EHZ is merged with the new file
+        assert len(selected[-1]) == 1
+        (hour_bank.bank_path / "6_EHZ.mseed").unlink()
+        hour_bank.update_index()
+        assert len(selected[-1]) == 1
+        # the stretch is rebuilt from the index rows of its channel
+        assert "channel ==" in wheres[-1]
+        monkeypatch.undo()
+        assert len(hour_bank.get_gaps_df(channel="EHZ")) == 3
+        self.assert_coverage_matches_index(hour_bank)
+
+    def test_table_without_data_columns(self, hour_bank):
+        """ Coverage tables written without data columns should be replaced. """
+        with pd.HDFStore(hour_bank.index_path, "a") as store:
+            coverage = hour_bank._read_coverage_table(store)
+            store.put(hour_bank._coverage_node, coverage, format="table")
+        (hour_bank.bank_path / "6_EHZ.mseed").unlink()
+        hour_bank.update_index()
+        with pd.HDFStore(hour_bank.index_path, "r") as store:
+            assert store.get_storer(hour_bank._coverage_node).data_columns
+        assert len(hour_bank.get_gaps_df(channel="EHZ")) == 3
+        self.assert_coverage_matches_index(hour_bank)
+
+    def test_clipped_to_times(self, hour_bank):
+        """ Availability should be clipped to the requested times. """
+        t1, t2 = self.t0 + 1800, self.t0 + 7200
+        avail = hour_bank.get_availability_df(starttime=t1, endtime=t2)
+        assert (avail["starttime"] == to_datetime64(t1)).all()
+        assert (avail["endtime"] == to_datetime64(t2)).all()
+
+    def test_get_coverage_hours(self, hour_bank):
+        """ Hourly coverage should be 0 for missing hours, else 1. """
+        df = hour_bank.get_coverage()
+        assert list(df.columns) == ["BW.RJOB..EHE", "BW.RJOB..EHN", "BW.RJOB..EHZ"]
+        assert len(df) == 12
+        assert df.index[0] == to_datetime64(self.t0)
+        expected = [0.0 if x in self.missing_hours else 1.0 for x in range(12)]
+        for seed_id in df.columns:
+            assert np.allclose(df[seed_id].values, expected)
+
+    def test_get_coverage_bins(self, hour_bank):
+        """ Bins of any size and times should give the covered fractions. """
+        df = hour_bank.get_coverage(channel="EHZ", bin_size=4 * 3600)
+        assert np.allclose(df["BW.RJOB..EHZ"], [0.75, 0.75, 0.75])
+        t1, t2 = self.t0 + 2.5 * 3600, self.t0 + 5.5 * 3600
+        df = hour_bank.get_coverage(
+            starttime=t1, endtime=t2, bin_size=np.timedelta64(1, "h")
+        )
+        assert df.index[0] == to_datetime64(t1)
+        assert np.allclose(df["BW.RJOB..EHN"], [0.5, 0.0, 0.5])
+
+    def test_get_coverage_no_data(self, hour_bank):
+        """ No matching channels should give an empty dataframe. """
+        assert hour_bank.get_coverage(station="BOB").empty
+
+    def test_min_gap(self, hour_bank):
+        """ Larger min_gaps merge coverage, smaller ones use the index. """
+        gaps = hour_bank.get_gaps_df(min_gap=3600 * 2)
+        # only the two missing hours are a long enough gap
+        assert len(gaps) == 3
+        assert (gaps["gap_duration"] == np.timedelta64(7201, "s")).all()
+        self.assert_coverage_matches_index(hour_bank, min_gap=3600 * 2)
+        small = hour_bank.get_gaps_df(min_gap=0.5)
+        expected = hour_bank._get_gaps_from_index(min_gap=0.5)
+        assert len(small) == len(expected) > 6
+
 
 class TestBadInputs:
     """ ensure wavebank handles bad inputs correctly """
@@ -1324,6 +2963,79 @@ class TestConcurrentUpdateIndex:
             pytest.fail(msg)
 
 
+class TestIndexLocks:
+    """ Tests for the locks coordinating readers and writers of the index. """
+
+    @pytest.fixture
+    def bank(self, trace_dir):
+        """ Create a bank of the default stream. """
+        return WaveBank(trace_dir).update_index()
+
+    def read_in_thread(self, reader) -> tuple:
+        """ Read the index in a thread, return the thread and output list. """
+        out = []
+        thread = threading.Thread(target=lambda: out.append(reader.read_index()))
+        thread.start()
+        return thread, out
+
+    def test_readers_wait_for_writes(self, bank):
+        """ Reads should wait for a write, then see all of it. """
+        st = station_stream("BOB")
+        reader = WaveBank(bank.bank_path)  # with its own lock file handle
+        with bank._index_lock(exclusive=True):
+            thread, out = self.read_in_thread(reader)
+            thread.join(0.3)
+            assert not out  # the reader is blocked, not retrying
+            st.write(str(bank.bank_path / "bob.mseed"), "mseed")
+            bank.update_index()
+        thread.join(10)
+        assert len(out[0]) == 6
+
+    def test_update_holds_write_lock(self, bank, monkeypatch):
+        """ update_index and compact_index should hold the write lock. """
+        held = []
+
+        def _write_update(*args, **kwargs):
+            held.append(bank._write_lock._depth)
+
+        obspy.read().write(str(bank.bank_path / "new.mseed"), "mseed")
+        monkeypatch.setattr(bank, "_write_update", _write_update)
+        bank.update_index()
+        assert held and all(held)
+
+    def test_no_retry_sleeps(self, bank, monkeypatch):
+        """ Errors reading the index should raise rather than sleep. """
+
+        def _select_index(*args, **kwargs):
+            raise ValueError("bad index")
+
+        monkeypatch.setattr(bank, "_select_index", _select_index)
+        monkeypatch.setattr(time, "sleep", None)
+        with pytest.raises(ValueError, match="bad index"):
+            bank.read_index()
+
+    def test_lock_files_not_writable(self, bank, monkeypatch):
+        """ Reads should work if the lock files can't be created. """
+        for path in bank.bank_path.glob("*.lock"):
+            path.unlink()
+
+        def _open(*args, **kwargs):
+            raise PermissionError("read only")
+
+        # only the lock files are opened with open in obsplus.utils.bank
+        monkeypatch.setattr(obsplus.utils.bank, "open", _open, raising=False)
+        reader = WaveBank(bank.bank_path)
+        assert len(reader.read_index()) == 3
+        assert len(reader.get_waveforms()) == 3
+        assert not list(bank.bank_path.glob("*.lock"))
+
+    def test_pickle(self, bank):
+        """ Banks should pickle, for use in other processes. """
+        new = pickle.loads(pickle.dumps(bank))
+        assert new.read_index().equals(bank.read_index())
+        assert new._index_cache.bank is new
+
+
 class TestSelectDoesntReturnSuperset:
     """ make sure selecting on an attribute doesnt return a superset of that
     attribute. EG, selecting station '2' should not also return station '22'
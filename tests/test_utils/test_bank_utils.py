@@ -2,7 +2,10 @@
 Tests for the bank-specific utilities
 """
 import os
+import pickle
 import tempfile
+import threading
+import time
 
 import numpy as np
 import obspy
@@ -10,13 +13,30 @@ import pytest
 import pandas as pd
 from obspy import UTCDateTime as UTC
 
+import obsplus.utils.mseed
 from obsplus.utils.bank import (
     _summarize_trace,
     _try_read_stream,
     summarize_generic_stream,
+    _IntervalIndex,
+    _interval_join,
+    _coalesce_intervals,
+    _binned_coverage,
+    _interval_gaps,
+    _plan_index_query,
+    _PrunedFileIterator,
+    _TraceCache,
+    _FileLock,
+    DIRECTORY_COLUMNS,
+)
+from obsplus.utils.mseed import (
+    summarize_mseed,
+    summarize_mseed_headers,
+    summarize_mseed_auto,
+    summarize_mseed_blocks,
 )
-from obsplus.utils.mseed import summarize_mseed
 from obsplus.utils.events import _summarize_event
+from obsplus.utils.time import to_datetime64
 from obsplus.constants import NSLC
 
 
@@ -174,3 +194,462 @@ class TestSummarizeStreams:
         df2 = self.clean_dataframe(pd.DataFrame(summary_2))
         assert len(df1) == len(df2)
         assert (df1 == df2).all().all()
+
+
+class TestSummarizeMseedHeaders:
+    """ Tests for the NumPy miniSEED header scanner. """
+
+    @staticmethod
+    def _sorted(summaries):
+        """ Decode bytes and sort a list of summaries. """
+        out = []
+        for summary in summaries:
+            items = summary.items()
+            out.append({i: v.decode() if isinstance(v, bytes) else v for i, v in items})
+        return sorted(out, key=lambda x: (x["channel"], x["starttime"]))
+
+    def _streams(self):
+        """ Yield (name, stream, write kwargs) to test. """
+        st = obspy.read()
+        yield "default", st, {}
+        yield "little_endian", st, dict(byteorder="<", reclen=512)
+        yield "large_records", st, dict(reclen=4096)
+        shifted = st.copy()
+        for tr in shifted:
+            tr.stats.starttime += 0.000123
+        yield "microseconds", shifted, {}
+        t1 = st[0].stats.starttime
+        gappy = st.copy().trim(endtime=t1 + 10) + st.copy().trim(starttime=t1 + 20)
+        yield "gappy", gappy, {}
+        slow = st.copy()
+        for tr in slow:
+            tr.stats.sampling_rate = 0.1
+        yield "slow", slow, dict(encoding="FLOAT64")
+        yield "overlapping", st + st.copy().trim(starttime=t1 + 5), {}
+
+    def test_matches_libmseed(self, tmp_path):
+        """ The summaries should match those made with libmseed. """
+        for name, st, kwargs in self._streams():
+            path = str(tmp_path / f"{name}.mseed")
+            st.write(path, "mseed", **kwargs)
+            expected = self._sorted(summarize_mseed(path))
+            assert self._sorted(summarize_mseed_headers(path)) == expected
+
+    def test_small_windows(self, tmp_path):
+        """ Runs spanning several mapped windows should be merged. """
+        for name, st, kwargs in self._streams():
+            path = str(tmp_path / f"{name}.mseed")
+            st.write(path, "mseed", **kwargs)
+            expected = self._sorted(summarize_mseed(path))
+            out = summarize_mseed_headers(path, window_bytes=1024)
+            assert self._sorted(out) == expected
+
+    def test_blocks(self, tmp_path):
+        """ Record blocks should tile the file and bound the record times. """
+        path = str(tmp_path / "blocks.mseed")
+        st = obspy.read()
+        st.write(path, "mseed", reclen=512)
+        df = summarize_mseed_blocks(path, 3)
+        assert (df["offset"].values[1:] == (df["offset"] + df["nbytes"])[:-1]).all()
+        assert df["nbytes"].sum() == os.path.getsize(path)
+        t1 = to_datetime64(min(tr.stats.starttime for tr in st)).astype(np.int64)
+        t2 = to_datetime64(max(tr.stats.endtime for tr in st)).astype(np.int64)
+        assert df["starttime"].min() < t1 and df["endtime"].max() > t2
+        assert df.equals(summarize_mseed_blocks(path, 3, window_bytes=1024))
+
+    def test_bad_file_raises(self, text_file):
+        """ Files which are not miniSEED should raise a ValueError. """
+        with pytest.raises(ValueError):
+            summarize_mseed_headers(text_file)
+
+    def test_fallback(self, tmp_path, monkeypatch):
+        """ Files the scanner doesnt support should be read with libmseed. """
+        monkeypatch.setattr(obsplus.utils.mseed, "_MIN_SCAN_BYTES", 0)
+        path = tmp_path / "mixed.mseed"
+        st = obspy.read()
+        st[:1].write(str(path), "mseed", reclen=512)
+        with path.open("ab") as fi:
+            st[1:].write(fi, "mseed", reclen=4096)
+        with pytest.raises(ValueError):
+            summarize_mseed_headers(str(path))
+        out = summarize_mseed_auto(str(path))
+        assert self._sorted(out) == self._sorted(summarize_mseed(str(path)))
+
+
+class TestTraceCache:
+    """ Tests for the LRU cache of decoded traces. """
+
+    @pytest.fixture
+    def cache(self):
+        """ Return a cache which can hold two of the default traces. """
+        nbytes = obspy.read()[0].data.nbytes
+        return _TraceCache(max_bytes=nbytes * 2)
+
+    def test_lru_eviction(self, cache):
+        """ The least recently used entry should be evicted first. """
+        st = obspy.read()
+        cache.put(("a", 1, st[0].id), [st[0]])
+        cache.put(("b", 1, st[1].id), [st[1]])
+        assert cache.get(("a", 1, st[0].id)) == [st[0]]
+        cache.put(("c", 1, st[2].id), [st[2]])
+        assert cache.get(("b", 1, st[1].id)) is None
+        assert len(cache) == 2 and cache.nbytes <= cache.max_bytes
+        assert cache.hits == 1 and cache.misses == 1
+
+    def test_too_large_not_cached(self, cache):
+        """ Entries larger than the budget should not be cached. """
+        cache.put(("a", 1, "all"), list(obspy.read()))
+        assert len(cache) == 0 and cache.nbytes == 0
+
+    def test_invalidate(self, cache):
+        """ Invalidating a path should remove all of its entries. """
+        st = obspy.read()
+        cache.put(("a", 1, st[0].id), [st[0]])
+        cache.put(("a", 1, st[1].id), [st[1]])
+        cache.invalidate(["a"])
+        assert len(cache) == 0 and cache.nbytes == 0
+
+
+@pytest.mark.skipif(os.name == "nt", reason="file locks need fcntl")
+class TestFileLock:
+    """ Tests for the shared and exclusive locks of index files. """
+
+    @pytest.fixture
+    def path(self, tmp_path):
+        """ Return the path of a lock file. """
+        return tmp_path / ".index.h5.lock"
+
+    def acquire(self, path, exclusive=False, lock=None) -> threading.Event:
+        """
+        Take a lock (a new one of path if None) in a thread, return an event
+        set once taken.
+        """
+        event = threading.Event()
+
+        def _take():
+            with (lock or _FileLock(path))(exclusive=exclusive):
+                event.set()
+
+        threading.Thread(target=_take, daemon=True).start()
+        return event
+
+    def test_shared_locks(self, path):
+        """ Shared locks should not block each other. """
+        with _FileLock(path)():
+            assert self.acquire(path).wait(5)
+
+    def test_exclusive_blocks(self, path):
+        """ An exclusive lock should block other locks until released. """
+        with _FileLock(path)(exclusive=True):
+            shared = self.acquire(path)
+            assert not shared.wait(0.2)
+        assert shared.wait(5)
+        with _FileLock(path)():
+            assert not self.acquire(path, exclusive=True).wait(0.2)
+
+    def test_reentrant(self, path):
+        """ Nested locks should convert and release the lock at the end. """
+        lock = _FileLock(path)
+        with lock():
+            with lock(exclusive=True):
+                assert lock._exclusive
+                with lock():
+                    assert lock._exclusive
+            assert not lock._exclusive
+        assert lock._file is None and lock._depth == 0
+        assert self.acquire(path, exclusive=True).wait(5)
+
+    def test_threads_share_lock(self, path):
+        """ Threads should hold one lock shared at once, but not exclusive. """
+        lock = _FileLock(path)
+        with lock():
+            assert self.acquire(path, lock=lock).wait(5)
+            exclusive = self.acquire(path, exclusive=True, lock=lock)
+            assert not exclusive.wait(0.2)
+        assert exclusive.wait(5)
+        # and the file lock is released by the last thread
+        assert self.acquire(path, exclusive=True).wait(5)
+
+    def test_threads_convert_lock(self, path):
+        """ Threads converting a shared lock at once should not deadlock. """
+        lock, barrier, out = _FileLock(path), threading.Barrier(2), []
+
+        def _convert():
+            with lock():
+                barrier.wait(5)
+                with lock(exclusive=True):
+                    out.append(lock._exclusive)
+
+        threads = [threading.Thread(target=_convert) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert out == [True, True]
+
+    def test_pickle(self, path):
+        """ A lock should pickle without its state. """
+        lock = _FileLock(path)
+        with lock():
+            new = pickle.loads(pickle.dumps(lock))
+        assert new.path == lock.path and new._depth == 0
+
+
+class TestPlanIndexQuery:
+    """ Tests for creating HDF5 queries of the index. """
+
+    def test_unbounded(self):
+        """ No times or codes should need no query. """
+        assert _plan_index_query() is None
+
+    def test_times(self):
+        """ Each bounded side of the query should add one condition. """
+        assert _plan_index_query(10, 20) == "(starttime <= 20) & (endtime >= 10)"
+        assert _plan_index_query(endtime=20) == "(starttime <= 20)"
+
+    def test_codes(self):
+        """ Rows should match one of the codes of each column. """
+        out = _plan_index_query(None, 20, {"station": [1, 2], "network": [0]})
+        expected = (
+            "(starttime <= 20) & (network == 0) & ((station == 1) | (station == 2))"
+        )
+        assert out == expected
+
+
+class TestIntervalIndex:
+    """ Tests for the interval structure used to trim cached indices. """
+
+    @pytest.fixture(scope="class")
+    def time_df(self):
+        """ Create a dataframe of random, overlapping time intervals. """
+        rand = np.random.RandomState(13)
+        starts = rand.randint(0, 10_000, 500)
+        durations = rand.randint(0, 500, 500)
+        df = pd.DataFrame({"starttime": starts, "endtime": starts + durations})
+        return df.astype("datetime64[ns]")
+
+    @pytest.fixture(scope="class")
+    def intervals(self, time_df):
+        """ Create the interval index from the time dataframe. """
+        return _IntervalIndex(time_df["starttime"], time_df["endtime"])
+
+    def test_matches_boolean_mask(self, time_df, intervals):
+        """ Queries should return the same rows as a brute force mask. """
+        for t1, t2 in [(0, 10), (5000, 5000), (1000, 3000), (-50, 20_000)]:
+            t1, t2 = np.datetime64(t1, "ns"), np.datetime64(t2, "ns")
+            open_mask = (time_df.starttime < t2) & (time_df.endtime > t1)
+            expected = np.flatnonzero(open_mask.values)
+            assert np.array_equal(intervals.query(t1, t2), expected)
+            closed_mask = (time_df.starttime <= t2) & (time_df.endtime >= t1)
+            expected = np.flatnonzero(closed_mask.values)
+            assert np.array_equal(intervals.query(t1, t2, closed=True), expected)
+
+    def test_empty(self):
+        """ An empty interval index should return no rows. """
+        ser = pd.Series([], dtype="datetime64[ns]")
+        intervals = _IntervalIndex(ser, ser)
+        out = intervals.query(np.datetime64(0, "ns"), np.datetime64(10, "ns"))
+        assert len(out) == 0
+
+
+class TestIntervalJoin:
+    """ Tests for joining query intervals to index intervals. """
+
+    def test_matches_brute_force(self):
+        """ The join should return all overlapping pairs with the same code. """
+        rand = np.random.RandomState(42)
+        for _ in range(20):
+            left_codes, codes = rand.randint(0, 4, 30), rand.randint(0, 4, 50)
+            left_starts, starts = rand.randint(0, 1000, 30), rand.randint(0, 1000, 50)
+            left_ends = left_starts + rand.randint(0, 100, 30)
+            ends = starts + rand.randint(0, 100, 50)
+            out = _interval_join(
+                left_codes, left_starts, left_ends, codes, starts, ends
+            )
+            expected = {
+                (i, j)
+                for i in range(30)
+                for j in range(50)
+                if left_codes[i] == codes[j]
+                and starts[j] <= left_ends[i]
+                and ends[j] >= left_starts[i]
+            }
+            assert set(zip(*out)) == expected
+            assert len(out[0]) == len(expected)
+
+    def test_empty(self):
+        """ Joining empty arrays should return empty positions. """
+        empty = np.array([], dtype=np.int64)
+        left_pos, right_pos = _interval_join(empty, empty, empty, [0], [0], [1])
+        assert len(left_pos) == len(right_pos) == 0
+
+
+class TestCoalesceIntervals:
+    """ Tests for merging overlapping and nearby intervals. """
+
+    def test_groups(self):
+        """ Intervals within tolerance of the same code share a group. """
+        codes = [0, 0, 0, 0, 1, 0]
+        starts = [0, 5, 20, 31, 6, 100]
+        ends = [10, 8, 30, 40, 9, 101]
+        out = _coalesce_intervals(codes, starts, ends, tolerance=1)
+        assert list(out) == [0, 0, 1, 1, 3, 2]
+
+    def test_nested(self):
+        """ An interval inside a longer one shouldn't end the group. """
+        out = _coalesce_intervals([0, 0, 0], [0, 1, 50], [100, 2, 60])
+        assert list(out) == [0, 0, 0]
+
+    def test_empty(self):
+        """ No intervals should give no groups. """
+        assert len(_coalesce_intervals([], [], [])) == 0
+
+
+class TestIntervalGaps:
+    """ Tests for finding gaps between the intervals of each code. """
+
+    def test_gaps(self):
+        """ Gaps longer than tolerance between intervals of a code are found. """
+        codes = [1, 0, 0, 0, 1, 0]
+        starts = [0, 20, 0, 31, 50, 100]
+        ends = [10, 30, 10, 40, 60, 101]
+        pos, gap_starts, gap_ends = _interval_gaps(codes, starts, ends, 1)
+        assert list(pos) == [1, 5, 4]
+        assert list(gap_starts) == [10, 40, 10]
+        assert list(gap_ends) == [20, 100, 50]
+
+    def test_nested(self):
+        """ A gap starts at the latest end of the preceding intervals. """
+        pos, gap_starts, gap_ends = _interval_gaps([0] * 3, [0, 1, 50], [40, 2, 60])
+        assert list(pos) == [2]
+        assert list(gap_starts) == [40]
+        assert list(gap_ends) == [50]
+
+    def test_tolerance_per_interval(self):
+        """ Each interval may have its own tolerance. """
+        out = _interval_gaps([0, 0, 1, 1], [0, 10, 0, 10], [5, 20, 5, 20], [1, 1, 9, 9])
+        assert list(out[0]) == [1]
+
+    def test_empty(self):
+        """ No intervals should give no gaps. """
+        assert all(len(x) == 0 for x in _interval_gaps([], [], []))
+
+
+class TestBinnedCoverage:
+    """ Tests for finding the fraction of time bins covered by intervals. """
+
+    def test_matches_brute_force(self):
+        """ Fractions should match the overlap of each bin and interval. """
+        rand = np.random.RandomState(42)
+        codes, starts, ends, time = [], [], [], 0
+        for num in range(30):
+            time += rand.randint(0, 50)
+            duration = rand.randint(1, 50)
+            codes.append(num % 3)
+            starts.append(time)
+            ends.append(time + duration)
+            time += duration
+        edges = np.array([-10, 0, 13, 100, 101, 400, 2000])
+        out = _binned_coverage(codes, starts, ends, edges)
+        assert out.shape == (3, 6)
+        for code in range(3):
+            for num, (t1, t2) in enumerate(zip(edges[:-1], edges[1:])):
+                covered = sum(
+                    max(0, min(end, t2) - max(start, t1))
+                    for cod, start, end in zip(codes, starts, ends)
+                    if cod == code
+                )
+                assert np.isclose(out[code, num], covered / (t2 - t1))
+
+
+class TestIterPrunedFiles:
+    """ Tests for walking directories while skipping unchanged listings. """
+
+    old = time.time() - 100
+
+    def age(self, path):
+        """ Set the mtime of all files and directories in path to old. """
+        for root, _, files in os.walk(path):
+            for name in files + ["."]:
+                os.utime(os.path.join(root, name), (self.old, self.old))
+
+    @staticmethod
+    def walk(path, manifest=None, **kwargs):
+        """ Walk path, return a set of files and the new manifest. """
+        walker = _PrunedFileIterator(path, manifest, **kwargs)
+        files = set(walker)
+        rows = list(walker.directories.values())
+        return files, pd.DataFrame(rows, columns=list(DIRECTORY_COLUMNS))
+
+    @pytest.fixture
+    def tree(self, tmp_path):
+        """ Create a small directory tree of text files. """
+        for sub in ["a/1", "a/2", "b"]:
+            path = tmp_path / sub
+            path.mkdir(parents=True)
+            for name in ["x.txt", "y.txt", ".hidden.txt"]:
+                (path / name).write_text("data")
+        self.age(tmp_path)
+        return tmp_path
+
+    def test_no_manifest_yields_all(self, tree):
+        """ Without a manifest all (non-hidden) files should be yielded. """
+        files, manifest = self.walk(tree)
+        assert files == {str(x) for x in tree.rglob("[!.]*.txt")}
+        expected = {".", "a", "a/1", "a/2", "b"}
+        assert set(manifest["path"]) == expected
+        counts = manifest.set_index("path")["file_count"]
+        assert counts["a/1"] == 2 and counts["a"] == 0
+
+    def test_unchanged_directories_pruned(self, tree):
+        """ Files modified in place in unchanged directories are not found. """
+        _, manifest = self.walk(tree)
+        path = tree / "a" / "1" / "x.txt"
+        path.write_text("new data")
+        os.utime(path.parent, (self.old, self.old))
+        files, new_manifest = self.walk(tree, manifest, mtime=self.old + 1)
+        assert not files
+        assert set(new_manifest["path"]) == set(manifest["path"])
+
+    def test_changed(self, tree):
+        """ The iterator should report if the manifest changed. """
+        walker = _PrunedFileIterator(tree)
+        list(walker)
+        assert walker.changed
+        manifest = pd.DataFrame(list(walker.directories.values()))
+        manifest.columns = list(DIRECTORY_COLUMNS)
+        walker = _PrunedFileIterator(tree, manifest)
+        list(walker)
+        assert not walker.changed
+        (tree / "b" / "z.txt").write_text("data")
+        list(walker)
+        assert walker.changed
+
+    def test_new_files_found(self, tree):
+        """ A file created in a nested directory should be found. """
+        _, manifest = self.walk(tree)
+        new_path = tree / "a" / "2" / "z.txt"
+        new_path.write_text("data")
+        files, _ = self.walk(tree, manifest, mtime=self.old + 1)
+        assert files == {str(new_path)}
+
+    def test_new_and_removed_directories(self, tree):
+        """ New directories should be walked and removed ones dropped. """
+        _, manifest = self.walk(tree)
+        for path in (tree / "b").iterdir():
+            path.unlink()
+        (tree / "b").rmdir()
+        new_dir = tree / "a" / "1" / "c"
+        new_dir.mkdir()
+        (new_dir / "x.txt").write_text("data")
+        files, new_manifest = self.walk(tree, manifest, mtime=self.old + 1)
+        assert files == {str(new_dir / "x.txt")}
+        assert set(new_manifest["path"]) == {".", "a", "a/1", "a/1/c", "a/2"}
+
+    def test_recently_listed_directories_relisted(self, tree):
+        """ Directories modified just before being listed are listed again. """
+        _, manifest = self.walk(tree)
+        # mtimes may be too coarse to detect changes made shortly after listing
+        manifest["listed"] = manifest["mtime"] + 0.5
+        files, _ = self.walk(tree, manifest)
+        assert files == {str(x) for x in tree.rglob("[!.]*.txt")}
@@ -191,6 +191,36 @@ class TestGetWaveformsBulkArgs:
         self.assert_wellformed_bulk_args(bulk)
 
 
+class TestCategoricalNSLC:
+    """
+    Tests for seed id and filtering functions on categorical NSLC columns.
+    """
+
+    @pytest.fixture
+    def nslc_df(self, waveform_df):
+        """ Return a dataframe with some nullish codes added. """
+        df = pd.concat([waveform_df] * 3, ignore_index=True)
+        df.loc[0, "location"] = None
+        df.loc[1, "network"] = "None"
+        df.loc[2, "station"] = "RJOB2"
+        return df
+
+    def test_seed_id_series_equal(self, nslc_df):
+        """ Categorical columns should produce the same seed ids as str. """
+        cat_df = nslc_df.astype({x: "category" for x in NSLC})
+        out1 = upd.get_seed_id_series(nslc_df)
+        out2 = upd.get_seed_id_series(cat_df)
+        assert out1.equals(out2)
+
+    def test_filter_df_equal(self, nslc_df):
+        """ Filtering categorical columns should match filtering str. """
+        cat_df = nslc_df.astype({x: "category" for x in NSLC})
+        for kwargs in [{"station": "RJOB"}, {"channel": "*Z"}, {"station": "R*2"}]:
+            out1 = upd.filter_df(nslc_df, **kwargs)
+            out2 = upd.filter_df(cat_df, **kwargs)
+            assert np.all(out1 == out2)
+
+
 class TestMisc:
     """ Misc. small tests. """
 